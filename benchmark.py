@@ -0,0 +1,621 @@
+# benchmark.py
+"""
+End-to-end benchmark of the pipeline on a reproducible synthetic Thai corpus.
+
+The corpus (Thai .txt / .docx documents with '========== PAGE N ==========' markers,
+laid out as <category>/<service>/<document_type>/ with _folder.meta.json sidecars)
+is generated offline from benchmark.seed and reused while its parameters do not
+change. Every stage then runs in-process on it, the same way main_ingest.py and
+main_index.py run them:
+
+    discovery    discover_source_files over the corpus
+    extraction   stream_extractions (process pool of ingest.extraction_workers)
+    metadata     generate_metadata_fields against stub_llm_server.py (no real LLM)
+    parse.*      chunk_item with each strategy in benchmark.strategies
+    embed        EmbeddingBatcher over the chunks of chunking.strategy (small local model, no cache)
+    store.*      add / persist into each store in benchmark.stores (scratch directory / database)
+    lexical.*    build of the BM25 index from the store (when search.lexical.enabled)
+    search.*.*   one text query at a time, per search mode
+
+For each stage the report holds the item count, wall time, throughput, p50/p99
+latency (per item, or per batch for batched stages; the wait per item for the
+streaming stages) and the peak RSS of the process during the stage. The report
+is written as JSON and compared with a stored baseline: a stage whose throughput
+dropped, or whose p99 grew, by more than benchmark.tolerance is a regression
+(exit code 1).
+
+    python benchmark.py                    # run and compare with benchmark.baseline_path
+    python benchmark.py --save-baseline    # run and store the result as the new baseline
+    python benchmark.py --documents 50     # quick run on a smaller corpus
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+from pipeline_lib.config_loader import load_config
+from pipeline_lib.db_handler import get_db_connection, ensure_ingest_schema, load_known_sources
+from pipeline_lib.discovery import SidecarResolver, discover_source_files, FOLDER_SIDECAR
+from pipeline_lib.embedding import EmbeddingProvider, EmbeddingBatcher, create_embedding_backend
+from pipeline_lib.extraction import stream_extractions
+from pipeline_lib.storage import FaissStore, ShardedFaissStore, PGVectorStore, SearchEngine, build_lexical_index, pgvector_maintenance
+from pipeline_lib.storage.search import SEARCH_MODES
+from pipeline_lib.utils import setup_logging
+from main_index import load_strategy_settings, chunk_item
+
+# เปลี่ยนเมื่อรูปแบบของ corpus เปลี่ยน เพื่อให้สร้าง corpus ใหม่แทนการใช้ของเดิม
+CORPUS_VERSION = 1
+
+# ไฟล์ที่บอกว่าโฟลเดอร์ทำงานสร้างโดยสคริปต์นี้ (ลบได้โดยไม่เสียข้อมูลอื่น)
+WORK_MARKER = ".benchmark_work"
+
+# ความต่างของเวลาที่น้อยกว่านี้ (ms) ถือเป็น noise ไม่นับเป็น regression
+NOISE_MS = 1.0
+
+# --- คำศัพท์สำหรับสร้างเอกสารจำลอง (หน่วยงาน -> งานบริการ) ---
+CATEGORIES = {
+    'กรมการปกครอง': ['บัตรประจำตัวประชาชน', 'ทะเบียนราษฎร์', 'อาวุธปืน', 'การเปลี่ยนชื่อตัว'],
+    'กรมการขนส่งทางบก': ['ใบอนุญาตขับรถ', 'ทะเบียนรถ', 'ภาษีรถประจำปี'],
+    'สำนักงานคณะกรรมการอาหารและยา': ['ใบอนุญาตผลิตอาหาร', 'เครื่องสำอาง', 'ยาแผนโบราณ'],
+    'กรมพัฒนาธุรกิจการค้า': ['การจดทะเบียนบริษัท', 'ทะเบียนพาณิชย์'],
+}
+DOCUMENT_TYPES = ['คู่มือสำหรับประชาชน', 'ประกาศ', 'ระเบียบ', 'แนวทางปฏิบัติ']
+ACTIONS = ['การขอ', 'การต่ออายุ', 'การแจ้งเปลี่ยนแปลง', 'การยกเลิก', 'การขอใบแทน']
+SUBJECTS = ['ผู้ยื่นคำขอ', 'เจ้าหน้าที่', 'นายทะเบียน', 'ผู้ประกอบการ', 'เจ้าบ้าน', 'ผู้รับมอบอำนาจ']
+VERBS = ['ต้องยื่น', 'ต้องแสดง', 'สามารถขอรับ', 'จะตรวจสอบ', 'ต้องจัดเตรียม', 'ต้องลงนามใน']
+OBJECTS = ['แบบคำขอ', 'สำเนาทะเบียนบ้าน', 'บัตรประจำตัวประชาชนฉบับจริง', 'หนังสือมอบอำนาจ',
+           'รูปถ่ายขนาด 1 นิ้ว จำนวน 2 รูป', 'ใบรับรองแพทย์', 'หลักฐานการชำระภาษี', 'สำเนาสูติบัตร']
+PLACES = ['ที่สำนักงานเขต', 'ที่ที่ว่าการอำเภอ', 'ผ่านระบบออนไลน์', 'ที่สำนักงานขนส่งจังหวัด',
+          'ณ ศาลากลางจังหวัด', 'ที่สำนักงานเทศบาล']
+CONDITIONS = ['ภายใน {n} วันนับแต่วันที่มีการเปลี่ยนแปลง', 'ก่อนวันที่ใบอนุญาตหมดอายุ', 'ในวันและเวลาราชการ',
+              'ตามที่กฎหมายกำหนด', 'โดยไม่ต้องนัดหมายล่วงหน้า']
+FORMS = ['แบบ ป.4', 'แบบ ท.ร.14', 'แบบ บ.ป.1', 'แบบ ภ.ง.ด.90', 'แบบ ร.ส.3', 'แบบ ข.1', 'แบบ อ.1']
+WARNINGS = ['หากพบว่ามีการแจ้งข้อความอันเป็นเท็จ จะมีความผิดตามกฎหมาย',
+            'ผู้ที่ไม่ปฏิบัติตามระเบียบนี้ต้องระวางโทษปรับไม่เกิน {fee} บาท',
+            'เอกสารที่เป็นสำเนาต้องลงลายมือชื่อรับรองสำเนาถูกต้องทุกฉบับ']
+ACTIVE_FIELDS = ["document_title", "tags", "summary", "category", "source_path", "page_number", "document_type"]
+
+def _sentence(rng, section, service, action):
+    """One Thai sentence for a section of a document about (action, service)."""
+    n, fee = rng.choice([7, 15, 30, 45, 90]), rng.choice([20, 50, 100, 200, 500, 1000])
+    if section == "ค่าธรรมเนียม":
+        return f"ค่าธรรมเนียม{action}{service} ฉบับละ {fee} บาท ชำระ{rng.choice(PLACES)}"
+    if section == "ระยะเวลา":
+        return f"ระยะเวลาดำเนินการ{action}{service} {rng.choice([1, 3, 5, 7, 15])} วันทำการ นับแต่ได้รับเอกสารครบถ้วน"
+    if section == "สถานที่ติดต่อ":
+        return f"ยื่นคำขอ{rng.choice(PLACES)} {rng.choice(CONDITIONS).format(n=n)}"
+    if section == "คำเตือน":
+        return rng.choice(WARNINGS).format(fee=fee)
+    if section == "เอกสาร/หลักฐานที่ใช้":
+        return f"{rng.choice(OBJECTS)} และ{rng.choice(OBJECTS)} พร้อม{rng.choice(FORMS)} ที่กรอกข้อความครบถ้วน"
+    return (f"{rng.choice(SUBJECTS)}{rng.choice(VERBS)}{rng.choice(OBJECTS)}{rng.choice(PLACES)} "
+            f"{rng.choice(CONDITIONS).format(n=n)}")
+
+def _document_text(rng, title, service, action, headers, num_pages):
+    """The full text of one document: a title, then pages of header sections and paragraphs."""
+    lines = [title, ""]
+    for page in range(1, num_pages + 1):
+        lines += [f"========== PAGE {page} ==========", ""]
+        for section in rng.sample(headers, rng.randint(2, min(4, len(headers)))):
+            lines.append(section)
+            for _ in range(rng.randint(1, 4)):
+                lines.append(" ".join(_sentence(rng, section, service, action) for _ in range(rng.randint(1, 3))))
+            lines.append("")
+    return "\n".join(lines)
+
+def _write_docx(path, text):
+    import docx
+    document = docx.Document()
+    for line in text.split("\n"):
+        document.add_paragraph(line)
+    document.save(path)
+
+def _reset_directory(path, marker):
+    """
+    Empties path for a fresh run. Only a directory this script created (it holds
+    marker) or an empty one is removed; anything else raises ValueError.
+    """
+    if os.path.exists(path):
+        if os.listdir(path) and not os.path.isfile(os.path.join(path, marker)):
+            raise ValueError(f"Refusing to delete '{path}': it is not empty and has no {marker} written by this benchmark.")
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+def generate_corpus(path, num_documents, seed=42, pages=(1, 8), docx_share=0.25, headers=()) -> dict:
+    """
+    Writes a reproducible synthetic corpus under path (same seed and sizes = same
+    files) and returns its manifest, which also holds the benchmark queries.
+    """
+    rng = random.Random(seed)
+    headers = list(headers) or ["สถานที่ติดต่อ", "เอกสาร/หลักฐานที่ใช้", "ค่าธรรมเนียม", "ระยะเวลา", "คำเตือน"]
+    # ลบเฉพาะ corpus ที่สคริปต์นี้สร้างไว้ (มี corpus.json) กันพลาดตั้ง corpus_path ไปที่โฟลเดอร์ข้อมูลจริง
+    _reset_directory(path, "corpus.json")
+
+    for category in CATEGORIES:
+        os.makedirs(os.path.join(path, category))
+        with open(os.path.join(path, category, FOLDER_SIDECAR), 'w', encoding='utf-8') as f:
+            json.dump({"active_fields": ACTIVE_FIELDS, "department": category}, f, ensure_ascii=False, indent=2)
+
+    files, topics = [], []
+    for number in range(num_documents):
+        category = rng.choice(list(CATEGORIES))
+        service = rng.choice(CATEGORIES[category])
+        document_type = rng.choice(DOCUMENT_TYPES)
+        action = rng.choice(ACTIONS)
+        directory = os.path.join(path, category, service, document_type)
+        os.makedirs(directory, exist_ok=True)
+
+        title = f"{document_type} เรื่อง {action}{service}"
+        text = _document_text(rng, title, service, action, headers, rng.randint(*pages))
+        extension = ".docx" if rng.random() < docx_share else ".txt"
+        filename = f"{document_type}_{number:05d}{extension}"
+        if extension == ".docx":
+            _write_docx(os.path.join(directory, filename), text)
+        else:
+            with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+                f.write(text)
+        # บางไฟล์มี sidecar ของตัวเอง (แทนที่ _folder.meta.json ของหน่วยงาน)
+        if rng.random() < 0.05:
+            with open(os.path.join(directory, os.path.splitext(filename)[0] + ".meta.json"), 'w', encoding='utf-8') as f:
+                json.dump({"active_fields": ACTIVE_FIELDS + ["effective_date", "version"],
+                           "effective_date": f"2567-{rng.randint(1, 12):02d}-01", "version": "2"}, f, ensure_ascii=False)
+        files.append(os.path.relpath(os.path.join(directory, filename), path).replace(os.path.sep, '/'))
+        topics.append((action, service))
+
+    queries = []
+    for _ in range(max(1, num_documents)):
+        action, service = rng.choice(topics)
+        queries.append(rng.choice([
+            f"{action}{service} ต้องใช้เอกสารอะไรบ้าง",
+            f"ค่าธรรมเนียม{action}{service} กี่บาท",
+            f"{action}{service} ใช้เวลากี่วัน",
+            f"ยื่น{rng.choice(FORMS)} ได้ที่ไหน",
+        ]))
+
+    manifest = {"version": CORPUS_VERSION, "seed": seed, "documents": num_documents, "pages": list(pages),
+                "docx_share": docx_share, "headers": headers, "files": files, "queries": queries}
+    with open(os.path.join(path, "corpus.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logging.info(f"Generated a synthetic corpus of {num_documents} documents in {path}.")
+    return manifest
+
+def load_or_generate_corpus(path, num_documents, seed, pages, docx_share, headers) -> dict:
+    """Reuses the corpus at path when it was generated with the same parameters, otherwise regenerates it."""
+    manifest_path = os.path.join(path, "corpus.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        expected = {"version": CORPUS_VERSION, "seed": seed, "documents": num_documents, "pages": list(pages),
+                    "docx_share": docx_share, "headers": list(headers)}
+        if all(manifest.get(key) == value for key, value in expected.items()):
+            logging.info(f"Using the existing synthetic corpus in {path}.")
+            return manifest
+    return generate_corpus(path, num_documents, seed, pages, docx_share, headers)
+
+# --- การวัดผลของแต่ละขั้นตอน ---
+def reset_peak_rss():
+    """Resets the peak RSS (VmHWM) of this process so that the next stage reports its own peak (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process since the last reset_peak_rss() (since start where it cannot be reset)."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageRecorder:
+    """Collects the latencies of one stage and summarizes them with its wall time and peak RSS."""
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        logging.info(f"--- Benchmark stage '{name}' ---")
+        reset_peak_rss()
+        self.start = time.perf_counter()
+
+    def record(self, seconds, items=1):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.items += items
+
+    def timed(self, iterable):
+        """Yields from a streaming stage, recording the wait for each item as its latency."""
+        last = time.perf_counter()
+        for item in iterable:
+            now = time.perf_counter()
+            self.record(now - last)
+            yield item
+            last = time.perf_counter()
+
+    def finish(self, **extra) -> dict:
+        seconds = time.perf_counter() - self.start
+        latencies_ms = np.array(self.latencies or [0.0]) * 1000
+        result = {
+            "unit": self.unit,
+            "items": self.items,
+            "seconds": round(seconds, 4),
+            "throughput": round(self.items / seconds, 3) if seconds else 0.0,
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            **extra,
+        }
+        logging.info(f"{self.name}: {result['items']} {self.unit} in {seconds:.2f}s ({result['throughput']:.1f}/s), "
+                     f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+        return result
+
+def _directory_mb(path) -> float:
+    total = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return round(total / 2**20, 2)
+
+# --- ขั้นตอนของ pipeline ---
+def run_discovery(corpus_path, stages) -> list:
+    recorder = StageRecorder("discovery", "files")
+    sources = list(recorder.timed(discover_source_files(corpus_path, SidecarResolver())))
+    stages["discovery"] = recorder.finish()
+    return sources
+
+def run_extraction(sources, ingest_config, stages) -> list:
+    """Returns the documents as dicts with the fields main_ingest.py gives a job."""
+    resolver = SidecarResolver()
+    tasks = ((source, source.path, source.filename, None) for source in sources)
+    recorder = StageRecorder("extraction", "files")
+    documents = []
+    results = stream_extractions(tasks, num_workers=ingest_config.get('extraction_workers', 4),
+                                 queue_size=ingest_config.get('queue_size', 64))
+    for source, result in recorder.timed(results):
+        if isinstance(result, Exception):
+            logging.error(f"Extraction of '{source.filename}' failed: {result}")
+            continue
+        sidecar_data = resolver.load(source.sidecar_path)
+        documents.append({
+            "action": "insert", "item_id": None, "filename": source.filename, "file_full_path": source.path,
+            "sidecar_data": sidecar_data, "active_fields": sidecar_data["active_fields"], "content": result[1],
+            "source_path": source.source_path, "source_size": source.size, "source_mtime": source.mtime,
+            "content_hash": result[0],
+        })
+    stages["extraction"] = recorder.finish(children_peak_rss_mb=round(
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1))
+    return documents
+
+def run_metadata(documents, config, bench_config, corpus_path, stages) -> list:
+    """Generates the metadata of every document against a local stub LLM server; returns it in document order."""
+    from main_ingest import build_metadata, build_metadata_concurrently
+    from pipeline_lib.llm_handler import MetadataExtractor
+    from stub_llm_server import make_server
+
+    server = make_server(port=0, latency=bench_config.get('llm_latency_s', 0.05), jitter=0.0,
+                         capacity=config['llm'].get('concurrency', {}).get('max', 32))
+    threading.Thread(target=server.serve_forever, name="stub-llm", daemon=True).start()
+    llm_config = dict(config['llm'], model=server.model, cache_path=None,
+                      api_base=f"http://127.0.0.1:{server.server_address[1]}/v1")
+    extractor = MetadataExtractor(llm_config)
+    recorder = StageRecorder("metadata", "documents")
+
+    def build(job):
+        start = time.perf_counter()
+        result = build_metadata(job, extractor, corpus_path)
+        recorder.record(time.perf_counter() - start)
+        return result
+
+    try:
+        if config.get('ingest', {}).get('mode', 'SEQUENTIAL') == 'CONCURRENT':
+            results = build_metadata_concurrently(documents, build, extractor.limiter.max_limit)
+        else:
+            results = ((job, build(job)) for job in documents)
+        metadata = [final_metadata or {} for _, final_metadata in results]
+        stages["metadata"] = recorder.finish(llm_requests=server.requests)
+    finally:
+        extractor.close()
+        server.shutdown()
+        server.server_close()
+    return metadata
+
+def run_parsers(documents, metadata, strategy_settings, strategies, embedding_provider, batcher, stages) -> dict:
+    """Chunks every document with each strategy; returns {strategy: [(item_id, chunks), ...]}."""
+    chunked = {}
+    for strategy in strategies:
+        settings = dict(strategy_settings, strategy=strategy)
+        recorder = StageRecorder(f"parse.{strategy}", "documents")
+        items, num_chunks = [], 0
+        for item_id, (document, parent_metadata) in enumerate(zip(documents, metadata), start=1):
+            start = time.perf_counter()
+            chunks, _ = chunk_item(item_id, document["content"], parent_metadata, settings, embedding_provider, batcher)
+            recorder.record(time.perf_counter() - start)
+            items.append((item_id, chunks))
+            num_chunks += len(chunks)
+        stages[f"parse.{strategy}"] = recorder.finish(chunks=num_chunks)
+        chunked[strategy] = items
+    return chunked
+
+def run_embedding(chunked_items, batcher, fetch_size, stages) -> dict:
+    """
+    Embeds every chunk in batches of fetch_size documents, as main_index.py does;
+    returns {(item_id, chunk_sequence): vector}. CINEMATIC chunks are embedded too,
+    even with POOLED vectors, so that the numbers stay comparable across strategies.
+    """
+    recorder = StageRecorder("embed", "chunks")
+    embeddings = {}
+    for first in range(0, len(chunked_items), fetch_size):
+        keyed_texts = [
+            ((item_id, i + 1), chunk_text)
+            for item_id, chunks in chunked_items[first:first + fetch_size]
+            for i, (chunk_text, _) in enumerate(chunks)
+        ]
+        start = time.perf_counter()
+        embeddings.update(batcher.embed(keyed_texts))
+        recorder.record(time.perf_counter() - start, items=len(keyed_texts))
+    stages["embed"] = recorder.finish()
+    return embeddings
+
+def open_store(store_type, config, work_dir, embedding_dim, conn=None):
+    """A fresh store of store_type in the scratch directory (Faiss) or the benchmark database (pgvector)."""
+    store_config = config.get('vector_store', {})
+    if store_type == 'PGVECTOR':
+        return PGVectorStore(conn, store_config.get('pgvector', {}))
+    faiss_config = dict(store_config['faiss'], index_path=os.path.join(work_dir, 'index.bin'),
+                        metadata_path=os.path.join(work_dir, 'metadata'))
+    if faiss_config.get('sharding', {}).get('shard_by'):
+        faiss_config['sharding'] = dict(faiss_config['sharding'], path=os.path.join(work_dir, 'shards'))
+        return ShardedFaissStore(faiss_config, embedding_dim)
+    return FaissStore(faiss_config, embedding_dim)
+
+def pgvector_item_ids(conn, documents, metadata) -> dict:
+    """
+    Writes the corpus into knowledge_items of the benchmark database (replacing an
+    earlier run) and returns {benchmark item id: knowledge_items.id}.
+    """
+    from pipeline_lib.ingest_writer import IngestCheckpoint, BatchedItemWriter
+    ensure_ingest_schema(conn)
+    remove_pgvector_items(conn, [document["source_path"] for document in documents])
+    writer = BatchedItemWriter(conn, IngestCheckpoint(None), batch_size=500)
+    for document, final_metadata in zip(documents, metadata):
+        writer.add(document, final_metadata)
+    writer.close()
+    known = load_known_sources(conn)
+    return {item_id: known[document["source_path"]].item_id for item_id, document in enumerate(documents, start=1)}
+
+def remove_pgvector_items(conn, source_paths):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM knowledge_chunks WHERE knowledge_item_id IN "
+                    "(SELECT id FROM knowledge_items WHERE source_path = ANY(%s));", (source_paths,))
+        cur.execute("DELETE FROM knowledge_items WHERE source_path = ANY(%s);", (source_paths,))
+    conn.commit()
+
+def run_store(store_type, store, chunked_items, embeddings, item_ids, fetch_size, config, stages):
+    """Adds the chunks in batches of fetch_size documents, persisting every indexing.persist_every batches, then the final persist."""
+    recorder = StageRecorder(f"store.{store_type}", "chunks")
+    persist_every = config.get('indexing', {}).get('persist_every', 20)
+    for batch_number, first in enumerate(range(0, len(chunked_items), fetch_size), 1):
+        chunks_to_store = [
+            (item_ids[item_id], chunk_text, i + 1, embeddings[(item_id, i + 1)],
+             dict(chunk_meta, document_id=item_ids[item_id], chunk_id=str(uuid.uuid4()), chunk_sequence=i + 1,
+                  indexing_timestamp=datetime.now(timezone.utc).isoformat(), schema_version="2.2"))
+            for item_id, chunks in chunked_items[first:first + fetch_size]
+            for i, (chunk_text, chunk_meta) in enumerate(chunks)
+        ]
+        start = time.perf_counter()
+        store.add(chunks_to_store)
+        if batch_number % persist_every == 0:
+            store.persist(final=False)
+        recorder.record(time.perf_counter() - start, items=len(chunks_to_store))
+    store.persist()
+    if store_type == 'PGVECTOR':
+        pg_config = config['vector_store'].get('pgvector', {})
+        pgvector_maintenance.ensure_indexes(store.conn, pg_config.get('index', {}), pg_config.get('precision', 'FLOAT32'),
+                                            pg_config.get('sharding', {}).get('shard_by'))
+        pgvector_maintenance.analyze_chunks(store.conn)
+    stages[f"store.{store_type}"] = recorder.finish()
+
+def run_search(store_type, store, embedding_provider, queries, config, work_dir, stages):
+    """Searches the store one text query at a time in every available mode (lexical modes need the BM25 index)."""
+    search_config = config.get('search', {})
+    lexical_config = search_config.get('lexical', {})
+    lexical_index = None
+    if lexical_config.get('enabled'):
+        recorder = StageRecorder(f"lexical.{store_type}", "chunks")
+        lexical_index = build_lexical_index(store, dict(lexical_config, path=os.path.join(work_dir, f"lexical_{store_type}")))
+        recorder.record(time.perf_counter() - recorder.start, items=len(lexical_index))
+        stages[f"lexical.{store_type}"] = recorder.finish()
+
+    engine = SearchEngine(store, embedding_provider, batch_size=search_config.get('batch_size', 32),
+                          lexical_index=lexical_index, hybrid_config=search_config.get('hybrid', {}))
+    engine.search_texts(queries[:1], k=search_config.get('top_k', 5), mode='DENSE')  # warm-up
+    for mode in (SEARCH_MODES if lexical_index is not None else ('DENSE',)):
+        recorder = StageRecorder(f"search.{store_type}.{mode}", "queries")
+        for query in queries:
+            start = time.perf_counter()
+            engine.search_texts([query], k=search_config.get('top_k', 5), mode=mode)
+            recorder.record(time.perf_counter() - start)
+        stages[f"search.{store_type}.{mode}"] = recorder.finish()
+
+# --- รายงานและการเทียบกับ baseline ---
+def benchmark_settings(config, bench_config, num_documents, seed, strategies, stores) -> dict:
+    """The settings a run depends on; a baseline taken with other settings is compared with a notice."""
+    faiss_config = config.get('vector_store', {}).get('faiss', {})
+    return {
+        "documents": num_documents,
+        "seed": seed,
+        "strategy": config.get('chunking', {}).get('strategy', 'RECURSIVE'),
+        "chunk_size": config.get('chunking', {}).get('size', 1000),
+        "chunk_overlap": config.get('chunking', {}).get('overlap', 200),
+        "chunk_unit": config.get('chunking', {}).get('unit', 'characters'),
+        "strategies": strategies,
+        "stores": stores,
+        "faiss_index_type": faiss_config.get('index_type', 'FLAT'),
+        "faiss_precision": faiss_config.get('precision', 'FLOAT32'),
+        "faiss_shard_by": faiss_config.get('sharding', {}).get('shard_by'),
+        "pgvector_precision": config.get('vector_store', {}).get('pgvector', {}).get('precision', 'FLOAT32'),
+        "embedding_model": bench_config.get('embedding_model'),
+        "embedding_backend": config['embedding'].get('backend', 'LOCAL'),
+        "token_budget": config['embedding'].get('token_budget', 16384),
+        "ingest_mode": config.get('ingest', {}).get('mode', 'SEQUENTIAL'),
+        "search_mode": config.get('search', {}).get('hybrid', {}).get('mode', 'HYBRID'),
+    }
+
+def compare_with_baseline(report, baseline, tolerance) -> list:
+    """Prints the change of every stage against the baseline and returns the regressed stage names."""
+    changed = {key: (baseline['settings'].get(key), value)
+               for key, value in report['settings'].items() if baseline['settings'].get(key) != value}
+    if changed:
+        print("\nSettings differ from the baseline:")
+        for key, (old, new) in changed.items():
+            print(f"  {key}: {old} -> {new}")
+
+    print(f"\n{'stage':<28} {'throughput':>12} {'change':>8} {'p99 ms':>10} {'change':>8} {'peak MB':>8}")
+    regressions = []
+    for name, stage in report['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f"{name:<28} {stage['throughput']:>12.1f} {'new':>8} {stage['p99_ms']:>10.1f} {'new':>8} {stage['peak_rss_mb']:>8.0f}")
+            continue
+        throughput_change = stage['throughput'] / base['throughput'] - 1 if base['throughput'] else 0.0
+        p99_change = stage['p99_ms'] / base['p99_ms'] - 1 if base['p99_ms'] else 0.0
+        # สัดส่วนเพียงอย่างเดียวไม่พอสำหรับขั้นตอนที่เร็วมาก: ต้องช้าลงจริงเกิน NOISE_MS ด้วย
+        regressed = ((throughput_change < -tolerance and (stage['seconds'] - base['seconds']) * 1000 > NOISE_MS)
+                     or (p99_change > tolerance and stage['p99_ms'] - base['p99_ms'] > NOISE_MS))
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<28} {stage['throughput']:>12.1f} {throughput_change:>+8.1%} {stage['p99_ms']:>10.1f} "
+              f"{p99_change:>+8.1%} {stage['peak_rss_mb']:>8.0f}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic Thai corpus.")
+    parser.add_argument("--documents", type=int, help="corpus size (default: benchmark.num_documents)")
+    parser.add_argument("--seed", type=int, help="corpus seed (default: benchmark.seed)")
+    parser.add_argument("--report", help="report path (default: benchmark.report_path)")
+    parser.add_argument("--baseline", help="baseline path (default: benchmark.baseline_path)")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args()
+
+    setup_logging()
+    config = load_config()
+    if not config: return 2
+    bench_config = config.get('benchmark', {})
+    num_documents = args.documents or bench_config.get('num_documents', 200)
+    seed = args.seed if args.seed is not None else bench_config.get('seed', 42)
+    strategies = bench_config.get('strategies', ['STRUCTURE_AWARE', 'RECURSIVE', 'CINEMATIC'])
+    stores = bench_config.get('stores') or [config.get('vector_store', {}).get('type', 'FAISS')]
+    strategy_settings = load_strategy_settings(config)
+    fetch_size = config.get('indexing', {}).get('fetch_size', 50)
+
+    corpus_path = bench_config.get('corpus_path', 'storage/benchmark_corpus')
+    work_dir = bench_config.get('work_path', 'storage/benchmark_work')
+    try:
+        corpus = load_or_generate_corpus(corpus_path, num_documents, seed, tuple(bench_config.get('pages', [1, 8])),
+                                         bench_config.get('docx_share', 0.25), strategy_settings['default_headers'])
+        _reset_directory(work_dir, WORK_MARKER)
+    except ValueError as e:
+        logging.error(e)
+        return 2
+    open(os.path.join(work_dir, WORK_MARKER), 'w').close()
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "settings": benchmark_settings(config, bench_config, num_documents, seed, strategies, stores),
+        "stages": {},
+    }
+    stages = report["stages"]
+
+    # 1-3. ขั้นตอนของ ingest
+    sources = run_discovery(corpus_path, stages)
+    documents = run_extraction(sources, config.get('ingest', {}), stages)
+    metadata = run_metadata(documents, config, bench_config, corpus_path, stages)
+
+    # 4-5. chunk และ embed ด้วย model ขนาดเล็กบน CPU (ไม่ใช้ cache เพื่อให้วัดการ encode จริงทุกครั้ง)
+    embedding_config = dict(config['embedding'], model_name=bench_config.get('embedding_model', config['embedding']['model_name']),
+                            device=bench_config.get('device', 'cpu'))
+    embedding_provider = EmbeddingProvider(embedding_config)
+    embedding_backend = create_embedding_backend(embedding_config, embedding_provider)
+    batcher = EmbeddingBatcher(embedding_backend, token_budget=embedding_config.get('token_budget', 16384),
+                               max_batch_size=embedding_config.get('max_batch_size', 128))
+    conn = None
+    try:
+        chunked = run_parsers(documents, metadata, strategy_settings, strategies, embedding_provider, batcher, stages)
+        if strategy_settings['strategy'] not in chunked:
+            chunked.update(run_parsers(documents, metadata, strategy_settings, [strategy_settings['strategy']],
+                                       embedding_provider, batcher, stages))
+        chunked_items = chunked[strategy_settings['strategy']]
+        embeddings = run_embedding(chunked_items, batcher, fetch_size, stages)
+        embedding_dim = len(next(iter(embeddings.values())))
+
+        # 6-7. บันทึกลง store แล้วค้นหา
+        for store_type in stores:
+            item_ids = {item_id: item_id for item_id, _ in chunked_items}
+            if store_type == 'PGVECTOR':
+                if not bench_config.get('database'):
+                    logging.warning("Skipping PGVECTOR: set benchmark.database to a scratch database to benchmark it.")
+                    continue
+                conn = conn or get_db_connection(bench_config['database'])
+                if not conn:
+                    continue
+                item_ids = pgvector_item_ids(conn, documents, metadata)
+            store_dir = os.path.join(work_dir, store_type.lower())
+            store = open_store(store_type, config, store_dir, embedding_dim, conn)
+            run_store(store_type, store, chunked_items, embeddings, item_ids, fetch_size, config, stages)
+            if store_type != 'PGVECTOR':
+                stages[f"store.{store_type}"]["disk_mb"] = _directory_mb(store_dir)
+            run_search(store_type, store, embedding_provider, corpus["queries"], config, store_dir, stages)
+            if store_type == 'PGVECTOR':
+                remove_pgvector_items(conn, [document["source_path"] for document in documents])
+    finally:
+        embedding_backend.close()
+        if conn:
+            conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report_path = args.report or bench_config.get('report_path', 'storage/benchmark_report.json')
+    write_json(report_path, report)
+    logging.info(f"Benchmark report written to {report_path}")
+
+    baseline_path = args.baseline or bench_config.get('baseline_path', 'storage/benchmark_baseline.json')
+    if args.save_baseline:
+        write_json(baseline_path, report)
+        logging.info(f"Saved as the new baseline: {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        logging.info(f"No baseline at {baseline_path}; run with --save-baseline to create one.")
+        return 0
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(report, baseline, bench_config.get('tolerance', 0.10))
+    if regressions:
+        logging.warning(f"{len(regressions)} stages regressed by more than {bench_config.get('tolerance', 0.10):.0%}: "
+                        f"{', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
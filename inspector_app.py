@@ -1,26 +1,24 @@
 # inspector_app.py
 import streamlit as st
-import json
-import os
 import pandas as pd
-from collections import defaultdict
 
 # Import library ของโปรเจกต์เรา
 from pipeline_lib.config_loader import load_config
 from pipeline_lib.db_handler import get_db_connection
+from pipeline_lib.storage import create_storage_adapter
 
 # --- การตั้งค่า ---
 CONFIG_PATH = "config.yaml"
 
 # --- ฟังก์ชันเสริม ---
 
-@st.cache_data # Cache a data loading to improve performance
-def load_faiss_metadata(filepath):
-    """Loads the Faiss metadata JSON file."""
-    if not os.path.exists(filepath):
+@st.cache_resource # Cache the opened store; the index and chunks are read from memory-mapped files on demand
+def load_faiss_store(store_config):
+    """Opens the (possibly sharded) Faiss index and its metadata read-only (None if they do not exist yet)."""
+    try:
+        return create_storage_adapter(store_config, None, read_only=True)
+    except FileNotFoundError:
         return None
-    with open(filepath, 'r', encoding='utf-8') as f:
-        return json.load(f)
 
 @st.cache_resource # Cache DB connection
 def get_cached_db_connection(db_config):
@@ -112,31 +110,20 @@ if store_type == 'PGVECTOR':
                 display_chunks(parent_item[0] if parent_item else None, chunks)
 
 # ===================================================================
-# โหมดที่ 2: ตรวจสอบจาก Faiss (ไฟล์ .bin และ .json)
+# โหมดที่ 2: ตรวจสอบจาก Faiss (ไฟล์ .bin และ metadata sidecar)
 # ===================================================================
 elif store_type == 'FAISS':
     st.header("Inspecting from Faiss Files")
-    metadata_path = config.get('vector_store', {}).get('faiss', {}).get('metadata_path', '')
-    
-    records = load_faiss_metadata(metadata_path)
-    if records:
-        # เตรียมข้อมูลสำหรับแสดงผล
-        doc_summary = defaultdict(lambda: {'title': 'N/A', 'chunk_count': 0, 'chunks': []})
-        for i, record in enumerate(records):
-            doc_id = record['metadata'].get('document_id')
-            if doc_id:
-                doc_summary[doc_id]['title'] = record['metadata'].get('document_title', 'Title not found')
-                doc_summary[doc_id]['chunk_count'] += 1
-                record_for_display = record.copy()
-                record_for_display['chunk_sequence'] = record['metadata'].get('chunk_sequence', i)
-                doc_summary[doc_id]['chunks'].append(record_for_display)
-
-        # แสดงตารางภาพรวม
-        st.subheader("ภาพรวมเอกสารที่พบใน `metadata.json`")
+    faiss_store = load_faiss_store(config.get('vector_store', {}))
+    if faiss_store:
+        documents = {doc_id: (fields, chunk_ids) for doc_id, fields, chunk_ids in faiss_store.iter_documents()}
+        st.caption(f"Index: {faiss_store.describe()} (memory-mapped, read-only)")
+        # แสดงตารางภาพรวม (ใช้เฉพาะข้อมูลระดับเอกสาร ไม่ต้องอ่านทุก chunk)
+        st.subheader("ภาพรวมเอกสารที่พบใน metadata sidecar")
         summary_df = pd.DataFrame([
-            {"id": doc_id, "title": data['title'], "chunk_count": data['chunk_count']}
-            for doc_id, data in doc_summary.items()
-        ]).sort_values(by="id")
+            {"id": doc_id, "title": fields.get('document_title', 'Title not found'), "chunk_count": len(chunk_ids)}
+            for doc_id, (fields, chunk_ids) in documents.items()
+        ], columns=["id", "title", "chunk_count"]).sort_values(by="id")
         st.dataframe(summary_df, use_container_width=True, hide_index=True)
 
         # ส่วนสำหรับดู Chunks
@@ -149,10 +136,16 @@ elif store_type == 'FAISS':
         )
 
         if st.button("🔬 แสดง Chunks", use_container_width=True):
-            if item_id_to_view in doc_summary:
-                doc_data = doc_summary[item_id_to_view]
+            if item_id_to_view in documents:
+                # อ่านเฉพาะ chunk ของเอกสารนี้จาก sidecar
+                fields, chunk_ids = documents[item_id_to_view]
+                chunks = []
+                for i, record in enumerate(faiss_store.fetch_chunks(chunk_ids).values()):
+                    record['chunk_sequence'] = record['metadata'].get('chunk_sequence', i)
+                    chunks.append(record)
                 # เรียงลำดับ chunk ตาม sequence ก่อนแสดงผล
-                sorted_chunks = sorted(doc_data['chunks'], key=lambda x: x['chunk_sequence'])
-                display_chunks(doc_data['title'], sorted_chunks)
+                sorted_chunks = sorted(chunks, key=lambda x: x['chunk_sequence'])
+                title = fields.get('document_title', 'Title not found')
+                display_chunks(title, sorted_chunks)
             else:
                 st.error(f"ไม่พบเอกสารสำหรับ ID: {item_id_to_view} ในไฟล์ metadata")
\ No newline at end of file
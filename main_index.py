@@ -4,160 +4,319 @@ import logging
 import time
 import uuid
 from datetime import datetime, timezone
-from sentence_transformers import SentenceTransformer
 
 from pipeline_lib.config_loader import load_config
-from pipeline_lib.db_handler import get_db_connection
+from pipeline_lib.db_handler import get_db_connection, ensure_ingest_schema
+from pipeline_lib.embedding import EmbeddingProvider, create_embedding_backend, EmbeddingBatcher, EmbeddingCache
+from pipeline_lib.metrics import METRICS, timed, count
 from pipeline_lib.utils import setup_logging
 from pipeline_lib.parsers import structured_parser, recursive_parser, cinematic_parser
-from pipeline_lib.storage import STORAGE_REGISTRY
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding # <-- เพิ่ม import นี้
+from pipeline_lib.storage import create_storage_adapter, pgvector_maintenance, LexicalIndex, build_lexical_index
+
+# เอกสารที่ต้อง index: เนื้อหาถูกแก้ไข (needs_reindex) หรือยังไม่มี chunk ใน knowledge_chunks
+# และไม่อยู่ในรายการที่ข้ามได้ (เช่น มีอยู่ใน Faiss แล้ว)
+ITEMS_TO_INDEX_WHERE = """
+    WHERE ki.status = 'active' AND (
+        ki.needs_reindex
+        OR (NOT EXISTS (SELECT 1 FROM knowledge_chunks kc WHERE kc.knowledge_item_id = ki.id) AND ki.id <> ALL(%s))
+    )
+"""
+
+ITEMS_TO_INDEX_SQL = f"""
+    SELECT ki.id, ki.full_content, ki.metadata, ki.needs_reindex
+    FROM knowledge_items ki
+    {ITEMS_TO_INDEX_WHERE}
+    ORDER BY ki.id;
+"""
+
+COUNT_ITEMS_TO_INDEX_SQL = f"""
+    SELECT count(*), count(*) FILTER (WHERE ki.needs_reindex)
+    FROM knowledge_items ki
+    {ITEMS_TO_INDEX_WHERE};
+"""
+
+CLEAR_REINDEX_SQL = "UPDATE knowledge_items SET needs_reindex = false WHERE id = ANY(%s);"
+
+def load_strategy_settings(config) -> dict:
+    """The chunking strategy and parser settings from the 'chunking' and 'parser_settings' config sections."""
+    chunk_config = config.get('chunking', {})
+    parser_config = config.get('parser_settings', {})
+    return {
+        'strategy': chunk_config.get('strategy', 'RECURSIVE'),
+        'chunk_size': chunk_config.get('size', 1000),
+        'chunk_overlap': chunk_config.get('overlap', 200),
+        'chunk_unit': chunk_config.get('unit', 'characters'),
+        # Load parser-specific settings
+        'default_headers': parser_config.get('default_headers', []),
+        'cinematic_threshold': parser_config.get('cinematic_parser', {}).get('breakpoint_percentile_threshold', 95),
+        'cinematic_engine': parser_config.get('cinematic_parser', {}).get('engine', 'NATIVE'),
+        'cinematic_chunk_embedding': parser_config.get('cinematic_parser', {}).get('chunk_embedding', 'POOLED'),
+    }
+
+def recursive_chunks(full_content, base_metadata, strategy_settings, batcher):
+    """
+    RECURSIVE chunks sized in characters, or in tokens of the embedding tokenizer
+    (chunking.unit: 'tokens'), in which case no chunk is longer than the model window.
+    """
+    if strategy_settings['chunk_unit'] == 'tokens':
+        return recursive_parser.parse_document(
+            full_content, base_metadata, strategy_settings['chunk_size'], strategy_settings['chunk_overlap'],
+            count_tokens=batcher.count_tokens, max_tokens=batcher.max_text_tokens()
+        )
+    return recursive_parser.parse_document(full_content, base_metadata, strategy_settings['chunk_size'], strategy_settings['chunk_overlap'])
+
+@timed("index.chunk")
+def chunk_item(item_id, full_content, parent_metadata, strategy_settings, embedding_provider, batcher):
+    """
+    Splits one knowledge item into (chunk_text, metadata) pairs with the configured strategy.
+    Returns (chunks, chunk_embeddings); chunk_embeddings is None unless the strategy
+    already produced the vectors (CINEMATIC with pooled sentence embeddings).
+    """
+    strategy = strategy_settings['strategy']
+    base_metadata = parent_metadata.copy()
+    base_metadata['document_id'] = item_id
+    base_metadata['chunking_strategy'] = strategy
+
+    if strategy == 'STRUCTURE_AWARE':
+        logging.info(f"  > Using 'STRUCTURE_AWARE' strategy for item ID {item_id}.")
+        headers_for_this_item = parent_metadata.get("custom_headers", strategy_settings['default_headers'])
+        if "custom_headers" in parent_metadata:
+            logging.info("    > Found and using custom headers from metadata.")
+        return structured_parser.parse_document(full_content, base_metadata, headers_for_this_item), None
+
+    elif strategy == 'RECURSIVE':
+        logging.info(f"  > Using 'RECURSIVE' strategy for item ID {item_id}.")
+        return recursive_chunks(full_content, base_metadata, strategy_settings, batcher), None
+
+    elif strategy == 'CINEMATIC':
+        logging.info(f"  > Using 'CINEMATIC' strategy for item ID {item_id}.")
+        if strategy_settings['cinematic_engine'] == 'LLAMA_INDEX':
+            # --- ใช้ model ตัวเดียวกับที่สร้าง embedding (สร้าง Adapter ครั้งแรกที่เรียกใช้เท่านั้น) ---
+            llama_embed_adapter = embedding_provider.as_llama_embedding()
+            return cinematic_parser.parse_document_llama_index(full_content, base_metadata, llama_embed_adapter, strategy_settings['cinematic_threshold']), None
+        # ประโยคถูก embed ผ่าน batcher/backend เดียวกับ chunk และนำ vector กลับมาใช้ได้
+        return cinematic_parser.parse_document(
+            full_content, base_metadata, batcher.embed_texts, strategy_settings['cinematic_threshold'],
+            pool_embeddings=strategy_settings['cinematic_chunk_embedding'] == 'POOLED'
+        )
+
+    logging.warning(f"  > Unknown strategy '{strategy}'. Defaulting to RECURSIVE.")
+    return recursive_chunks(full_content, base_metadata, strategy_settings, batcher), None
+
+def index_batch(items, strategy_settings, batcher, embedding_provider, storage_adapter) -> int:
+    """
+    Chunks, embeds and stores one bounded batch of items; returns the number of chunks stored.
+    Items flagged needs_reindex have their existing chunks replaced by the new ones.
+    """
+    # 1. Chunk every item of the batch first
+    chunked_items = []
+    embeddings = {}
+    reindexed_ids = [item_id for item_id, _, _, needs_reindex in items if needs_reindex]
+    for item_id, full_content, parent_metadata, _ in items:
+        if not full_content or not full_content.strip():
+            logging.warning(f"Skipping item ID {item_id} due to empty content.")
+            continue
+
+        chunks, chunk_embeddings = chunk_item(item_id, full_content, parent_metadata, strategy_settings, embedding_provider, batcher)
+        if not chunks:
+            logging.warning(f"  > No chunks were created for item ID {item_id}.")
+            continue
+        logging.info(f"  > Created {len(chunks)} chunks for item ID {item_id}.")
+        chunked_items.append((item_id, chunks))
+        if chunk_embeddings is not None:
+            embeddings.update({(item_id, i + 1): vector for i, vector in enumerate(chunk_embeddings)})
+
+    # 2. Generate Embeddings across documents, in length-sorted batches (skipping chunks that already have one)
+    embeddings.update(batcher.embed([
+        ((item_id, i + 1), chunk_text)
+        for item_id, chunks in chunked_items
+        for i, (chunk_text, meta) in enumerate(chunks)
+        if (item_id, i + 1) not in embeddings
+    ]))
+
+    chunks_to_store = []
+    for item_id, chunks in chunked_items:
+        for i, (chunk_text, chunk_meta) in enumerate(chunks):
+            chunk_meta['chunk_id'] = str(uuid.uuid4())
+            chunk_meta['chunk_sequence'] = i + 1
+            chunk_meta['indexing_timestamp'] = datetime.now(timezone.utc).isoformat()
+            chunk_meta['schema_version'] = "2.2" # Version with performance fix
+            
+            # ส่ง vector เป็น numpy โดยตรง (store แปลงเองทั้ง batch ไม่ต้อง .tolist())
+            embedding_vector = embeddings[(item_id, i + 1)]
+            
+            chunks_to_store.append(
+                (item_id, chunk_text, i + 1, embedding_vector, chunk_meta)
+            )
+
+    # ส่งต่อให้ store ทันทีเมื่อจบ batch เพื่อให้หน่วยความจำคงที่ (บันทึกลงดิสก์เป็นระยะใน main)
+    if reindexed_ids:
+        # ลบ chunk/vector เดิมของเอกสารที่ถูกแก้ไข (รวมถึงเอกสารที่ตอนนี้ไม่มี chunk แล้ว) แล้วใส่ของใหม่แทน
+        with timed("store.add"):
+            storage_adapter.replace_documents(chunks_to_store, document_ids=reindexed_ids)
+    elif chunks_to_store:
+        with timed("store.add"):
+            storage_adapter.add(chunks_to_store)
+    count("index.items", len(items))
+    count("index.chunks", len(chunks_to_store))
+    return len(chunks_to_store)
+
+def clear_reindex_flags(conn, item_ids):
+    """Clears needs_reindex for items whose new chunks are durably stored."""
+    if not item_ids:
+        return
+    with conn.cursor() as cur:
+        cur.execute(CLEAR_REINDEX_SQL, (item_ids,))
+    conn.commit()
 
 def main():
     """
     Main function to run the indexing pipeline.
-    This script fetches items from 'knowledge_items' that have not yet been chunked,
-    processes them according to the chunking strategy defined in config.yaml,
-    creates vector embeddings, and stores the final chunks in the configured vector store.
+    This script streams items from 'knowledge_items' that have not yet been chunked
+    through a server-side cursor, processes them in bounded batches according to the
+    chunking strategy defined in config.yaml, creates vector embeddings, and hands
+    each batch to the configured vector store as soon as it is done. The store is
+    persisted every few batches or seconds (a Faiss persist rewrites its whole index
+    file) and once at the end.
     """
     # 1. Setup and Configuration Loading
     setup_logging()
     config = load_config()
     if not config: return
+    METRICS.start_run("index", config.get('metrics', {}))
 
     # Load chunking settings and the global strategy
-    chunk_config = config.get('chunking', {})
-    CHUNK_SIZE = chunk_config.get('size', 1000)
-    CHUNK_OVERLAP = chunk_config.get('overlap', 200)
-    GLOBAL_STRATEGY = chunk_config.get('strategy', 'RECURSIVE')
+    strategy_settings = load_strategy_settings(config)
 
-    # Load parser-specific settings
-    parser_config = config.get('parser_settings', {})
-    DEFAULT_HEADERS = parser_config.get('default_headers', [])
-    CINEMATIC_THRESHOLD = parser_config.get('cinematic_parser', {}).get('breakpoint_percentile_threshold', 95)
+    # Load streaming settings
+    indexing_config = config.get('indexing', {})
+    FETCH_SIZE = indexing_config.get('fetch_size', 50)
+    PERSIST_EVERY = indexing_config.get('persist_every', 20)
+    PERSIST_INTERVAL = indexing_config.get('persist_interval_s', 300)
     
-    logging.info(f"Global chunking strategy set to: '{GLOBAL_STRATEGY}'")
+    logging.info(f"Global chunking strategy set to: '{strategy_settings['strategy']}'")
 
-    # 2. Load Embedding Model
-    logging.info(f"Loading embedding model: {config['embedding']['model_name']}")
-    model = SentenceTransformer(
-        config['embedding']['model_name'], 
-        device=config['embedding']['device']
-    )
-    logging.info("Model loaded successfully.")
+    # 2. Load Embedding Model (in this process, or once per worker for the PROCESS_POOL backend)
+    # ทุกส่วนในโปรเซสนี้ใช้ model ตัวเดียวกันผ่าน provider
+    embedding_provider = EmbeddingProvider(config['embedding'])
+    embedding_backend = create_embedding_backend(config['embedding'], embedding_provider)
 
-    # --- สร้าง LlamaIndex Adapter เพียงครั้งเดียว ---
-    logging.info("Creating LlamaIndex embedding adapter...")
-    llama_embed_adapter = HuggingFaceEmbedding(model_name=config['embedding']['model_name'])
-    logging.info("Adapter created successfully.")
+    # Cache ของ embedding (ข้อความเดิม + model เดิม = ไม่ต้อง embed ใหม่)
+    cache_config = config['embedding'].get('cache', {})
+    embedding_cache = None
+    if cache_config.get('enabled', False):
+        embedding_cache = EmbeddingCache(
+            cache_config.get('path', 'storage/embedding_cache.sqlite'),
+            config['embedding']['model_name'],
+            max_bytes=cache_config.get('max_size_mb', 2048) * 2**20
+        )
+
+    batcher = EmbeddingBatcher(
+        embedding_backend,
+        token_budget=config['embedding'].get('token_budget', 16384),
+        max_batch_size=config['embedding'].get('max_batch_size', 128),
+        cache=embedding_cache
+    )
 
     # 3. Initialize Storage Adapter
     store_config = config.get('vector_store', {})
     store_type = store_config.get('type', 'PGVECTOR')
-    storage_adapter = None
     conn = get_db_connection(config['database'])
     if not conn: return
     
-    logging.info(f"Initializing vector store adapter: {store_type}")
-    storage_class = STORAGE_REGISTRY.get(store_type)
-    
-    if store_type == 'PGVECTOR':
-        storage_adapter = storage_class(conn)
-    elif store_type == 'FAISS':
-        storage_adapter = storage_class(config['vector_store']['faiss'])
-    else:
-        logging.error(f"Unknown vector store type: {store_type}")
-        if conn: conn.close()
+    storage_adapter = create_storage_adapter(store_config, conn)
+    if not storage_adapter:
+        conn.close()
         return
 
     try:
+        ensure_ingest_schema(conn)
+
+        # Faiss ไม่ได้เขียนลง knowledge_chunks จึงต้องตัดเอกสารที่อยู่ใน index แล้วออกเอง
+        skip_ids = sorted(storage_adapter.indexed_document_ids()) if store_type == 'FAISS' else []
+
         with conn.cursor() as cur:
-            # 4. Fetch Items to Process from PostgreSQL
-            cur.execute("""
-                SELECT ki.id, ki.full_content, ki.metadata
-                FROM knowledge_items ki
-                LEFT JOIN knowledge_chunks kc ON ki.id = kc.knowledge_item_id
-                WHERE ki.status = 'active' AND kc.id IS NULL;
-            """)
-            items_to_process = cur.fetchall()
-
-            if not items_to_process:
-                logging.info("No new items to index. System is up-to-date.")
-                return
-
-            logging.info(f"Found {len(items_to_process)} items to process.")
-
-            all_chunks_to_store = []
-
-            # 5. Process Each Item
-            for item_id, full_content, parent_metadata in items_to_process:
-                if not full_content or not full_content.strip():
-                    logging.warning(f"Skipping item ID {item_id} due to empty content.")
-                    continue
-                
-                base_metadata = parent_metadata.copy()
-                base_metadata['document_id'] = item_id
-                base_metadata['chunking_strategy'] = GLOBAL_STRATEGY
-                
-                chunks = []
-                
-                if GLOBAL_STRATEGY == 'STRUCTURE_AWARE':
-                    logging.info(f"  > Using 'STRUCTURE_AWARE' strategy for item ID {item_id}.")
-                    headers_for_this_item = parent_metadata.get("custom_headers", DEFAULT_HEADERS)
-                    if "custom_headers" in parent_metadata:
-                        logging.info("    > Found and using custom headers from metadata.")
-                    chunks = structured_parser.parse_document(full_content, base_metadata, headers_for_this_item)
-
-                elif GLOBAL_STRATEGY == 'RECURSIVE':
-                    logging.info(f"  > Using 'RECURSIVE' strategy for item ID {item_id}.")
-                    chunks = recursive_parser.parse_document(full_content, base_metadata, CHUNK_SIZE, CHUNK_OVERLAP)
-                
-                elif GLOBAL_STRATEGY == 'CINEMATIC':
-                    logging.info(f"  > Using 'CINEMATIC' strategy for item ID {item_id}.")
-                    # --- ส่ง Adapter ที่สร้างไว้แล้วเข้าไป ---
-                    chunks = cinematic_parser.parse_document(full_content, base_metadata, llama_embed_adapter, CINEMATIC_THRESHOLD)
-
-                else:
-                    logging.warning(f"  > Unknown strategy '{GLOBAL_STRATEGY}'. Defaulting to RECURSIVE.")
-                    chunks = recursive_parser.parse_document(full_content, base_metadata, CHUNK_SIZE, CHUNK_OVERLAP)
-
-                if not chunks:
-                    logging.warning(f"  > No chunks were created for item ID {item_id}.")
-                    continue
-
-                # 6. Generate Embeddings in Batches
-                texts_to_embed = [chunk_text for chunk_text, meta in chunks]
-                logging.info(f"  > Created {len(chunks)} chunks. Generating embeddings...")
-                
-                embeddings = model.encode(texts_to_embed, normalize_embeddings=True)
-                
-                # 7. Accumulate chunks to be stored
-                for i, (chunk_text, chunk_meta) in enumerate(chunks):
-                    chunk_meta['chunk_id'] = str(uuid.uuid4())
-                    chunk_meta['chunk_sequence'] = i + 1
-                    chunk_meta['indexing_timestamp'] = datetime.now(timezone.utc).isoformat()
-                    chunk_meta['schema_version'] = "2.2" # Version with performance fix
-                    
-                    embedding_vector = embeddings[i].tolist()
-                    
-                    all_chunks_to_store.append(
-                        (item_id, chunk_text, i + 1, embedding_vector, chunk_meta)
-                    )
-
-        # 8. Save all accumulated chunks at once using the adapter
-        if all_chunks_to_store:
-            storage_adapter.add(all_chunks_to_store)
+            cur.execute(COUNT_ITEMS_TO_INDEX_SQL, (skip_ids,))
+            total_items, total_reindex = cur.fetchone()
+        lexical_config = config.get('search', {}).get('lexical', {})
+        if not total_items:
+            logging.info("No new items to index. System is up-to-date.")
+            if lexical_config.get('enabled') and not LexicalIndex.load(lexical_config['path']):
+                build_lexical_index(storage_adapter, lexical_config)
+            return
+        logging.info(f"Found {total_items} items to process ({total_reindex} changed since last indexing). "
+                     f"Streaming in batches of {FETCH_SIZE}.")
+
+        # โหลดจำนวนมาก: ลบ vector index ก่อน แล้วสร้างใหม่ครั้งเดียวหลังโหลดเสร็จ (เร็วกว่าอัปเดต index ทีละแถว)
+        pg_config = store_config.get('pgvector', {})
+        pg_index_config = pg_config.get('index', {})
+        drop_threshold = pg_index_config.get('drop_before_bulk_load')
+        if store_type == 'PGVECTOR' and drop_threshold and total_items >= drop_threshold:
+            logging.info(f"{total_items} items to load (>= {drop_threshold}); dropping the vector index until the load is done.")
+            pgvector_maintenance.drop_vector_index(conn)
+
+        # 4. Stream Items from PostgreSQL through a server-side cursor
+        # withhold=True ทำให้ cursor ยังอยู่หลัง commit ของแต่ละ batch
+        items_processed = 0
+        chunks_stored = 0
+        # needs_reindex ถูกล้างหลังจาก persist ที่บันทึกลงดิสก์จริงเท่านั้น (ถ้าล่มก่อนหน้านั้น รอบถัดไปจะทำใหม่)
+        unpersisted_reindex_ids = []
+        batches_since_persist, last_persist = 0, time.monotonic()
+        with conn.cursor(name='index_items_cursor', withhold=True) as cur:
+            cur.execute(ITEMS_TO_INDEX_SQL, (skip_ids,))
+            while True:
+                with timed("db.fetch_items"):
+                    items = cur.fetchmany(FETCH_SIZE)
+                if not items:
+                    break
+
+                # 5. Chunk, embed and store this batch
+                chunks_stored += index_batch(items, strategy_settings, batcher, embedding_provider, storage_adapter)
+                unpersisted_reindex_ids += [item_id for item_id, _, _, needs_reindex in items if needs_reindex]
+                items_processed += len(items)
+                batches_since_persist += 1
+                logging.info(f"Progress: {items_processed}/{total_items} items, {chunks_stored} chunks stored.")
+
+                if batches_since_persist >= PERSIST_EVERY or time.monotonic() - last_persist >= PERSIST_INTERVAL:
+                    with timed("store.persist"):
+                        persisted = storage_adapter.persist(final=False)
+                    batches_since_persist, last_persist = 0, time.monotonic()
+                    if persisted:
+                        clear_reindex_flags(conn, unpersisted_reindex_ids)
+                        unpersisted_reindex_ids = []
+
+        # 6. Final flush (e.g. trains a Faiss IVF index that was still collecting samples)
+        with timed("store.persist_final"):
             storage_adapter.persist()
-        else:
+        clear_reindex_flags(conn, unpersisted_reindex_ids)
+        if store_type == 'PGVECTOR':
+            with timed("store.ensure_indexes"):
+                pgvector_maintenance.ensure_indexes(conn, pg_index_config, pg_config.get('precision', 'FLOAT32'),
+                                                    pg_config.get('sharding', {}).get('shard_by'))
+                pgvector_maintenance.analyze_chunks(conn)
+        # 7. Lexical (BM25) index ของ hybrid search สร้างใหม่จาก chunk ทั้งหมดใน store
+        # (ข้ามได้ถ้า store ไม่เปลี่ยน: ไม่มี chunk ใหม่และไม่มีเอกสารที่ถูกแทนที่/ลบ chunk เดิม)
+        store_changed = chunks_stored or total_reindex
+        if lexical_config.get('enabled') and (store_changed or not LexicalIndex.load(lexical_config['path'])):
+            with timed("index.lexical"):
+                build_lexical_index(storage_adapter, lexical_config)
+        batcher.log_stats()
+        if embedding_cache:
+            embedding_cache.log_stats()
+        if not chunks_stored:
             logging.info("No new chunks were created to be stored.")
 
     except Exception as e:
         logging.error(f"An unexpected error occurred during indexing: {e}", exc_info=True)
         if store_type == 'PGVECTOR' and conn: conn.rollback()
     finally:
+        embedding_backend.close()
+        if embedding_cache:
+            embedding_cache.close()
         if conn:
             conn.close()
             logging.info("Database connection closed.")
+        METRICS.write_report()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
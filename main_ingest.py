@@ -1,127 +1,176 @@
 # main_ingest.py
 import os
-import json
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-import docx
 
 from pipeline_lib.config_loader import load_config
-from pipeline_lib.db_handler import get_db_connection
+from pipeline_lib.db_handler import get_db_connection, ensure_ingest_schema, load_known_sources
+from pipeline_lib.discovery import SidecarResolver, discover_source_files
+from pipeline_lib.extraction import stream_extractions
+from pipeline_lib.ingest_writer import IngestCheckpoint, BatchedItemWriter
 from pipeline_lib.llm_handler import MetadataExtractor
+from pipeline_lib.metrics import METRICS, timed, count
 from pipeline_lib.utils import setup_logging
-from pipeline_lib.metadata_generator import METADATA_GENERATOR_REGISTRY
+from pipeline_lib.metadata_generator import generate_metadata_fields
 
-def find_instruction_file(file_path, base_path):
+def discover_jobs(base_path, known_sources, ingest_config):
     """
-    Busca el archivo de instrucciones de metadatos correcto utilizando un enfoque jerárquico.
-    Ahora maneja tanto .txt como .docx.
+    Recorre la carpeta raíz y genera un trabajo por cada archivo que debe ingerirse.
+    Cada trabajo tiene una acción:
+      - 'insert': archivo nuevo (con instrucciones válidas y contenido leído).
+      - 'update': archivo conocido cuyo contenido cambió; se regeneran sus metadatos y se re-indexa.
+      - 'touch':  archivo conocido con tamaño o fecha distinta pero el mismo hash; solo se actualiza el manifiesto.
+    Los archivos conocidos con el mismo tamaño y fecha de modificación se omiten sin abrirlos.
+
+    El descubrimiento (os.scandir + instrucciones en caché por carpeta) y la extracción
+    de texto (pool de procesos) avanzan en paralelo con las etapas siguientes a través
+    de una cola acotada.
     """
-    # 1. Cambiar la búsqueda de .meta.json para que sea dinámica
-    # Separa el nombre del archivo de su extensión y luego añade .meta.json
-    base_name = os.path.splitext(file_path)[0]
-    specific_meta_path = base_name + ".meta.json"
-    
-    if os.path.exists(specific_meta_path):
-        return specific_meta_path
-
-    # (El resto de esta función es exactamente el mismo)
-    current_dir = os.path.dirname(file_path)
-    norm_base_path = os.path.normpath(base_path)
-    while True:
-        folder_meta_path = os.path.join(current_dir, "_folder.meta.json")
-        if os.path.exists(folder_meta_path):
-            return folder_meta_path
-        norm_current_dir = os.path.normpath(current_dir)
-        if norm_current_dir == norm_base_path:
-            break
-        parent_dir = os.path.dirname(current_dir)
-        if parent_dir == current_dir:
-            break
-        current_dir = parent_dir
-    return None
-
-def process_source_folder(conn, config, llm_extractor):
-    base_path = config['paths']['docs_root']
-    logging.info(f"--- Iniciando el procesamiento jerárquico bajo demanda en la carpeta raíz: {base_path} ---")
-    items_added = 0
-
-    for root, _, files in os.walk(base_path):
-        for filename in files:
-            # --- 2. Cambiar para buscar archivos .txt y .docx ---
-            if not filename.endswith((".txt", ".docx")):
+    resolver = SidecarResolver()
+    skipped = {"known": 0}
+
+    def extraction_tasks():
+        for source in discover_source_files(base_path, resolver):
+            known = known_sources.get(source.source_path)
+            if known and (known.source_size, known.source_mtime) == (source.size, source.mtime):
+                logging.debug(f"Omitiendo '{source.filename}': El elemento ya existe en la base de datos.")
+                skipped["known"] += 1
                 continue
 
-            file_full_path = os.path.join(root, filename)
-            instruction_file_path = find_instruction_file(file_full_path, base_path)
-
-            if not instruction_file_path:
-                logging.debug(f"Omitiendo '{filename}': No se encontró un archivo de instrucciones en la jerarquía.")
+            sidecar_data = resolver.load(source.sidecar_path)
+            if sidecar_data is None:
                 continue
-            
-            try:
-                with open(instruction_file_path, 'r', encoding='utf-8') as f:
-                    sidecar_data = json.load(f)
-                active_fields = sidecar_data.get("active_fields")
-                if not active_fields or not isinstance(active_fields, list):
-                    logging.warning(f"Omitiendo '{filename}': El archivo de instrucciones '{instruction_file_path}' no contiene una lista válida de 'active_fields'.")
-                    continue
-            except Exception as e:
-                logging.error(f"No se pudo leer o analizar el archivo de instrucciones '{instruction_file_path}' para '{filename}': {e}")
+            active_fields = sidecar_data.get("active_fields")
+            if not active_fields or not isinstance(active_fields, list):
+                logging.warning(f"Omitiendo '{source.filename}': El archivo de instrucciones '{source.sidecar_path}' no contiene una lista válida de 'active_fields'.")
                 continue
+            # Tamaño o fecha distintos: el worker compara el hash y no extrae el texto si es el mismo
+            yield (source, known, sidecar_data), source.path, source.filename, known.content_hash if known else None
+
+    results = stream_extractions(
+        extraction_tasks(),
+        num_workers=ingest_config.get('extraction_workers', 4),
+        queue_size=ingest_config.get('queue_size', 64)
+    )
+    for (source, known, sidecar_data), result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Fallo al procesar '{source.filename}': {result}")
+            continue
+        content_hash, full_content = result
+
+        # Filas antiguas sin hash se toman como iguales: solo se completa su manifiesto
+        if known and (full_content is None or known.content_hash is None):
+            yield {
+                "action": "touch",
+                "item_id": known.item_id,
+                "filename": source.filename,
+                "source_path": source.source_path,
+                "source_size": source.size,
+                "source_mtime": source.mtime,
+                "content_hash": content_hash,
+            }
+            continue
+
+        logging.info(f"Procesando '{source.filename}' usando las instrucciones de '{os.path.basename(source.sidecar_path)}'")
+        yield {
+            "action": "update" if known else "insert",
+            "item_id": known.item_id if known else None,
+            "filename": source.filename,
+            "file_full_path": source.path,
+            "sidecar_data": sidecar_data,
+            "active_fields": sidecar_data["active_fields"],
+            "content": full_content,
+            "source_path": source.source_path,
+            "source_size": source.size,
+            "source_mtime": source.mtime,
+            "content_hash": content_hash,
+        }
+    count("ingest.skipped_unchanged", skipped["known"])
+    logging.info(f"Se omitieron {skipped['known']} archivos sin cambios que ya existen en la base de datos.")
+
+@timed("ingest.metadata")
+def build_metadata(job, llm_extractor, base_path):
+    """Genera los metadatos finales de un trabajo (aquí ocurren las llamadas al LLM). Devuelve None si falla."""
+    if job["action"] == "touch":
+        return {}
+    try:
+        final_metadata = generate_metadata_fields(
+            job["active_fields"],
+            llm_extractor=llm_extractor,
+            content=job["content"],
+            filename=job["filename"],
+            file_full_path=job["file_full_path"],
+            base_path=base_path,
+            sidecar_data=job["sidecar_data"]
+        )
+    except Exception as e:
+        logging.error(f"Fallo al generar metadatos para '{job['filename']}': {e}", exc_info=True)
+        return None
+
+    final_metadata["source_type"] = "RAG"
+    final_metadata["ingest_timestamp"] = datetime.now(timezone.utc).isoformat()
+    final_metadata["chunking_strategy"] = job["sidecar_data"].get("chunking_strategy", "STRUCTURE_AWARE")
+    return final_metadata
+
+def build_metadata_concurrently(jobs, build, max_in_flight):
+    """
+    Ejecuta build(job) para muchos trabajos a la vez en un pool de threads y
+    devuelve (job, resultado) en el mismo orden en que llegaron los trabajos,
+    de modo que las inserciones en la base de datos conservan el orden secuencial.
+    Como máximo 2 x max_in_flight trabajos (con su contenido) esperan en memoria.
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="llm") as pool:
+        window = deque()
+        for job in jobs:
+            window.append((job, pool.submit(build, job)))
+            if len(window) >= 2 * max_in_flight:
+                head_job, future = window.popleft()
+                yield head_job, future.result()
+        while window:
+            head_job, future = window.popleft()
+            yield head_job, future.result()
 
-            logging.info(f"Procesando '{filename}' usando las instrucciones de '{os.path.basename(instruction_file_path)}'")
-            
-            try:
-                # --- 3. Añadir una condición para elegir el método de lectura de archivos según la extensión ---
-                full_content = ""
-                if filename.endswith(".txt"):
-                    with open(file_full_path, 'r', encoding='utf-8') as f:
-                        full_content = f.read()
-                elif filename.endswith(".docx"):
-                    document = docx.Document(file_full_path)
-                    full_content = "\n".join([p.text for p in document.paragraphs])
-
-                source_path_for_check = os.path.relpath(file_full_path, base_path).replace(os.path.sep, '/')
-                with conn.cursor() as cur:
-                    cur.execute("SELECT id FROM knowledge_items WHERE (metadata->>'source_path') = %s", (source_path_for_check,))
-                    if cur.fetchone():
-                        logging.info(f"Omitiendo '{filename}': El elemento ya existe en la base de datos.")
-                        continue
-
-                final_metadata = {}
-                for field_name in active_fields:
-                    generator_func = METADATA_GENERATOR_REGISTRY.get(field_name)
-                    if generator_func:
-                        func_args = {
-                            "llm_extractor": llm_extractor,
-                            "content": full_content,
-                            "filename": filename,
-                            "file_full_path": file_full_path,
-                            "base_path": base_path,
-                            "sidecar_data": sidecar_data
-                        }
-                        value = generator_func(**func_args)
-                        if value is not None:
-                            final_metadata[field_name] = value
-                
-                final_metadata["source_type"] = "RAG"
-                final_metadata["ingest_timestamp"] = datetime.now(timezone.utc).isoformat()
-                final_metadata["chunking_strategy"] = sidecar_data.get("chunking_strategy", "STRUCTURE_AWARE")
-                
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """INSERT INTO knowledge_items (source_type, status, title, full_content, metadata) VALUES (%s, %s, %s, %s, %s)""",
-                        ('RAG', 'active', final_metadata.get('document_title', filename), full_content, json.dumps(final_metadata, ensure_ascii=False))
-                    )
-                items_added += 1
-                logging.info(f"Se ha ingerido '{filename}' exitosamente.")
-
-            except Exception as e:
-                logging.error(f"Fallo al procesar '{filename}': {e}", exc_info=True)
-                conn.rollback()
-
-    conn.commit()
-    logging.info(f"--- Procesamiento de archivos finalizado. Se añadieron {items_added} nuevos elementos. ---")
+def process_source_folder(conn, config, llm_extractor):
+    base_path = config['paths']['docs_root']
+    ingest_config = config.get('ingest', {})
+    mode = ingest_config.get('mode', 'SEQUENTIAL')
+    logging.info(f"--- Iniciando el procesamiento jerárquico bajo demanda en la carpeta raíz: {base_path} (modo {mode}) ---")
+
+    # Una sola consulta al inicio en lugar de un SELECT por archivo
+    ensure_ingest_schema(conn)
+    known_sources = load_known_sources(conn)
+    jobs = discover_jobs(base_path, known_sources, ingest_config)
+    build = lambda job: build_metadata(job, llm_extractor, base_path)
+    if mode == 'CONCURRENT':
+        # El número real de llamadas simultáneas lo regula el limitador adaptativo del extractor
+        results = build_metadata_concurrently(jobs, build, llm_extractor.limiter.max_limit)
+    else:
+        results = ((job, build(job)) for job in jobs)
+
+    # Se confirma cada N elementos o T segundos; un reinicio continúa desde el último commit
+    checkpoint = IngestCheckpoint(ingest_config.get('checkpoint_path', 'storage/ingest_checkpoint.json'))
+    writer = BatchedItemWriter(
+        conn, checkpoint,
+        batch_size=ingest_config.get('commit_every', 200),
+        commit_interval=ingest_config.get('commit_interval_s', 30)
+    )
+    for job, final_metadata in results:
+        if final_metadata is None:
+            continue
+        writer.add(job, final_metadata)
+        if job["action"] == "insert":
+            logging.info(f"Se ha procesado '{job['filename']}' exitosamente.")
+        elif job["action"] == "update":
+            logging.info(f"Se ha actualizado '{job['filename']}' (contenido modificado, pendiente de re-indexar).")
+    writer.close()
+
+    counts = writer.counts
+    if writer.failed:
+        logging.warning(f"No se pudieron guardar {writer.failed} elementos (ver '{checkpoint.path}').")
+    logging.info(f"--- Procesamiento de archivos finalizado. Se añadieron {counts['insert']} nuevos elementos, "
+                 f"se actualizaron {counts['update']} y se refrescó el manifiesto de {counts['touch']}. ---")
 
 
 def main():
@@ -133,13 +182,16 @@ def main():
     if not conn: return
         
     llm_extractor = MetadataExtractor(config['llm'])
+    METRICS.start_run("ingest", config.get('metrics', {}))
 
     try:
         process_source_folder(conn, config, llm_extractor)
     finally:
+        llm_extractor.close()
         if conn:
             conn.close()
             logging.info("Conexión a la base de datos cerrada.")
+        METRICS.write_report()
 
 
 if __name__ == "__main__":
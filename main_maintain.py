@@ -0,0 +1,59 @@
+# main_maintain.py
+import argparse
+import logging
+
+from pipeline_lib.config_loader import load_config
+from pipeline_lib.db_handler import get_db_connection
+from pipeline_lib.utils import setup_logging
+from pipeline_lib.storage import pgvector_maintenance
+
+def main():
+    """
+    Maintenance of the pgvector indexes on knowledge_chunks.
+    Example: python main_maintain.py create      # metadata indexes + HNSW/IVFFlat index (after bulk loads)
+             python main_maintain.py drop-vector # before a large bulk load
+             python main_maintain.py rebuild     # after changing vector_store.pgvector.index / sharding settings
+             python main_maintain.py set-precision # after changing vector_store.pgvector.precision
+             python main_maintain.py status
+    """
+    parser = argparse.ArgumentParser(description="Create, rebuild or inspect the pgvector indexes.")
+    parser.add_argument("command", choices=["create", "drop-vector", "rebuild", "set-precision", "analyze", "status"])
+    args = parser.parse_args()
+
+    setup_logging()
+    config = load_config()
+    if not config: return
+    pg_config = config.get('vector_store', {}).get('pgvector', {})
+    index_config = pg_config.get('index', {})
+    precision = pg_config.get('precision', 'FLOAT32')
+    shard_by = pg_config.get('sharding', {}).get('shard_by')
+
+    conn = get_db_connection(config['database'])
+    if not conn: return
+
+    try:
+        if args.command == "create":
+            pgvector_maintenance.ensure_indexes(conn, index_config, precision, shard_by)
+            pgvector_maintenance.analyze_chunks(conn)
+        elif args.command == "drop-vector":
+            pgvector_maintenance.drop_vector_index(conn)
+        elif args.command == "rebuild":
+            pgvector_maintenance.rebuild_vector_index(conn, index_config, precision, shard_by)
+            pgvector_maintenance.analyze_chunks(conn)
+        elif args.command == "set-precision":
+            pgvector_maintenance.set_embedding_precision(conn, pg_config)
+            pgvector_maintenance.analyze_chunks(conn)
+        elif args.command == "analyze":
+            pgvector_maintenance.analyze_chunks(conn)
+
+        for name, size, definition in pgvector_maintenance.index_status(conn):
+            print(f"{name:<40} {size:>10}  {definition}")
+    except Exception as e:
+        logging.error(f"Index maintenance failed: {e}", exc_info=True)
+        conn.rollback()
+    finally:
+        conn.close()
+        logging.info("Database connection closed.")
+
+if __name__ == "__main__":
+    main()
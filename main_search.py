@@ -0,0 +1,63 @@
+# main_search.py
+import argparse
+import logging
+
+from pipeline_lib.config_loader import load_config
+from pipeline_lib.db_handler import get_db_connection
+from pipeline_lib.embedding import load_embedding_model
+from pipeline_lib.utils import setup_logging
+from pipeline_lib.storage import create_storage_adapter, SearchEngine, LexicalIndex
+from pipeline_lib.storage.search import SEARCH_MODES
+
+def main():
+    """
+    Command-line front end for the search engine.
+    Example: python main_search.py "ขอใบอนุญาตอาวุธปืน" "ค่าธรรมเนียมบัตรประชาชน" --category กรมการปกครอง -k 5
+    """
+    parser = argparse.ArgumentParser(description="Search the vector store with one or more text queries.")
+    parser.add_argument("queries", nargs="+", help="query texts (encoded together as one batch)")
+    parser.add_argument("-k", type=int, default=None, help="number of chunks to return per query")
+    parser.add_argument("--category", action="append", help="only search documents in this category (repeatable)")
+    parser.add_argument("--document-type", action="append", help="only search documents of this type (repeatable)")
+    parser.add_argument("--source-path", action="append", help="only search these source files (repeatable)")
+    parser.add_argument("--mode", choices=SEARCH_MODES, help="retrieval mode (default: search.hybrid.mode; DENSE without a lexical index)")
+    args = parser.parse_args()
+
+    setup_logging()
+    config = load_config()
+    if not config: return
+
+    search_config = config.get('search', {})
+    top_k = args.k or search_config.get('top_k', 5)
+    filters = {
+        field: values for field, values in (
+            ('category', args.category), ('document_type', args.document_type), ('source_path', args.source_path)
+        ) if values
+    }
+
+    conn = get_db_connection(config['database'])
+    if not conn: return
+
+    try:
+        # อ่านอย่างเดียว: Faiss index ถูก map จากไฟล์แทนการโหลดทั้งก้อน
+        storage_adapter = create_storage_adapter(config.get('vector_store', {}), conn, read_only=True)
+        if not storage_adapter: return
+        model = load_embedding_model(config['embedding'])
+        lexical_config = search_config.get('lexical', {})
+        lexical_index = LexicalIndex.load(lexical_config['path']) if lexical_config.get('enabled') else None
+        engine = SearchEngine(storage_adapter, model, batch_size=search_config.get('batch_size', 32),
+                              lexical_index=lexical_index, hybrid_config=search_config.get('hybrid', {}))
+
+        results = engine.search_texts(args.queries, k=top_k, filters=filters, mode=args.mode)
+        for query, hits in zip(args.queries, results):
+            print(f"\n=== {query} ===")
+            for rank, hit in enumerate(hits, start=1):
+                title = hit['metadata'].get('document_title', '')
+                preview = hit['chunk_text'][:200].replace("\n", " ")
+                print(f"{rank:>2}. [{hit['score']:.4f}] doc {hit['document_id']} - {title}\n    {preview}")
+    finally:
+        conn.close()
+        logging.info("Database connection closed.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# pipeline_lib/concurrency.py
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of in-flight requests with AIMD (additive increase,
+    multiplicative decrease), like TCP congestion control.
+
+    Every successful request that finishes within target_latency raises the
+    limit by 1/limit (about +1 per full window of requests). An error or a
+    request slower than target_latency halves it, at most once per
+    target_latency so that one burst of failures counts as one signal.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, target_latency=30.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, error=False):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if error or (latency is not None and latency > self.target_latency):
+                if now - self._last_decrease >= self.target_latency:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+                    logging.info(f"  > Concurrency limit decreased to {int(self.limit)} "
+                                 f"({'error' if error else f'latency {latency:.1f}s'}).")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Holds one slot for the duration of the block; the block's time and outcome adjust the limit."""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.release(error=True)
+            raise
+        self.release(latency=time.monotonic() - start)
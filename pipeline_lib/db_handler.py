@@ -1,6 +1,9 @@
 # pipeline_lib/db_handler.py
 import psycopg2
 import logging
+from collections import namedtuple
+
+from .metrics import timed
 
 def get_db_connection(db_config):
     """Establishes and returns a database connection."""
@@ -16,4 +19,38 @@ def get_db_connection(db_config):
         return conn
     except psycopg2.OperationalError as e:
         logging.error(f"Database connection failed: {e}")
-        return None
\ No newline at end of file
+        return None
+
+# คอลัมน์จริงพร้อม index สำหรับตรวจว่าไฟล์ถูก ingest ไปแล้วหรือยัง (แทนการสแกน metadata->>'source_path')
+# source_size / source_mtime / content_hash คือ manifest ของไฟล์ต้นฉบับ ใช้ตรวจว่าไฟล์ถูกแก้ไขหรือไม่
+# needs_reindex = เนื้อหาเปลี่ยนแล้ว ต้องสร้าง chunk และ vector ใหม่
+INGEST_SCHEMA_SQL = """
+    ALTER TABLE knowledge_items ADD COLUMN IF NOT EXISTS source_path TEXT;
+    ALTER TABLE knowledge_items ADD COLUMN IF NOT EXISTS source_size BIGINT;
+    ALTER TABLE knowledge_items ADD COLUMN IF NOT EXISTS source_mtime DOUBLE PRECISION;
+    ALTER TABLE knowledge_items ADD COLUMN IF NOT EXISTS content_hash TEXT;
+    ALTER TABLE knowledge_items ADD COLUMN IF NOT EXISTS needs_reindex BOOLEAN NOT NULL DEFAULT false;
+    UPDATE knowledge_items SET source_path = metadata->>'source_path'
+    WHERE source_path IS NULL AND metadata ? 'source_path';
+    CREATE INDEX IF NOT EXISTS idx_knowledge_items_source_path ON knowledge_items (source_path);
+"""
+
+def ensure_ingest_schema(conn):
+    """Adds the source file manifest and needs_reindex columns used by ingest and indexing (idempotent)."""
+    with conn.cursor() as cur:
+        cur.execute(INGEST_SCHEMA_SQL)
+    conn.commit()
+    logging.info("Ingest schema is up to date.")
+
+KnownSource = namedtuple('KnownSource', ['item_id', 'source_size', 'source_mtime', 'content_hash'])
+
+@timed("db.load_known_sources")
+def load_known_sources(conn) -> dict:
+    """Returns {source_path: KnownSource} for every ingested item, in a single query."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT source_path, id, source_size, source_mtime, content_hash FROM knowledge_items WHERE source_path IS NOT NULL"
+        )
+        known = {row[0]: KnownSource(*row[1:]) for row in cur}
+    logging.info(f"Loaded {len(known)} known source files from the database.")
+    return known
@@ -0,0 +1,90 @@
+# pipeline_lib/discovery.py
+import json
+import logging
+import os
+from collections import namedtuple
+
+SOURCE_EXTENSIONS = (".txt", ".docx")
+FOLDER_SIDECAR = "_folder.meta.json"
+
+SourceFile = namedtuple('SourceFile', ['path', 'filename', 'source_path', 'size', 'mtime', 'sidecar_path'])
+
+class SidecarResolver:
+    """
+    Resolves the instruction file (sidecar) of each source file from the
+    directory listings of the walk, without any extra stat calls.
+
+    A file uses its own '<name>.meta.json' when present, otherwise the nearest
+    '_folder.meta.json' from its directory up to the docs root. The inherited
+    folder sidecar is computed once per directory, and every sidecar is read
+    and parsed only once however many files share it.
+    """
+
+    def __init__(self):
+        self._folder_sidecars = {}
+        self._parsed = {}
+
+    def enter_directory(self, dir_path, parent_path, names) -> str:
+        """Records the folder sidecar inherited by dir_path (None if there is none) and returns it."""
+        own = os.path.join(dir_path, FOLDER_SIDECAR) if FOLDER_SIDECAR in names else None
+        inherited = own or self._folder_sidecars.get(parent_path)
+        self._folder_sidecars[dir_path] = inherited
+        return inherited
+
+    def load(self, sidecar_path):
+        """Returns the parsed sidecar, or None if it cannot be read (logged once per sidecar)."""
+        if sidecar_path not in self._parsed:
+            try:
+                with open(sidecar_path, 'r', encoding='utf-8') as f:
+                    self._parsed[sidecar_path] = json.load(f)
+            except Exception as e:
+                logging.error(f"Could not read or parse instruction file '{sidecar_path}': {e}")
+                self._parsed[sidecar_path] = None
+        return self._parsed[sidecar_path]
+
+def discover_source_files(base_path, resolver, extensions=SOURCE_EXTENSIONS):
+    """
+    Walks base_path top-down with os.scandir and yields a SourceFile for every
+    source file that has an instruction file. Size and mtime come from the
+    directory entry, so unchanged files can be skipped without opening them.
+    """
+    stack = [(base_path, None)]
+    while stack:
+        dir_path, parent_path = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logging.error(f"Could not list directory '{dir_path}': {e}")
+            continue
+
+        names = {entry.name for entry in entries}
+        folder_sidecar = resolver.enter_directory(dir_path, parent_path, names)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            if not entry.name.endswith(extensions) or not entry.is_file():
+                continue
+
+            own_sidecar = os.path.splitext(entry.name)[0] + ".meta.json"
+            sidecar_path = os.path.join(dir_path, own_sidecar) if own_sidecar in names else folder_sidecar
+            if not sidecar_path:
+                logging.debug(f"Skipping '{entry.name}': no instruction file found in the hierarchy.")
+                continue
+            try:
+                stat = entry.stat()
+            except OSError as e:
+                logging.error(f"Could not stat '{entry.path}': {e}")
+                continue
+            yield SourceFile(
+                path=entry.path,
+                filename=entry.name,
+                source_path=os.path.relpath(entry.path, base_path).replace(os.path.sep, '/'),
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                sidecar_path=sidecar_path,
+            )
+        # กลับลำดับเพื่อให้ pop ได้ตามลำดับชื่อ (ลำดับเดียวกับ os.walk แบบ top-down)
+        stack.extend((subdir, dir_path) for subdir in reversed(subdirs))
@@ -0,0 +1,6 @@
+# pipeline_lib/embedding/__init__.py
+from .loader import load_embedding_model
+from .provider import EmbeddingProvider
+from .batcher import EmbeddingBatcher
+from .backends import EMBEDDING_BACKEND_REGISTRY, create_embedding_backend
+from .cache import EmbeddingCache
@@ -0,0 +1,100 @@
+# pipeline_lib/embedding/backends.py
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .loader import load_embedding_model
+
+class LocalEmbeddingBackend:
+    """Runs the provider's model inside the indexer process (the right choice on a GPU)."""
+
+    def __init__(self, embedding_config, provider):
+        self.provider = provider
+        self.tokenizer = provider.tokenizer
+        self.max_seq_length = provider.max_seq_length
+
+    def encode_batches(self, batches: list) -> list:
+        """Encodes each batch of texts and returns their vectors in the same order."""
+        return [self.provider.encode(texts, batch_size=len(texts), normalize_embeddings=True) for texts in batches]
+
+    def close(self):
+        pass
+
+# --- ตัวแปรของแต่ละ worker process (โหลดครั้งเดียวตอนเริ่ม worker) ---
+_worker_model = None
+
+def _init_worker(embedding_config, threads_per_worker, pin_cpus, worker_counter):
+    global _worker_model
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads_per_worker)
+    if pin_cpus and hasattr(os, 'sched_setaffinity'):
+        # ให้แต่ละ worker ใช้กลุ่ม core ของตัวเอง ไม่แย่ง cache กัน
+        with worker_counter.get_lock():
+            worker_index = worker_counter.value
+            worker_counter.value += 1
+        cpus = sorted(os.sched_getaffinity(0))
+        first = (worker_index * threads_per_worker) % len(cpus)
+        os.sched_setaffinity(0, cpus[first:first + threads_per_worker] or cpus)
+
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    _worker_model = load_embedding_model(dict(embedding_config, device='cpu'))
+
+def _encode_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts), normalize_embeddings=True)
+
+def _max_seq_length():
+    return _worker_model.max_seq_length
+
+class ProcessPoolEmbeddingBackend:
+    """
+    CPU embedding across a pool of worker processes.
+    Each worker loads the model once and runs with threads_per_worker
+    intra-op threads; batches are streamed to the workers and the results
+    come back in submission order.
+    """
+
+    def __init__(self, embedding_config, provider):
+        from transformers import AutoTokenizer
+
+        threads_per_worker = embedding_config.get('threads_per_worker', 4)
+        num_workers = embedding_config.get('num_workers') or max(1, os.cpu_count() // threads_per_worker)
+        logging.info(f"Starting {num_workers} embedding workers x {threads_per_worker} threads...")
+
+        context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(embedding_config, threads_per_worker, embedding_config.get('pin_cpus', True), context.Value('i', 0))
+        )
+        # tokenizer อย่างเดียวพอสำหรับการจัด batch ใน process หลัก ไม่ต้องโหลดทั้ง model
+        self.tokenizer = AutoTokenizer.from_pretrained(embedding_config['model_name'])
+        self.max_seq_length = self.executor.submit(_max_seq_length).result()
+
+    def encode_batches(self, batches: list) -> list:
+        """Encodes each batch of texts on the pool and returns their vectors in the same order."""
+        return list(self.executor.map(_encode_batch, batches))
+
+    def close(self):
+        self.executor.shutdown()
+
+EMBEDDING_BACKEND_REGISTRY = {
+    'LOCAL': LocalEmbeddingBackend,
+    'PROCESS_POOL': ProcessPoolEmbeddingBackend,
+}
+
+def create_embedding_backend(embedding_config, provider):
+    """
+    Creates the backend selected by embedding.backend (default: LOCAL).
+    LOCAL encodes with the provider's model; PROCESS_POOL leaves the provider
+    untouched, so the main process only loads the model if something else
+    (e.g. the CINEMATIC splitter) asks for it.
+    """
+    backend_type = embedding_config.get('backend', 'LOCAL')
+    backend_class = EMBEDDING_BACKEND_REGISTRY.get(backend_type)
+    if not backend_class:
+        raise ValueError(f"Unknown embedding backend: {backend_type}")
+    logging.info(f"Using embedding backend: {backend_type}")
+    return backend_class(embedding_config, provider)
@@ -0,0 +1,126 @@
+# pipeline_lib/embedding/batcher.py
+import logging
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from ..metrics import timed, count
+
+class EmbeddingBatcher:
+    """
+    Embeds chunks collected across many documents in length-sorted batches.
+
+    Chunks are sorted by token length so that each batch holds chunks of
+    similar size (little padding), and a batch is closed once
+    (longest chunk in batch) x (batch size) would exceed token_budget.
+    Vectors are handed back under the key each chunk was submitted with,
+    e.g. (item_id, chunk_sequence). The batches themselves are encoded by an
+    embedding backend (see backends.py); when a cache is given, texts that were
+    embedded before are served from it and only the misses are encoded.
+    count_tokens() measures text with the same tokenizer, for the RECURSIVE chunker.
+    """
+
+    def __init__(self, backend, token_budget=16384, max_batch_size=128, cache=None, token_count_cache_size=65536):
+        self.backend = backend
+        self.cache = cache
+        # ชิ้นข้อความเล็กๆ (ตัวแบ่ง บรรทัดหัวเรื่อง grapheme) ถูกนับซ้ำบ่อย: เก็บผลไว้
+        self._cached_token_count = lru_cache(maxsize=token_count_cache_size)(self._token_count)
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.total_chunks = 0
+        self.total_batches = 0
+        self.total_tokens = 0
+        self.total_padded_tokens = 0
+        self.total_seconds = 0.0
+
+    def token_lengths(self, texts: list) -> np.ndarray:
+        """Token count of each text, capped at the model's window (what encode() will actually see)."""
+        encoded = self.backend.tokenizer(
+            texts, add_special_tokens=True, truncation=True, max_length=self.backend.max_seq_length
+        )
+        return np.array([len(ids) for ids in encoded['input_ids']], dtype='int64')
+
+    def _token_count(self, text: str) -> int:
+        return len(self.backend.tokenizer(text, add_special_tokens=False)['input_ids'])
+
+    def count_tokens(self, text: str) -> int:
+        """Token count of a text without special tokens and without truncation."""
+        if len(text) > 256:
+            # ข้อความยาวแทบไม่ซ้ำกัน ไม่คุ้มที่จะเก็บไว้ใน cache
+            return self._token_count(text)
+        return self._cached_token_count(text)
+
+    def max_text_tokens(self) -> int:
+        """Tokens of text that fit in the model window once the special tokens are added."""
+        return self.backend.max_seq_length - self.backend.tokenizer.num_special_tokens_to_add()
+
+    def plan_batches(self, lengths: np.ndarray) -> list:
+        """Groups text positions into batches whose padded size stays within the token budget."""
+        # ยาวสุดก่อน: batch แรกคือ batch ที่ใช้หน่วยความจำมากที่สุด ถ้าจะ OOM ก็จะรู้ทันที
+        order = np.argsort(-lengths, kind='stable')
+        batches, current, current_max = [], [], 0
+        for position in order.tolist():
+            longest = max(current_max, int(lengths[position]))
+            if current and (longest * (len(current) + 1) > self.token_budget or len(current) >= self.max_batch_size):
+                batches.append(current)
+                current, longest = [], int(lengths[position])
+            current.append(position)
+            current_max = longest
+        if current:
+            batches.append(current)
+        return batches
+
+    @timed("embedding.embed")
+    def embed(self, keyed_texts: list) -> dict:
+        """Embeds [(key, text), ...] and returns {key: normalized vector}."""
+        if not keyed_texts:
+            return {}
+        start = time.perf_counter()
+        vectors = {}
+        if self.cache:
+            cached = self.cache.get_many([text for _, text in keyed_texts])
+            vectors = {keyed_texts[position][0]: vector for position, vector in cached.items()}
+            keyed_texts = [item for position, item in enumerate(keyed_texts) if position not in cached]
+            count("embedding.cache_hits", len(cached))
+            if not keyed_texts:
+                return vectors
+        keys = [key for key, _ in keyed_texts]
+        texts = [text for _, text in keyed_texts]
+        with timed("embedding.tokenize"):
+            lengths = self.token_lengths(texts)
+        batches = self.plan_batches(lengths)
+
+        with timed("embedding.encode"):
+            batch_results = self.backend.encode_batches([[texts[i] for i in batch] for batch in batches])
+        for batch, batch_vectors in zip(batches, batch_results):
+            for position, vector in zip(batch, batch_vectors):
+                vectors[keys[position]] = vector
+            self.total_padded_tokens += int(lengths[batch].max()) * len(batch)
+        if self.cache:
+            self.cache.put_many(texts, [vectors[key] for key in keys])
+
+        elapsed = time.perf_counter() - start
+        self.total_chunks += len(texts)
+        self.total_batches += len(batches)
+        self.total_tokens += int(lengths.sum())
+        self.total_seconds += elapsed
+        count("embedding.chunks", len(texts))
+        count("embedding.tokens", int(lengths.sum()))
+        logging.info(f"  > Embedded {len(texts)} chunks in {len(batches)} batches "
+                     f"({len(texts) / elapsed:.1f} chunks/sec).")
+        return vectors
+
+    def embed_texts(self, texts: list) -> np.ndarray:
+        """Embeds a list of texts and returns their vectors as rows in the same order."""
+        vectors = self.embed(list(enumerate(texts)))
+        return np.vstack([vectors[i] for i in range(len(texts))])
+
+    def log_stats(self):
+        """Logs the throughput and padding overhead accumulated over the run."""
+        if not self.total_chunks:
+            return
+        padding = 1 - self.total_tokens / self.total_padded_tokens if self.total_padded_tokens else 0.0
+        logging.info(f"Embedding: {self.total_chunks} chunks in {self.total_batches} batches, "
+                     f"{self.total_chunks / self.total_seconds:.1f} chunks/sec, "
+                     f"{self.total_tokens / self.total_seconds:.0f} tokens/sec, padding {padding:.1%}.")
@@ -0,0 +1,106 @@
+# pipeline_lib/embedding/cache.py
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+
+# SQLite จำกัดจำนวนพารามิเตอร์ต่อคำสั่ง จึงทำทีละกลุ่ม
+_SQL_CHUNK = 500
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (model name, hash of the chunk text).
+
+    Vectors are stored as float32 blobs in SQLite. Every hit refreshes the
+    entry's last_used time, and when the cache grows past max_bytes the
+    least recently used entries are evicted down to 90% of the limit.
+    """
+
+    def __init__(self, path, model_name, max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        logging.info(f"Embedding cache opened at {path} ({self.total_bytes / 2**20:.1f} MB).")
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: list) -> dict:
+        """Returns {position: vector} for the texts that are in the cache."""
+        keys = [self._key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), _SQL_CHUNK):
+            group = keys[start:start + _SQL_CHUNK]
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(group))})", group
+            ).fetchall()
+            found.update({key: np.frombuffer(vector, dtype='float32') for key, vector in rows})
+            if rows:
+                self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                      [(time.time(), key) for key, _ in rows])
+        self.conn.commit()
+
+        vectors = {position: found[key] for position, key in enumerate(keys) if key in found}
+        self.hits += len(vectors)
+        self.misses += len(texts) - len(vectors)
+        return vectors
+
+    def put_many(self, texts: list, vectors: list):
+        """Stores vectors for the given texts, then evicts old entries if over the size limit."""
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            blob = np.asarray(vector, dtype='float32').tobytes()
+            rows[self._key(text)] = (self._key(text), blob, len(blob), now)
+        rows = list(rows.values())
+        self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, nbytes, last_used) VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.total_bytes += sum(nbytes for _, _, nbytes, _ in rows)
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY last_used LIMIT ?", (_SQL_CHUNK,)
+            ).fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, nbytes in rows:
+                if self.total_bytes <= target:
+                    break
+                victims.append((key,))
+                self.total_bytes -= nbytes
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+            evicted += len(victims)
+        self.conn.commit()
+        logging.info(f"Embedding cache evicted {evicted} least recently used entries.")
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        logging.info(f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                     f"{self.total_bytes / 2**20:.1f} MB on disk.")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,24 @@
+# pipeline_lib/embedding/llama_adapter.py
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+class SharedModelLlamaEmbedding(BaseEmbedding):
+    """LlamaIndex embedding adapter that delegates to an EmbeddingProvider instead of loading its own model."""
+
+    _provider = PrivateAttr()
+
+    def __init__(self, provider, **kwargs):
+        super().__init__(model_name=provider.embedding_config['model_name'], **kwargs)
+        self._provider = provider
+
+    def _get_query_embedding(self, query: str) -> list:
+        return self._get_text_embeddings([query])[0]
+
+    def _get_text_embedding(self, text: str) -> list:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: list) -> list:
+        return self._provider.encode(texts, normalize_embeddings=True).tolist()
+
+    async def _aget_query_embedding(self, query: str) -> list:
+        return self._get_query_embedding(query)
@@ -0,0 +1,13 @@
+# pipeline_lib/embedding/loader.py
+import logging
+from sentence_transformers import SentenceTransformer
+
+def load_embedding_model(embedding_config):
+    """Loads the SentenceTransformer model described in the 'embedding' config section."""
+    logging.info(f"Loading embedding model: {embedding_config['model_name']}")
+    model = SentenceTransformer(
+        embedding_config['model_name'],
+        device=embedding_config['device']
+    )
+    logging.info("Model loaded successfully.")
+    return model
@@ -0,0 +1,42 @@
+# pipeline_lib/embedding/provider.py
+from .loader import load_embedding_model
+
+class EmbeddingProvider:
+    """
+    Owns the one SentenceTransformer instance of the process.
+
+    The model is loaded on first use, with the configured device. Both the
+    plain encode() interface and the LlamaIndex BaseEmbedding adapter used by
+    the CINEMATIC splitter go through this same instance, and the adapter is
+    only built when a strategy actually asks for it.
+    """
+
+    def __init__(self, embedding_config):
+        self.embedding_config = embedding_config
+        self._model = None
+        self._llama_embedding = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = load_embedding_model(self.embedding_config)
+        return self._model
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    @property
+    def max_seq_length(self):
+        return self.model.max_seq_length
+
+    def encode(self, texts, **kwargs):
+        return self.model.encode(texts, **kwargs)
+
+    def as_llama_embedding(self):
+        """Returns a LlamaIndex BaseEmbedding backed by this provider's model."""
+        if self._llama_embedding is None:
+            # import ตรงนี้ เพื่อไม่ให้ strategy อื่นต้องโหลด LlamaIndex
+            from .llama_adapter import SharedModelLlamaEmbedding
+            self._llama_embedding = SharedModelLlamaEmbedding(self)
+        return self._llama_embedding
@@ -0,0 +1,118 @@
+# pipeline_lib/extraction.py
+import hashlib
+import io
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import observe
+
+_DONE = object()
+
+def extract_text(filename, raw: bytes) -> str:
+    """Extracts the plain text of a .txt or .docx file from its bytes."""
+    if filename.endswith(".txt"):
+        return raw.decode('utf-8')
+    if filename.endswith(".docx"):
+        import docx
+        document = docx.Document(io.BytesIO(raw))
+        return "\n".join([p.text for p in document.paragraphs])
+    return ""
+
+def extract_document(path, filename, expected_hash=None):
+    """
+    Reads a source file once and returns (content_hash, text).
+    text is None when the content hash equals expected_hash (the file did not really change).
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    content_hash = hashlib.sha256(raw).hexdigest()
+    if expected_hash is not None and content_hash == expected_hash:
+        return content_hash, None
+    return content_hash, extract_text(filename, raw)
+
+def _extract_timed(path, filename, expected_hash=None):
+    """extract_document plus its duration, measured in the worker so the parent can record it."""
+    start = time.perf_counter()
+    result = extract_document(path, filename, expected_hash)
+    return result, time.perf_counter() - start
+
+def _extraction_timer(filename) -> str:
+    # แยกตามชนิดไฟล์ (เช่น extraction.docx) เพราะ .docx ใช้เวลามากกว่า .txt หลายเท่า
+    return "extraction." + filename.rsplit('.', 1)[-1].lower()
+
+def stream_extractions(tasks, num_workers=4, queue_size=64):
+    """
+    Runs extract_document for each (key, path, filename, expected_hash) task in a
+    process pool and yields (key, result) in task order, where result is
+    (content_hash, text) or the exception raised while extracting.
+
+    The tasks iterable (e.g. file discovery) is consumed by a feeder thread and the
+    pending extractions wait in a bounded queue, so discovery, extraction and the
+    caller's stages overlap while at most queue_size documents are held in memory.
+    With num_workers == 0 everything runs inline in the calling thread.
+    The extraction time of each file is recorded per file type (e.g. 'extraction.docx').
+    """
+    if not num_workers:
+        for key, path, filename, expected_hash in tasks:
+            try:
+                result, seconds = _extract_timed(path, filename, expected_hash)
+                observe(_extraction_timer(filename), seconds)
+            except Exception as e:
+                result = e
+            yield key, result
+        return
+
+    pending = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed(pool):
+        try:
+            for key, path, filename, expected_hash in tasks:
+                if not put((key, (filename, pool.submit(_extract_timed, path, filename, expected_hash)))):
+                    return
+        except Exception as e:
+            logging.error(f"File discovery failed: {e}", exc_info=True)
+            put((_DONE, e))
+            return
+        put((_DONE, None))
+
+    # spawn: process หลักมี thread อื่นอยู่แล้ว (feeder, LLM pool) การ fork จึงไม่ปลอดภัย
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        feeder = threading.Thread(target=feed, args=(pool,), name="discovery", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                key, item = pending.get()
+                if key is _DONE:
+                    if item is not None:
+                        raise item
+                    break
+                filename, future = item
+                error = future.exception()
+                if error is not None:
+                    yield key, error
+                    continue
+                result, seconds = future.result()
+                observe(_extraction_timer(filename), seconds)
+                yield key, result
+        finally:
+            stop.set()
+            feeder.join()
+            # งานที่ยังค้างในคิวไม่ต้องทำต่อ (เช่น เมื่อผู้เรียกหยุดกลางทาง)
+            while not pending.empty():
+                key, item = pending.get_nowait()
+                if key is not _DONE:
+                    item[1].cancel()
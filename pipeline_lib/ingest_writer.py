@@ -0,0 +1,181 @@
+# pipeline_lib/ingest_writer.py
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+from .metrics import timed, count
+
+INSERT_ITEMS_SQL = """
+    INSERT INTO knowledge_items (source_type, status, title, full_content, metadata, source_path, source_size, source_mtime, content_hash)
+    VALUES %s
+"""
+INSERT_ITEMS_TEMPLATE = "(%s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s)"
+
+UPDATE_ITEMS_SQL = """
+    UPDATE knowledge_items AS ki
+    SET title = v.title, full_content = v.full_content, metadata = v.metadata, source_size = v.source_size,
+        source_mtime = v.source_mtime, content_hash = v.content_hash, needs_reindex = true
+    FROM (VALUES %s) AS v (id, title, full_content, metadata, source_size, source_mtime, content_hash)
+    WHERE ki.id = v.id
+"""
+UPDATE_ITEMS_TEMPLATE = "(%s, %s, %s, %s::jsonb, %s::bigint, %s::double precision, %s)"
+
+TOUCH_ITEMS_SQL = """
+    UPDATE knowledge_items AS ki
+    SET source_size = v.source_size, source_mtime = v.source_mtime, content_hash = v.content_hash
+    FROM (VALUES %s) AS v (id, source_size, source_mtime, content_hash)
+    WHERE ki.id = v.id
+"""
+TOUCH_ITEMS_TEMPLATE = "(%s, %s::bigint, %s::double precision, %s)"
+
+def _item_row(job, final_metadata):
+    """The VALUES row of one job for its action's statement."""
+    if job["action"] == "touch":
+        return (job["item_id"], job["source_size"], job["source_mtime"], job["content_hash"])
+    title = final_metadata.get('document_title', job["filename"])
+    metadata = json.dumps(final_metadata, ensure_ascii=False)
+    if job["action"] == "update":
+        return (job["item_id"], title, job["content"], metadata,
+                job["source_size"], job["source_mtime"], job["content_hash"])
+    return ('RAG', 'active', title, job["content"], metadata,
+            job["source_path"], job["source_size"], job["source_mtime"], job["content_hash"])
+
+STATEMENTS = {
+    "insert": (INSERT_ITEMS_SQL, INSERT_ITEMS_TEMPLATE),
+    "update": (UPDATE_ITEMS_SQL, UPDATE_ITEMS_TEMPLATE),
+    "touch": (TOUCH_ITEMS_SQL, TOUCH_ITEMS_TEMPLATE),
+}
+
+class IngestCheckpoint:
+    """
+    Persistent record of an ingest run, rewritten atomically after every commit.
+    A run that did not reach 'completed' is resumed by the next start: its counts
+    carry over, and the files it committed are skipped through the source manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        state = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+            except Exception as e:
+                logging.warning(f"Could not read ingest checkpoint '{path}', starting a new run: {e}")
+        if state and state.get("status") == "running":
+            logging.info(f"Resuming ingest run {state['run_id']} started at {state['started_at']} "
+                         f"({sum(state['committed'].values())} items already committed, last: '{state.get('last_source_path')}').")
+        else:
+            now = datetime.now(timezone.utc).isoformat()
+            state = {
+                "run_id": uuid.uuid4().hex,
+                "status": "running",
+                "started_at": now,
+                "updated_at": now,
+                "last_source_path": None,
+                "committed": {"insert": 0, "update": 0, "touch": 0},
+                "failed": {},
+            }
+        self.state = state
+
+    def record(self, committed_jobs, failed_jobs):
+        for job in committed_jobs:
+            self.state["committed"][job["action"]] += 1
+            self.state["failed"].pop(job["source_path"], None)
+        for job, error in failed_jobs:
+            self.state["failed"][job["source_path"]] = error
+        if committed_jobs:
+            self.state["last_source_path"] = committed_jobs[-1]["source_path"]
+        self._write()
+
+    def finish(self):
+        self.state["status"] = "completed"
+        self._write()
+
+    def _write(self):
+        if not self.path:
+            return
+        self.state["updated_at"] = datetime.now(timezone.utc).isoformat()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+class BatchedItemWriter:
+    """
+    Buffers knowledge_items writes and stores them with multi-row execute_values
+    statements, committing every batch_size items or commit_interval seconds.
+
+    Each batch runs under a savepoint. If a statement fails, the batch is retried
+    row by row, each row under its own savepoint, so a bad file is logged and
+    skipped without discarding the rest of the batch or earlier commits.
+    """
+
+    def __init__(self, conn, checkpoint, batch_size=200, commit_interval=30.0):
+        self.conn = conn
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._buffer = []
+        self._last_commit = time.monotonic()
+        self.counts = {"insert": 0, "update": 0, "touch": 0}
+        self.failed = 0
+
+    def add(self, job, final_metadata):
+        self._buffer.append((job, final_metadata))
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.flush()
+
+    @timed("db.write_batch")
+    def flush(self):
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+        committed, failed = [], []
+        with self.conn.cursor() as cur:
+            for action, (sql, template) in STATEMENTS.items():
+                group = [(job, _item_row(job, final_metadata)) for job, final_metadata in buffer if job["action"] == action]
+                if not group:
+                    continue
+                cur.execute("SAVEPOINT ingest_batch")
+                try:
+                    execute_values(cur, sql, [row for _, row in group], template=template, page_size=len(group))
+                    cur.execute("RELEASE SAVEPOINT ingest_batch")
+                    committed.extend(job for job, _ in group)
+                    continue
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT ingest_batch")
+                    logging.warning(f"Batch {action} of {len(group)} items failed ({e}); retrying item by item.")
+
+                for job, row in group:
+                    cur.execute("SAVEPOINT ingest_item")
+                    try:
+                        execute_values(cur, sql, [row], template=template)
+                        cur.execute("RELEASE SAVEPOINT ingest_item")
+                        committed.append(job)
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT ingest_item")
+                        logging.error(f"Could not store '{job['filename']}': {e}")
+                        failed.append((job, str(e)))
+        self.conn.commit()
+        self._last_commit = time.monotonic()
+
+        for job in committed:
+            self.counts[job["action"]] += 1
+            count(f"ingest.{job['action']}")
+        self.failed += len(failed)
+        count("ingest.failed", len(failed))
+        self.checkpoint.record(committed, failed)
+        logging.info(f"Committed {len(committed)} items ({len(failed)} failed); "
+                     f"run total: {sum(self.counts.values())} items.")
+
+    def close(self):
+        """Commits whatever is still buffered and marks the run as completed."""
+        self.flush()
+        self.checkpoint.finish()
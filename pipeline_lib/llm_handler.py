@@ -1,8 +1,72 @@
 # pipeline_lib/llm_handler.py
 from llama_index.llms.openai_like import OpenAILike
 from llama_index.core.llms import ChatMessage, MessageRole
+import hashlib
 import json
 import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import openai
+
+from .concurrency import AdaptiveConcurrencyLimiter
+from .metrics import timed, count
+
+# ข้อผิดพลาดชั่วคราวที่ควรลองใหม่ (timeout, เชื่อมต่อไม่ได้, server ล้น)
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+class LLMResponseCache:
+    """
+    Persistent cache of raw LLM responses keyed by (model, hash of the prompt).
+    Re-ingesting a file whose content (and therefore prompt) is unchanged
+    is answered from here without calling the LLM server.
+    """
+
+    def __init__(self, path, model_name):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # ใช้ร่วมกันหลาย thread ในโหมด CONCURRENT จึงต้องมี lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        logging.info(f"LLM response cache opened at {path}.")
+
+    def _key(self, prompt):
+        return hashlib.sha256(f"{self.model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, prompt):
+        with self._lock:
+            row = self.conn.execute("SELECT response FROM llm_responses WHERE key = ?", (self._key(prompt),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, prompt, response):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO llm_responses (key, response, created_at) VALUES (?, ?, ?)",
+                              (self._key(prompt), response, time.time()))
+            self.conn.commit()
+
+    def log_stats(self):
+        logging.info(f"LLM response cache: {self.hits} hits, {self.misses} misses.")
+
+    def close(self):
+        self.conn.close()
 
 class MetadataExtractor:
     def __init__(self, llm_config):
@@ -12,20 +76,64 @@ class MetadataExtractor:
             api_key=llm_config['api_key'],
             temperature=llm_config['temperature'],
             is_chat_model=True,
-            timeout=llm_config['timeout']
+            timeout=llm_config['timeout'],
+            max_retries=0 # ลองใหม่เองใน _chat เพื่อให้ limiter เห็นทุกครั้งที่เรียก
         )
         self.limit = llm_config['context_char_limit']
+        self.max_retries = llm_config.get('max_retries', 3)
+        self.retry_backoff = llm_config.get('retry_backoff_s', 2.0)
+        concurrency_config = llm_config.get('concurrency', {})
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial=concurrency_config.get('initial', 4),
+            min_limit=concurrency_config.get('min', 1),
+            max_limit=concurrency_config.get('max', 32),
+            target_latency=concurrency_config.get('target_latency_s', 30.0)
+        )
+        # cache_path ว่าง = ไม่ใช้ cache
+        self.cache = LLMResponseCache(llm_config['cache_path'], llm_config['model']) if llm_config.get('cache_path') else None
         logging.info(f"LLM Metadata Extractor initialized with model: {llm_config['model']}")
 
     def generate_metadata(self, content, filename):
         prompt = self._create_prompt(content[:self.limit], filename)
-        messages = [ChatMessage(role=MessageRole.USER, content=prompt)]
+        if self.cache:
+            cached = self.cache.get(prompt)
+            if cached is not None:
+                count("llm.cache_hits")
+                return self._extract_json(cached)
         try:
-            response = self.llm.chat(messages)
-            return self._extract_json(response.message.content)
+            text = self._chat(prompt)
         except Exception as e:
             logging.error(f"LLM API call failed: {e}")
+            count("llm.failures")
             return {}
+        data = self._extract_json(text)
+        # เก็บเฉพาะคำตอบที่อ่าน JSON ได้ เพื่อให้รอบหน้าลองใหม่ถ้าครั้งนี้ผิดพลาด
+        if self.cache and data:
+            self.cache.put(prompt, text)
+        return data
+
+    def _chat(self, prompt):
+        """Sends one prompt under the concurrency limiter, retrying transient errors with exponential backoff."""
+        messages = [ChatMessage(role=MessageRole.USER, content=prompt)]
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limiter.slot(), timed("llm.call"):
+                    response = self.llm.chat(messages)
+                count("llm.prompt_chars", len(prompt))
+                return response.message.content
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                count("llm.retries")
+                delay = self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+                logging.warning(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s "
+                                f"[{attempt + 1}/{self.max_retries}].")
+                time.sleep(delay)
+
+    def close(self):
+        if self.cache:
+            self.cache.log_stats()
+            self.cache.close()
 
     def _create_prompt(self, file_content, filename):
      return f"""คุณคือผู้เชี่ยวชาญด้านการวิเคราะห์และจัดหมวดหมู่เอกสารราชการของกรมการปกครอง (DOPA)
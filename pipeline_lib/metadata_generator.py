@@ -2,16 +2,27 @@
 import os
 import re
 
+# --- Shared dependencies: ข้อมูลที่หลาย generator ใช้ร่วมกัน จะถูกคำนวณครั้งเดียวต่อเอกสาร ---
+def extract_llm_metadata(llm_extractor, content, filename, **kwargs):
+    """เรียก LLM ครั้งเดียวเพื่อดึง title, summary และ tags ของเอกสาร"""
+    return llm_extractor.generate_metadata(content, filename)
+
+DEPENDENCY_REGISTRY = {
+    "llm_metadata": extract_llm_metadata,
+}
+
 # แต่ละฟังก์ชันจะรับผิดชอบการสร้าง Metadata 1 ชนิด
-def get_document_title_from_llm(llm_extractor, content, filename, **kwargs): # <--- เพิ่ม , **kwargs
+def get_document_title_from_llm(llm_metadata, filename, **kwargs): # <--- เพิ่ม , **kwargs
     """ใช้ LLM สร้าง Title"""
-    data = llm_extractor.generate_metadata(content, filename)
-    return data.get("document_title", filename)
+    return llm_metadata.get("document_title", filename)
 
-def get_tags_from_llm(llm_extractor, content, filename, **kwargs): # <--- เพิ่ม , **kwargs
+def get_tags_from_llm(llm_metadata, **kwargs): # <--- เพิ่ม , **kwargs
     """ใช้ LLM สร้าง Tags"""
-    data = llm_extractor.generate_metadata(content, filename)
-    return data.get("tags", [])
+    return llm_metadata.get("tags", [])
+
+def get_summary_from_llm(llm_metadata, **kwargs):
+    """ใช้ LLM สร้างบทสรุป"""
+    return llm_metadata.get("summary")
 
 def get_category_from_path(file_full_path, base_path, **kwargs):
     """สร้าง Category แบบหลายระดับจากโครงสร้างโฟลเดอร์"""
@@ -48,6 +59,7 @@ def get_document_type_from_path(file_full_path, base_path, **kwargs):
 METADATA_GENERATOR_REGISTRY = {
     "document_title": get_document_title_from_llm,
     "tags": get_tags_from_llm,
+    "summary": get_summary_from_llm,
     "category": get_category_from_path,
     "source_path": get_source_path,
     "page_number": get_page_count_from_content,
@@ -56,4 +68,31 @@ METADATA_GENERATOR_REGISTRY = {
     "effective_date": lambda sidecar_data, **kwargs: get_custom_field_from_sidecar("effective_date", sidecar_data),
     "department": lambda sidecar_data, **kwargs: get_custom_field_from_sidecar("department", sidecar_data),
     "version": lambda sidecar_data, **kwargs: get_custom_field_from_sidecar("version", sidecar_data),
-}
\ No newline at end of file
+}
+
+# --- Dependencies ที่แต่ละ generator ต้องการ (ชื่อใน DEPENDENCY_REGISTRY) ---
+GENERATOR_DEPENDENCIES = {
+    "document_title": ["llm_metadata"],
+    "tags": ["llm_metadata"],
+    "summary": ["llm_metadata"],
+}
+
+def generate_metadata_fields(active_fields, **context) -> dict:
+    """
+    Runs the generators of the active fields for one document.
+    Each shared dependency is computed at most once and passed to every
+    generator that declares it, so title, tags and summary share one LLM call.
+    """
+    resolved = {}
+    final_metadata = {}
+    for field_name in active_fields:
+        generator_func = METADATA_GENERATOR_REGISTRY.get(field_name)
+        if not generator_func:
+            continue
+        for dependency in GENERATOR_DEPENDENCIES.get(field_name, []):
+            if dependency not in resolved:
+                resolved[dependency] = DEPENDENCY_REGISTRY[dependency](**context)
+        value = generator_func(**context, **resolved)
+        if value is not None:
+            final_metadata[field_name] = value
+    return final_metadata
@@ -0,0 +1,289 @@
+# pipeline_lib/metrics.py
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import ContextDecorator
+from datetime import datetime, timezone
+
+# จำนวนตัวอย่างเวลาสูงสุดที่เก็บต่อ timer (reservoir sampling) สำหรับคำนวณ quantile
+MAX_SAMPLES = 2048
+QUANTILES = (0.5, 0.9, 0.99)
+METRIC_PREFIX = "pipeline"
+
+class TimerStats:
+    """Count, sum, min, max and a bounded random sample of the durations of one timer."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds, error, rng):
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            slot = rng.randrange(self.count)
+            if slot < MAX_SAMPLES:
+                self.samples[slot] = seconds
+
+    def quantile(self, q) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_s": round(self.total, 6),
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "min_ms": round(self.min * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            **{f"p{int(q * 100)}_ms": round(self.quantile(q) * 1000, 3) for q in QUANTILES},
+        }
+
+class _Timer(ContextDecorator):
+    """Context manager and decorator that adds the duration of its block to a named timer."""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def _recreate_cm(self):
+        # ฟังก์ชันที่ถูก decorate อาจถูกเรียกพร้อมกันหลาย thread: ใช้ instance ใหม่ทุกครั้ง
+        return _Timer(self.registry, self.name)
+
+    def __enter__(self):
+        self._profiling = self.registry._start_stage_profile(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, error=exc_type is not None)
+        if self._profiling:
+            self.registry._stop_stage_profile(self.name)
+        return False
+
+class MetricsRegistry:
+    """
+    Timers and counters of one pipeline run (thread-safe).
+
+    Timers are named by stage, e.g. 'llm.call' or 'embedding.encode', and used as
+    context managers or decorators:
+
+        with METRICS.timer('store.add'):
+            storage_adapter.add(chunks)
+
+        @timed('index.chunk')
+        def chunk_item(...): ...
+
+    At the end of a run, write_report() stores the run as JSON and, when
+    configured, as a Prometheus / OpenMetrics textfile for the node_exporter
+    textfile collector. Profiling with cProfile is opt-in, for the whole run or
+    only inside the listed timers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self.config = {}
+        self.run = None
+        self.started_at = None
+        self.timers = {}
+        self.counters = {}
+        self._stage_profiles = {}      # timer name -> cProfile.Profile (สะสมทุกครั้งที่เข้า timer)
+        self._active_profile = None    # cProfile ทำงานได้ทีละตัว
+
+    def start_run(self, run, metrics_config=None):
+        """
+        Clears the registry for a new run named run (e.g. 'ingest', 'index').
+        With profile.enabled and no profile.stages, cProfile runs from here until write_report().
+        """
+        with self._lock:
+            self.config = metrics_config or {}
+            self.run = run
+            self.started_at = time.time()
+            self.timers = {}
+            self.counters = {}
+            self._stage_profiles = {}
+            self._active_profile = None
+        profile_config = self._profile_config()
+        if profile_config.get('enabled') and not profile_config.get('stages'):
+            self._active_profile = self._stage_profiles['run'] = cProfile.Profile()
+            self._active_profile.enable()
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.get('enabled', True)
+
+    def timer(self, name) -> _Timer:
+        return _Timer(self, name)
+
+    def observe(self, name, seconds, error=False):
+        """Adds one duration (seconds) to a timer, e.g. one measured in a worker process."""
+        with self._lock:
+            stats = self.timers.get(name)
+            if stats is None:
+                stats = self.timers[name] = TimerStats()
+            stats.add(seconds, error, self._rng)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        """The run as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "run": self.run,
+                "started_at": datetime.fromtimestamp(self.started_at or time.time(), timezone.utc).isoformat(),
+                "duration_s": round(time.time() - (self.started_at or time.time()), 3),
+                "timers": {name: stats.as_dict() for name, stats in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    # --- cProfile ---
+    def _profile_config(self):
+        return self.config.get('profile', {}) if self.enabled else {}
+
+    def _start_stage_profile(self, name) -> bool:
+        profile_config = self._profile_config()
+        if not profile_config.get('enabled') or name not in (profile_config.get('stages') or ()):
+            return False
+        with self._lock:
+            if self._active_profile is not None:
+                return False
+            profile = self._stage_profiles.setdefault(name, cProfile.Profile())
+            self._active_profile = profile
+        profile.enable()
+        return True
+
+    def _stop_stage_profile(self, name):
+        profile = self._stage_profiles[name]
+        profile.disable()
+        with self._lock:
+            self._active_profile = None
+
+    def _write_profiles(self, stamp):
+        profile_dir = self._profile_config().get('path', 'storage/profiles')
+        for name, profile in self._stage_profiles.items():
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f"{self.run}-{stamp}-{name}.prof")
+            profile.dump_stats(path)
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(15)
+            logging.info(f"Profile of '{name}' written to {path} (open with snakeviz or pstats):\n{summary.getvalue()}")
+
+    # --- export ---
+    def write_report(self):
+        """Logs a summary of the run and writes its JSON file, textfile export and profiles as configured."""
+        if not self.enabled:
+            return
+        if 'run' in self._stage_profiles:
+            self._stage_profiles['run'].disable()
+            self._active_profile = None
+        report = self.snapshot()
+        self.log_summary(report)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        json_dir = self.config.get('json_dir')
+        if json_dir:
+            path = os.path.join(json_dir, f"{self.run}-{stamp}.json")
+            _write_atomic(path, json.dumps(report, ensure_ascii=False, indent=2))
+            logging.info(f"Run metrics written to {path}")
+        textfile_dir = self.config.get('textfile_dir')
+        if textfile_dir:
+            path = os.path.join(textfile_dir, f"{METRIC_PREFIX}_{self.run}.prom")
+            _write_atomic(path, render_textfile(report, self.config.get('format', 'prometheus')))
+            logging.info(f"Run metrics exported to {path}")
+        self._write_profiles(stamp)
+
+    def log_summary(self, report):
+        lines = [f"{'timer':<28} {'count':>8} {'total s':>10} {'p50 ms':>10} {'p99 ms':>10}"]
+        for name, stats in sorted(report["timers"].items(), key=lambda item: -item[1]["total_s"]):
+            lines.append(f"{name:<28} {stats['count']:>8} {stats['total_s']:>10.2f} {stats['p50_ms']:>10.1f} {stats['p99_ms']:>10.1f}")
+        counters = ", ".join(f"{name}={value:g}" for name, value in report["counters"].items())
+        logging.info(f"Run '{report['run']}' took {report['duration_s']:.1f}s; time per stage:\n" + "\n".join(lines)
+                     + (f"\nCounters: {counters}" if counters else ""))
+
+def _write_atomic(path, text):
+    # node_exporter อ่านไฟล์ได้ทุกเมื่อ: เขียนไฟล์ชั่วคราวก่อนแล้วค่อยสลับ
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_textfile(report, fmt='prometheus') -> str:
+    """
+    Renders a run report in the Prometheus text exposition format, or in
+    OpenMetrics (fmt='openmetrics'): timers as summaries, counters as counters.
+    """
+    if fmt not in ('prometheus', 'openmetrics'):
+        raise ValueError(f"Unknown metrics format: {fmt}. Supported: ['prometheus', 'openmetrics']")
+    run = _label(report["run"])
+    stage = f"{METRIC_PREFIX}_stage_duration_seconds"
+    errors = f"{METRIC_PREFIX}_stage_errors"
+    events = f"{METRIC_PREFIX}_events"
+    lines = [
+        f"# HELP {METRIC_PREFIX}_run_duration_seconds Wall time of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+        f'{METRIC_PREFIX}_run_duration_seconds{{run="{run}"}} {report["duration_s"]}',
+        f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Unix time at which the last run finished.",
+        f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+        f'{METRIC_PREFIX}_run_timestamp_seconds{{run="{run}"}} {time.time():.0f}',
+        f"# HELP {stage} Time spent per pipeline stage.",
+        f"# TYPE {stage} summary",
+    ]
+    if fmt == 'openmetrics':
+        lines.append(f"# UNIT {stage} seconds")
+    for name, stats in report["timers"].items():
+        labels = f'run="{run}",stage="{_label(name)}"'
+        for q in QUANTILES:
+            lines.append(f'{stage}{{{labels},quantile="{q}"}} {stats[f"p{int(q * 100)}_ms"] / 1000:.6f}')
+        lines.append(f"{stage}_sum{{{labels}}} {stats['total_s']:.6f}")
+        lines.append(f"{stage}_count{{{labels}}} {stats['count']}")
+
+    # Prometheus: ชื่อ counter ลงท้าย _total ทั้งใน TYPE และ sample; OpenMetrics: TYPE ไม่มี _total
+    for family, help_text, samples in (
+        (errors, "Stage executions that raised an exception.",
+         [(f'stage="{_label(name)}"', stats["errors"]) for name, stats in report["timers"].items()]),
+        (events, "Events counted during the run.",
+         [(f'name="{_label(name)}"', value) for name, value in report["counters"].items()]),
+    ):
+        type_name = family if fmt == 'openmetrics' else f"{family}_total"
+        lines += [f"# HELP {type_name} {help_text}", f"# TYPE {type_name} counter"]
+        lines += [f'{family}_total{{run="{run}",{labels}}} {value:g}' for labels, value in samples]
+    if fmt == 'openmetrics':
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+# registry ของ process (ทุก module ใช้ตัวเดียวกัน)
+METRICS = MetricsRegistry()
+
+def timed(name) -> _Timer:
+    """Times a block or a function into the process registry: `with timed('x'):` or `@timed('x')`."""
+    return METRICS.timer(name)
+
+def count(name, value=1):
+    METRICS.count(name, value)
+
+def observe(name, seconds, error=False):
+    METRICS.observe(name, seconds, error)
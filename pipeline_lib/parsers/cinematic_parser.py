@@ -1,13 +1,85 @@
 # pipeline_lib/parsers/cinematic_parser.py
 import logging
-from llama_index.core.node_parser import SemanticSplitterNodeParser
-from llama_index.core.schema import Document
-# ไม่จำเป็นต้อง import SentenceTransformer หรือ HuggingFaceEmbedding ในไฟล์นี้
+import re
+import numpy as np
 
-def parse_document(content: str, metadata: dict, llama_embed_adapter, breakpoint_threshold: int) -> list:
+# แบ่งประโยคหลังเครื่องหมายจบประโยค ที่ขึ้นบรรทัดใหม่ หรือที่ช่องว่างระหว่างอักษรไทย (ภาษาไทยเว้นวรรคระหว่างประโยค
+# และไม่มี .!?) แต่ไม่แบ่งหลังไม้ยมก "ๆ" (เก็บตัวแบ่งไว้กับประโยคก่อนหน้า)
+SENTENCE_BOUNDARY = re.compile(r'((?<=[.!?])\s+|\n+|(?<=[\u0e01-\u0e45\u0e47-\u0e5b])[ \t]+(?=[\u0e01-\u0e5b]))')
+
+_llama_splitters = {}
+
+def split_sentences(content: str) -> list:
+    """Splits text into sentences, keeping each separator so that ''.join(sentences) == content."""
+    parts = SENTENCE_BOUNDARY.split(content)
+    sentences = []
+    for i in range(0, len(parts), 2):
+        sentence = parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        if sentence.strip():
+            sentences.append(sentence)
+        elif sentences:
+            sentences[-1] += sentence
+    return sentences
+
+def find_breakpoints(window_embeddings: np.ndarray, breakpoint_threshold: int) -> np.ndarray:
+    """Indices i after which to cut: cosine distance between window i and i+1 above the percentile."""
+    if len(window_embeddings) < 2:
+        return np.zeros(0, dtype='int64')
+    distances = 1.0 - np.einsum('ij,ij->i', window_embeddings[:-1], window_embeddings[1:])
+    return np.nonzero(distances > np.percentile(distances, breakpoint_threshold))[0]
+
+def parse_document(content: str, metadata: dict, embed_texts, breakpoint_threshold: int, buffer_size: int = 1, pool_embeddings: bool = False):
+    """
+    Splits document text based on semantic similarity between neighbouring sentences.
+
+    Every sentence is embedded together with buffer_size neighbours on each side
+    in one batched embed_texts() call, and the text is cut where the distance
+    between consecutive windows is above the given percentile.
+
+    Returns (chunks_with_meta, chunk_embeddings). When pool_embeddings is True,
+    chunk_embeddings holds one vector per chunk, the normalized mean of its
+    sentence windows, so the chunks need not be embedded again; otherwise it is None.
+    """
+    if not content or not content.strip():
+        return [], None
+
+    logging.info(f"    > Applying 'CINEMATIC' chunking with threshold: {breakpoint_threshold}")
+
+    sentences = split_sentences(content)
+    windows = [
+        "".join(sentences[max(0, i - buffer_size):i + buffer_size + 1])
+        for i in range(len(sentences))
+    ]
+    try:
+        window_embeddings = np.asarray(embed_texts(windows), dtype='float32')
+    except Exception as e:
+        logging.error(f"Cinematic parsing failed while embedding sentences: {e}", exc_info=True)
+        return [], None
+
+    breakpoints = find_breakpoints(window_embeddings, breakpoint_threshold)
+    bounds = np.concatenate([[0], breakpoints + 1, [len(sentences)]])
+
+    chunks_with_meta = []
+    chunk_embeddings = []
+    document_main_title = metadata.get("document_title", "")
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        chunk_text = "".join(sentences[start:end]).strip()
+        if not chunk_text:
+            continue
+        enriched_content = f"from topic: {document_main_title}\n\n{chunk_text}"
+        meta = metadata.copy()
+        meta.update({"source_section": "cinematic_segment"})
+        chunks_with_meta.append((enriched_content, meta))
+        if pool_embeddings:
+            pooled = window_embeddings[start:end].mean(axis=0)
+            chunk_embeddings.append(pooled / np.linalg.norm(pooled))
+
+    return chunks_with_meta, (np.vstack(chunk_embeddings) if pool_embeddings and chunk_embeddings else None)
+
+def parse_document_llama_index(content: str, metadata: dict, llama_embed_adapter, breakpoint_threshold: int) -> list:
     """
     Splits document text based on semantic similarity using a pre-initialized
-    LlamaIndex embedding model adapter.
+    LlamaIndex embedding model adapter (the original CINEMATIC engine).
     """
     if not content or not content.strip():
         return []
@@ -15,11 +87,17 @@ def parse_document(content: str, metadata: dict, llama_embed_adapter, breakpoint
     logging.info(f"    > Applying 'CINEMATIC' (LlamaIndex) chunking with threshold: {breakpoint_threshold}")
 
     try:
-        # สร้าง Splitter โดยใช้ Adapter ที่รับเข้ามาโดยตรง
-        splitter = SemanticSplitterNodeParser(
-            embed_model=llama_embed_adapter,
-            breakpoint_percentile_threshold=breakpoint_threshold
-        )
+        from llama_index.core.node_parser import SemanticSplitterNodeParser
+        from llama_index.core.schema import Document
+
+        # สร้าง Splitter ครั้งเดียวต่อ adapter/threshold แล้วใช้ซ้ำทุกเอกสาร
+        key = (id(llama_embed_adapter), breakpoint_threshold)
+        if key not in _llama_splitters:
+            _llama_splitters[key] = SemanticSplitterNodeParser(
+                embed_model=llama_embed_adapter,
+                breakpoint_percentile_threshold=breakpoint_threshold
+            )
+        splitter = _llama_splitters[key]
 
         document = Document(text=content)
         nodes = splitter.get_nodes_from_documents([document])
@@ -35,7 +113,7 @@ def parse_document(content: str, metadata: dict, llama_embed_adapter, breakpoint
             chunks_with_meta.append((enriched_content, meta))
 
         return chunks_with_meta
-        
+
     except Exception as e:
         logging.error(f"Cinematic parsing with LlamaIndex failed: {e}", exc_info=True)
-        return []
\ No newline at end of file
+        return []
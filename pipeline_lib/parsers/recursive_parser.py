@@ -1,50 +1,131 @@
 # pipeline_lib/parsers/recursive_parser.py
+import logging
+import re
+from collections import deque
 
-def parse_document(content: str, metadata: dict, chunk_size: int, chunk_overlap: int) -> list:
+# ลำดับตัวแบ่ง: ย่อหน้า -> บรรทัด -> ช่องว่าง (ภาษาไทยเว้นวรรคระหว่างประโยค) -> ทีละ grapheme cluster
+SEPARATORS = ("\n\n", "\n", " ")
+
+# ตัวอักษรหนึ่งตัวพร้อมสระบน/ล่าง วรรณยุกต์ และเครื่องหมายที่ตามมา (ห้ามตัดแยกออกจากกัน)
+_GRAPHEME = re.compile(".[\u0e31\u0e34-\u0e3a\u0e47-\u0e4e\u0300-\u036f\u200c\u200d\ufe00-\ufe0f]*", re.S)
+
+def _split_graphemes(text: str, budget: int, count_tokens):
+    """Cuts a text with no separator left into runs of whole grapheme clusters within budget."""
+    clusters = _GRAPHEME.findall(text)
+    # ประมาณความยาวของแต่ละส่วนจากอัตรา token ต่อ cluster ของทั้งข้อความ แล้วหดลงจนพอดี budget
+    step = max(1, len(clusters) * budget // max(1, count_tokens(text)))
+    start = 0
+    while start < len(clusters):
+        end = start + step
+        while True:
+            end = min(end, len(clusters))
+            piece = "".join(clusters[start:end])
+            tokens = count_tokens(piece)
+            if tokens <= budget or end - start == 1:
+                break
+            end = start + min(end - start - 1, max(1, (end - start) * budget // tokens))
+        yield "", piece, tokens
+        start = end
+
+def _split_units(text: str, level: int, budget: int, count_tokens):
+    """
+    Yields (separator, unit, tokens) in document order, each unit within budget.
+    A piece that is too large at one level is split again at the next one;
+    separator is the text that stood between the unit and the previous one.
+    """
+    if level == len(SEPARATORS):
+        yield from _split_graphemes(text, budget, count_tokens)
+        return
+    separator = SEPARATORS[level]
+    for piece in text.split(separator):
+        if not piece.strip():
+            continue
+        tokens = count_tokens(piece)
+        if tokens <= budget:
+            yield separator, piece, tokens
+            continue
+        for position, (inner_separator, unit, unit_tokens) in enumerate(_split_units(piece, level + 1, budget, count_tokens)):
+            yield (separator if position == 0 else inner_separator), unit, unit_tokens
+
+def _merge_units(units, budget: int, overlap: int, count_tokens) -> list:
+    """Packs units greedily into chunks of at most budget, repeating the last units of a chunk (up to overlap) in the next."""
+    chunks = []
+    window = deque()  # (separator, unit, tokens, separator_tokens); ตัวแบ่งของหน่วยแรกใน chunk ไม่นับ
+    window_tokens = 0
+    for separator, unit, tokens in units:
+        separator_tokens = count_tokens(separator) if separator else 0
+        if window and window_tokens + separator_tokens + tokens > budget:
+            chunks.append(_join(window))
+            while window and (window_tokens > overlap or window_tokens + separator_tokens + tokens > budget):
+                window_tokens -= window.popleft()[2]
+                if window:
+                    window_tokens -= window[0][3]
+        if window:
+            window_tokens += separator_tokens
+        window.append((separator, unit, tokens, separator_tokens))
+        window_tokens += tokens
+    if window:
+        chunks.append(_join(window))
+    return chunks
+
+def _join(window) -> str:
+    parts = [window[0][1]]
+    for separator, unit, _, _ in list(window)[1:]:
+        parts.append(separator)
+        parts.append(unit)
+    return "".join(parts).strip()
+
+def _split_text(text: str, budget: int, overlap: int, count_tokens) -> list:
+    return _merge_units(_split_units(text, 0, budget, count_tokens), budget, overlap, count_tokens)
+
+def parse_document(content: str, metadata: dict, chunk_size: int, chunk_overlap: int,
+                   count_tokens=None, max_tokens: int = None) -> list:
     """
     Splits document text recursively with size and overlap awareness.
     This is the upgraded RECURSIVE strategy.
+
+    Text is split by paragraph, then line, then space, and finally between
+    grapheme clusters (a Thai consonant keeps its vowels and tone marks), and
+    the pieces are packed into chunks in a single pass. Sizes are measured
+    with count_tokens (e.g. the embedding tokenizer) or, without it, in
+    characters. With max_tokens (the model window without special tokens),
+    no chunk plus its title header is longer than the model will read.
     """
     if not content or not content.strip():
         return []
 
-    # 1. เริ่มต้นด้วยการแบ่งตามย่อหน้าเป็นหลัก
-    splits = content.split('\n\n')
-    
-    # 2. รวมประโยคเล็กๆ เข้าด้วยกัน
-    merged_splits = []
-    current_chunk = ""
-    for split in splits:
-        if len(current_chunk) + len(split) < chunk_size:
-            current_chunk += "\n\n" + split
-        else:
-            if current_chunk:
-                merged_splits.append(current_chunk.strip())
-            current_chunk = split
-    if current_chunk:
-        merged_splits.append(current_chunk.strip())
-
-    # 3. สร้าง Final Chunks พร้อม Overlap
-    final_chunks = []
-    for text in merged_splits:
-        # ถ้า Chunk ที่รวมแล้วยังใหญ่ไป ก็แบ่งย่อยอีก
-        if len(text) > chunk_size:
-            start = 0
-            while start < len(text):
-                end = start + chunk_size
-                chunk_text = text[start:end]
-                final_chunks.append(chunk_text)
-                start += chunk_size - chunk_overlap
-        else:
-            final_chunks.append(text)
-    
-    # 4. สร้าง enriched_content และ metadata สำหรับแต่ละ Chunk
-    chunks_with_meta = []
     document_main_title = metadata.get("document_title", "")
+    header = f"จากหัวข้อ: {document_main_title}\n\n"
+    count_tokens = count_tokens or len
+    budget = chunk_size
+    if max_tokens:
+        # หัวเรื่องที่เติมหน้า chunk ก็กินพื้นที่ใน window ของ model
+        budget = max(1, min(chunk_size, max_tokens - count_tokens(header)))
+    overlap = max(0, min(chunk_overlap, budget // 2))
+
+    final_chunks = _split_text(content, budget, overlap, count_tokens)
+    if max_tokens:
+        # จำนวน token ของแต่ละส่วนรวมกันเป็นค่าประมาณ: ตรวจ chunk จริงอีกครั้ง ไม่ให้ส่วนท้ายถูกตัดทิ้งตอน embed
+        checked = []
+        pending = [(chunk_text, budget) for chunk_text in reversed(final_chunks)]
+        while pending:
+            chunk_text, chunk_budget = pending.pop()
+            tokens = count_tokens(header + chunk_text)
+            if tokens <= max_tokens or chunk_budget == 1:
+                checked.append(chunk_text)
+                continue
+            logging.debug(f"  > Chunk of {tokens} tokens exceeds the model window ({max_tokens}); splitting it further.")
+            smaller = max(1, min(chunk_budget - 1, chunk_budget * max_tokens // tokens))
+            pieces = _split_text(chunk_text, smaller, min(overlap, smaller // 2), count_tokens)
+            pending.extend((piece, smaller) for piece in reversed(pieces))
+        final_chunks = checked
+
+    # สร้าง enriched_content และ metadata สำหรับแต่ละ Chunk
+    chunks_with_meta = []
     for chunk_text in final_chunks:
-        enriched_content = f"จากหัวข้อ: {document_main_title}\n\n{chunk_text}"
+        enriched_content = header + chunk_text
         meta = metadata.copy()
         meta.update({"source_section": "เนื้อหาทั่วไป"})
         chunks_with_meta.append((enriched_content, meta))
 
-    return chunks_with_meta
\ No newline at end of file
+    return chunks_with_meta
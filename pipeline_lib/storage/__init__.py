@@ -1,8 +1,31 @@
 # pipeline_lib/storage/__init__.py
+import logging
+
 from .pgvector_store import PGVectorStore
 from .faiss_store import FaissStore
+from .sharded_faiss_store import ShardedFaissStore
+from .search import SearchEngine
+from .lexical_index import LexicalIndex, build_lexical_index
 
 STORAGE_REGISTRY = {
     'PGVECTOR': PGVectorStore,
     'FAISS': FaissStore
-}
\ No newline at end of file
+}
+
+def create_storage_adapter(store_config, conn, read_only=False):
+    """
+    Creates the vector store adapter selected by vector_store.type (None if unknown).
+    read_only opens a Faiss index memory-mapped for search-only processes.
+    """
+    store_type = store_config.get('type', 'PGVECTOR')
+    logging.info(f"Initializing vector store adapter: {store_type}")
+    storage_class = STORAGE_REGISTRY.get(store_type)
+
+    if store_type == 'PGVECTOR':
+        return storage_class(conn, store_config.get('pgvector', {}))
+    elif store_type == 'FAISS':
+        if store_config['faiss'].get('sharding', {}).get('shard_by'):
+            return ShardedFaissStore(store_config['faiss'], read_only=read_only)
+        return storage_class(store_config['faiss'], read_only=read_only)
+    logging.error(f"Unknown vector store type: {store_type}")
+    return None
\ No newline at end of file
@@ -0,0 +1,237 @@
+# pipeline_lib/storage/faiss_metadata.py
+import json
+import logging
+import mmap
+import os
+from collections import defaultdict
+import numpy as np
+
+# ตารางตำแหน่งของแต่ละ chunk (เรียงตาม faiss id) ชี้เข้าไปใน blob ของข้อความและ metadata
+ROW_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('document_id', '<i8'),
+    ('text_offset', '<i8'),
+    ('text_length', '<i4'),
+    ('meta_offset', '<i8'),
+    ('meta_length', '<i4'),
+])
+
+# ฟิลด์ระดับเอกสาร (มาจาก metadata ของ knowledge item) เก็บครั้งเดียวต่อเอกสาร; ฟิลด์อื่นเก็บกับแต่ละ chunk
+DOCUMENT_FIELDS = (
+    'document_id', 'document_title', 'tags', 'summary', 'category', 'source_path', 'page_number',
+    'document_type', 'case_number', 'effective_date', 'department', 'version', 'source_type',
+    'ingest_timestamp', 'chunking_strategy', 'custom_headers',
+)
+
+def _compact_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+class MetadataSidecar:
+    """
+    Record-offset metadata store that sits next to the Faiss index.
+
+    Layout of the directory:
+      chunks.<g>.npy      fixed-size rows (ROW_DTYPE), memory-mapped, sorted by faiss id
+      texts.<b>.bin       UTF-8 chunk texts, append-only
+      chunk_meta.<b>.bin  compact JSON of the per-chunk fields, append-only
+      documents.<g>.json  parent-level fields (title, tags, summary, category, ...) once per document
+      manifest.json       names the current files, next_id and blob bookkeeping
+
+    Reading one chunk is a binary search on the id column plus two slices of
+    memory-mapped blobs, so nothing is parsed until it is asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.next_id = 0
+        self.documents = {}                       # document_id -> parent-level fields
+        self.document_chunks = defaultdict(list)  # document_id -> [faiss id, ...]
+        self._rows = np.zeros(0, dtype=ROW_DTYPE)
+        self._texts = None
+        self._chunk_meta = None
+        self._dead_bytes = 0
+        self._manifest = None
+        self._pending = {}                        # faiss id -> (document_id, chunk_text, chunk fields)
+        self._deleted = set()
+        if self.exists():
+            self._open()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self._file("manifest.json"))
+
+    def _open(self):
+        with open(self._file("manifest.json"), 'r', encoding='utf-8') as f:
+            self._manifest = json.load(f)
+        self.next_id = self._manifest['next_id']
+        self._dead_bytes = self._manifest['dead_bytes']
+        with open(self._file(self._manifest['documents']), 'r', encoding='utf-8') as f:
+            self.documents = {doc_id: fields for doc_id, fields in json.load(f)}
+
+        rows_path = self._file(self._manifest['rows'])
+        self._rows = np.load(rows_path, mmap_mode='r') if self._manifest['num_rows'] else np.load(rows_path)
+        self._texts = self._mmap(self._file(self._manifest['texts']))
+        self._chunk_meta = self._mmap(self._file(self._manifest['chunk_meta']))
+
+        self.document_chunks = defaultdict(list)
+        for doc_id, faiss_id in zip(self._rows['document_id'].tolist(), self._rows['id'].tolist()):
+            self.document_chunks[doc_id].append(faiss_id)
+
+    @staticmethod
+    def _mmap(file_path):
+        # mmap ไม่รองรับไฟล์ว่าง
+        if os.path.getsize(file_path) == 0:
+            return b""
+        with open(file_path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._rows) - len(self._deleted) + len(self._pending)
+
+    def ids(self) -> np.ndarray:
+        """Returns the faiss ids of all live chunks in ascending order."""
+        stored = np.asarray(self._rows['id'])
+        if self._deleted:
+            stored = stored[~np.isin(stored, np.fromiter(self._deleted, dtype='int64'))]
+        return np.concatenate([stored, np.array(sorted(self._pending), dtype='int64')])
+
+    def get(self, faiss_id):
+        """Returns {"chunk_text", "metadata"} for one chunk, or None if it does not exist."""
+        faiss_id = int(faiss_id)
+        if faiss_id in self._pending:
+            doc_id, chunk_text, chunk_fields = self._pending[faiss_id]
+            return {"chunk_text": chunk_text, "metadata": dict(self.documents.get(doc_id, {}), **chunk_fields)}
+        if faiss_id in self._deleted:
+            return None
+
+        pos = int(np.searchsorted(self._rows['id'], faiss_id))
+        if pos >= len(self._rows) or self._rows['id'][pos] != faiss_id:
+            return None
+        row = self._rows[pos]
+        text_start, meta_start = int(row['text_offset']), int(row['meta_offset'])
+        chunk_text = self._texts[text_start:text_start + int(row['text_length'])].decode('utf-8')
+        chunk_fields = json.loads(self._chunk_meta[meta_start:meta_start + int(row['meta_length'])].decode('utf-8'))
+        return {"chunk_text": chunk_text, "metadata": dict(self.documents.get(int(row['document_id']), {}), **chunk_fields)}
+
+    def iter_records(self):
+        """Yields (faiss_id, record) for every live chunk."""
+        for faiss_id in self.ids().tolist():
+            yield faiss_id, self.get(faiss_id)
+
+    def add(self, ids, chunks_data: list):
+        """Registers new chunks; parent-level fields are split off and stored once per document."""
+        chunks_by_document = defaultdict(list)
+        for faiss_id, (item_id, chunk_text, _, _, metadata) in zip(ids, chunks_data):
+            chunks_by_document[item_id].append((int(faiss_id), chunk_text, metadata))
+
+        for doc_id, chunks in chunks_by_document.items():
+            first_meta = chunks[0][2]
+            document_fields = dict(self.documents.get(doc_id, {}),
+                                   **{key: value for key, value in first_meta.items() if key in DOCUMENT_FIELDS})
+            self.documents[doc_id] = document_fields
+            for faiss_id, chunk_text, metadata in chunks:
+                # ค่าที่ต่างจากของเอกสารเก็บไว้กับ chunk ด้วย (ค่าของ chunk มาก่อนตอนอ่าน)
+                chunk_fields = {key: value for key, value in metadata.items()
+                                if key not in document_fields or document_fields[key] != value}
+                self._pending[faiss_id] = (doc_id, chunk_text, chunk_fields)
+                self.document_chunks[doc_id].append(faiss_id)
+            self.next_id = max(self.next_id, max(faiss_id for faiss_id, _, _ in chunks) + 1)
+
+    def delete_documents(self, document_ids) -> list:
+        """Drops every chunk of the given documents and returns the removed faiss ids."""
+        removed = []
+        for doc_id in document_ids:
+            removed.extend(self.document_chunks.pop(doc_id, []))
+            self.documents.pop(doc_id, None)
+        for faiss_id in removed:
+            if self._pending.pop(faiss_id, None) is None:
+                self._deleted.add(faiss_id)
+        return removed
+
+    def persist(self):
+        """
+        Appends new chunks to the blobs and writes a new row table.
+
+        Every persist writes its files under a new generation number and then
+        atomically swaps manifest.json, so a crash at any point leaves the
+        previous generation readable. The blobs are rewritten only when more
+        than half of their bytes belong to deleted chunks.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        old_manifest = self._manifest
+        generation = old_manifest['generation'] + 1 if old_manifest else 0
+        blob_generation = old_manifest['blob_generation'] if old_manifest else 0
+        text_path = self._file(f"texts.{blob_generation}.bin")
+        meta_path = self._file(f"chunk_meta.{blob_generation}.bin")
+
+        rows = np.asarray(self._rows)
+        if self._deleted:
+            deleted = np.isin(rows['id'], np.fromiter(self._deleted, dtype='int64'))
+            self._dead_bytes += int(rows['text_length'][deleted].sum() + rows['meta_length'][deleted].sum())
+            rows = rows[~deleted]
+
+        # ต่อท้าย blob เดิม: ข้อมูลที่ต่อท้ายไม่กระทบตารางของ generation ก่อนหน้า
+        text_end = os.path.getsize(text_path) if os.path.exists(text_path) else 0
+        meta_end = os.path.getsize(meta_path) if os.path.exists(meta_path) else 0
+        new_rows = np.zeros(len(self._pending), dtype=ROW_DTYPE)
+        with open(text_path, 'ab') as text_file, open(meta_path, 'ab') as meta_file:
+            for i, faiss_id in enumerate(sorted(self._pending)):
+                doc_id, chunk_text, chunk_fields = self._pending[faiss_id]
+                text_bytes = chunk_text.encode('utf-8')
+                meta_bytes = _compact_json(chunk_fields).encode('utf-8')
+                new_rows[i] = (faiss_id, doc_id, text_end, len(text_bytes), meta_end, len(meta_bytes))
+                text_file.write(text_bytes)
+                meta_file.write(meta_bytes)
+                text_end += len(text_bytes)
+                meta_end += len(meta_bytes)
+        rows = np.concatenate([rows, new_rows])
+
+        if self._dead_bytes > text_end + meta_end - self._dead_bytes:
+            blob_generation = generation
+            rows = self._compact(rows, text_path, meta_path, blob_generation)
+
+        manifest = {
+            "format_version": 1,
+            "next_id": self.next_id,
+            "dead_bytes": self._dead_bytes,
+            "generation": generation,
+            "blob_generation": blob_generation,
+            "num_rows": len(rows),
+            "rows": f"chunks.{generation}.npy",
+            "documents": f"documents.{generation}.json",
+            "texts": f"texts.{blob_generation}.bin",
+            "chunk_meta": f"chunk_meta.{blob_generation}.bin",
+        }
+        np.save(self._file(manifest['rows']), rows)
+        with open(self._file(manifest['documents']), 'w', encoding='utf-8') as f:
+            f.write(_compact_json([[doc_id, fields] for doc_id, fields in self.documents.items()]))
+        with open(self._file("manifest.json.tmp"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(self._file("manifest.json.tmp"), self._file("manifest.json"))
+
+        # ลบไฟล์ของ generation ก่อนหน้าที่ไม่ได้ใช้แล้ว
+        if old_manifest:
+            for key in ('rows', 'documents', 'texts', 'chunk_meta'):
+                if old_manifest[key] != manifest[key]:
+                    os.remove(self._file(old_manifest[key]))
+
+        self._pending, self._deleted = {}, set()
+        self._open()
+
+    def _compact(self, rows, text_path, meta_path, blob_generation):
+        logging.info(f"Compacting Faiss metadata blobs ({self._dead_bytes} dead bytes)...")
+        texts, chunk_meta = self._mmap(text_path), self._mmap(meta_path)
+        with open(self._file(f"texts.{blob_generation}.bin"), 'wb') as text_file, \
+             open(self._file(f"chunk_meta.{blob_generation}.bin"), 'wb') as meta_file:
+            for row in rows:
+                text_start, meta_start = int(row['text_offset']), int(row['meta_offset'])
+                text_file.write(texts[text_start:text_start + int(row['text_length'])])
+                meta_file.write(chunk_meta[meta_start:meta_start + int(row['meta_length'])])
+
+        compacted = rows.copy()
+        compacted['text_offset'] = np.concatenate([[0], np.cumsum(rows['text_length'], dtype='int64')[:-1]])
+        compacted['meta_offset'] = np.concatenate([[0], np.cumsum(rows['meta_length'], dtype='int64')[:-1]])
+        self._dead_bytes = 0
+        return compacted
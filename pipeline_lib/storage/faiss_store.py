@@ -5,44 +5,452 @@ import json
 import logging
 import os
 
+from .faiss_metadata import MetadataSidecar
+from .search import normalize_filters, matches_filters, make_hit, as_query_matrix
+
+# ขั้นต่ำของจำนวน vector ที่ใช้ train ต่อ 1 centroid (ตามคำแนะนำของ Faiss)
+MIN_POINTS_PER_CENTROID = 39
+
+# ความละเอียดของ vector ที่เก็บใน index -> codec ของ index_factory (bytes ต่อ vector 1024 มิติ)
+PRECISION_CODECS = {
+    'FLOAT32': 'Flat',    # 4096 bytes
+    'FLOAT16': 'SQfp16',  # 2048 bytes
+    'SQ8': 'SQ8',         # 1024 bytes (ต้อง train หาช่วงค่าของแต่ละมิติ)
+}
+
+# เปิดแบบอ่านอย่างเดียว: map ไฟล์ index เข้าหน่วยความจำแทนการอ่านทั้งไฟล์ (ใช้ page cache ร่วมกันได้หลาย process)
+# IO_FLAG_MMAP_IFC (Faiss >= 1.9) map ได้ทุกชนิด index; รุ่นเก่ากว่า map ได้เฉพาะ inverted list ของ IVF
+MMAP_READ_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# PQ{m}x{nbits} ต้องมีตัวอย่างสำหรับ train อย่างน้อย 2**nbits ตัว; ต่ำกว่า 2**PQ_MIN_NBITS ใช้ IVF_FLAT แทน
+PQ_MIN_NBITS = 4
+
+# จำนวน vector ที่รอไว้ train SQ8 (หาค่า min/max ของแต่ละมิติ) ก่อนเริ่มเพิ่มลง index
+SQ_MIN_TRAIN_SIZE = 10000
+
+def index_factory_string(faiss_config, n_train=None):
+    """Builds the Faiss index_factory string for the configured index type."""
+    index_type = faiss_config.get('index_type', 'FLAT')
+    nlist = faiss_config.get('nlist', 1024)
+    if n_train is not None and index_type in ('IVF_FLAT', 'IVF_PQ'):
+        # ถ้าข้อมูลสำหรับ train มีน้อย ให้ลดจำนวน cluster ลงเพื่อให้ train ได้
+        max_nlist = max(1, n_train // MIN_POINTS_PER_CENTROID)
+        if nlist > max_nlist:
+            logging.warning(f"Only {n_train} training vectors; reducing nlist from {nlist} to {max_nlist}.")
+            nlist = max_nlist
+
+    precision = faiss_config.get('precision', 'FLOAT32')
+    codec = PRECISION_CODECS.get(precision)
+    if codec is None:
+        raise ValueError(f"Unknown Faiss precision: {precision}")
+
+    if index_type == 'FLAT':
+        return codec
+    if index_type == 'IVF_FLAT':
+        return f"IVF{nlist},{codec}"
+    if index_type == 'IVF_PQ':
+        pq_nbits = faiss_config.get('pq_nbits', 8)
+        if n_train is not None and n_train < 2 ** pq_nbits:
+            max_nbits = n_train.bit_length() - 1
+            if max_nbits < PQ_MIN_NBITS:
+                logging.warning(f"Only {n_train} training vectors; too few for PQ, using IVF{nlist},{codec} instead.")
+                return f"IVF{nlist},{codec}"
+            logging.warning(f"Only {n_train} training vectors; reducing pq_nbits from {pq_nbits} to {max_nbits}.")
+            pq_nbits = max_nbits
+        # PQ บีบอัด vector อยู่แล้ว precision จึงไม่มีผล
+        return f"IVF{nlist},PQ{faiss_config.get('pq_m', 64)}x{pq_nbits}"
+    if index_type == 'HNSW':
+        return f"HNSW{faiss_config.get('hnsw_m', 32)},{codec}"
+    raise ValueError(f"Unknown Faiss index type: {index_type}")
+
+def build_binary_index(faiss_config, embedding_dim):
+    """
+    Binary codes with float rescoring: one sign bit per dimension (128 bytes for
+    1024 dims) is scanned by Hamming distance for rescore_factor x k candidates,
+    which are then re-ranked by inner product on the binary_rescore codes.
+    """
+    if faiss_config.get('index_type', 'FLAT') != 'FLAT':
+        raise ValueError("BINARY precision is only supported with index_type FLAT.")
+    binary = faiss.IndexLSH(embedding_dim, embedding_dim, False, False)
+    # IndexRefine ต้องการ metric เดียวกัน; LSH จัดอันดับด้วย Hamming distance อยู่แล้วไม่ว่า metric จะเป็นอะไร
+    binary.metric_type = faiss.METRIC_INNER_PRODUCT
+    rescore_codec = PRECISION_CODECS[faiss_config.get('binary_rescore', 'FLOAT16')]
+    rescore = faiss.index_factory(embedding_dim, rescore_codec, faiss.METRIC_INNER_PRODUCT)
+    index = faiss.IndexRefine(binary, rescore)
+    index.k_factor = faiss_config.get('rescore_factor', 10)
+    return index
+
+def build_index(faiss_config, embedding_dim, n_train=None):
+    """Creates an empty index of the configured type that stores vectors under chunk IDs."""
+    if faiss_config.get('precision', 'FLOAT32') == 'BINARY':
+        return faiss.IndexIDMap2(build_binary_index(faiss_config, embedding_dim))
+    factory = index_factory_string(faiss_config, n_train)
+    base_index = faiss.index_factory(embedding_dim, factory, faiss.METRIC_INNER_PRODUCT) # IP (Inner Product) for BGE-m3
+    if isinstance(base_index, faiss.IndexIVF):
+        # IVF เก็บ ID ใน inverted list เองอยู่แล้ว; direct map แบบ hashtable ทำให้ reconstruct และลบตาม ID ได้
+        base_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return base_index
+    if isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efConstruction = faiss_config.get('ef_construction', 200)
+    # IDMap2 ทำให้แต่ละ vector มี ID ถาวร (ลบ/แทนที่ได้) และ reconstruct ได้
+    return faiss.IndexIDMap2(base_index)
+
+def unwrap_ivf(index):
+    """
+    Converts an IDMap2-wrapped IVF index, as written by earlier versions, into a
+    plain IVF index whose inverted lists hold the chunk IDs instead of positions.
+    """
+    ivf = faiss.downcast_index(index.index)
+    id_map = faiss.vector_to_array(index.id_map)
+    invlists = ivf.invlists
+    for list_no in range(ivf.nlist):
+        list_size = invlists.list_size(list_no)
+        if list_size:
+            positions = faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size).copy()
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), list_size * invlists.code_size).copy()
+            chunk_ids = np.ascontiguousarray(id_map[positions])
+            invlists.update_entries(list_no, 0, list_size, faiss.swig_ptr(chunk_ids), faiss.swig_ptr(codes))
+    # สำเนาที่ไม่ผูกกับ IDMap2 (IDMap2 เป็นเจ้าของ index ข้างใน และจะลบทิ้งเมื่อตัวเองถูกลบ)
+    ivf = faiss.clone_index(ivf)
+    ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return ivf
+
+def apply_search_params(index, faiss_config):
+    """Sets the query-time knobs (nprobe / efSearch) on an index."""
+    base_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base_index, faiss.IndexIVF):
+        base_index.nprobe = faiss_config.get('nprobe', 16)
+    elif isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efSearch = faiss_config.get('ef_search', 64)
+    elif isinstance(base_index, faiss.IndexRefine):
+        base_index.k_factor = faiss_config.get('rescore_factor', 10)
+
+def search_parameters(index, faiss_config, selector):
+    """Per-query parameters that restrict the search to the ids accepted by selector."""
+    base_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base_index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=faiss_config.get('nprobe', 16))
+    if isinstance(base_index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=faiss_config.get('ef_search', 64))
+    return faiss.SearchParameters(sel=selector)
+
 class FaissStore:
-    def __init__(self, config, embedding_dim=1024):
+    """
+    Faiss index plus its metadata sidecar.
+
+    With read_only=True the index file is memory-mapped instead of read into
+    RAM, like the sidecar already is. Processes that open the same files share
+    the page cache, and the first search runs as soon as the headers are read.
+    A read-only store cannot be modified: writing into a mapped index would
+    abort the process, so add / delete / persist raise instead.
+    """
+
+    def __init__(self, config, embedding_dim=1024, read_only=False):
+        self.config = config
+        self.read_only = read_only
         self.index_path = config['index_path']
-        self.metadata_path = config['metadata_path']
+        # metadata_path คือ directory ของ sidecar; ไฟล์ .json แบบเก่าจะถูกแปลงให้อัตโนมัติ
+        metadata_path = config['metadata_path']
+        if metadata_path.endswith('.json'):
+            self.metadata_path, self.legacy_metadata_path = os.path.splitext(metadata_path)[0], metadata_path
+        else:
+            self.metadata_path, self.legacy_metadata_path = metadata_path, metadata_path + '.json'
         self.embedding_dim = embedding_dim
-        self.vectors = []
-        self.metadata_list = []
-        logging.info("FaissStore Adapter initialized.")
+        self.index = None
+        self._pending_vectors = []              # vectors waiting for the index to be trained
+        self._pending_ids = []
+        self.sidecar = MetadataSidecar(self.metadata_path)
+        self._dirty = False
+        self._load()
+        mode = " (read-only, memory-mapped)" if read_only else ""
+        logging.info(f"FaissStore Adapter initialized with {len(self.sidecar)} existing chunks{mode}.")
+
+    def _new_index(self, n_train=None):
+        index = build_index(self.config, self.embedding_dim, n_train)
+        apply_search_params(index, self.config)
+        return index
+
+    def _base_index(self):
+        return faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+
+    @property
+    def next_id(self):
+        return self.sidecar.next_id
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"Faiss index {self.index_path} is opened read-only.")
+
+    def _load(self):
+        """Loads the existing index and metadata so new chunks are appended, not overwritten."""
+        if self.read_only:
+            if not os.path.exists(self.index_path) or not self.sidecar.exists():
+                raise FileNotFoundError(f"No Faiss index with a metadata sidecar at {self.index_path} / {self.metadata_path}; "
+                                        f"run main_index.py first (it also migrates legacy metadata).")
+            logging.info(f"Memory-mapping Faiss index {self.index_path} (read-only)...")
+            self.index = faiss.read_index(self.index_path, MMAP_READ_FLAGS)
+            apply_search_params(self.index, self.config)
+            return
+
+        has_legacy = os.path.exists(self.legacy_metadata_path)
+        if not os.path.exists(self.index_path) or not (self.sidecar.exists() or has_legacy):
+            self.index = self._new_index()
+            return
+
+        logging.info(f"Loading existing Faiss index from {self.index_path}...")
+        index = faiss.read_index(self.index_path)
+        if isinstance(index, faiss.IndexIDMap) and isinstance(faiss.downcast_index(index.index), faiss.IndexIVF):
+            logging.info("Converting ID-mapped IVF index to native IVF ids...")
+            index = unwrap_ivf(index)
+            self._dirty = True
+        if self.sidecar.exists():
+            self.index = index
+            apply_search_params(self.index, self.config)
+            return
+
+        logging.info(f"Migrating legacy metadata {self.legacy_metadata_path} to sidecar {self.metadata_path}...")
+        with open(self.legacy_metadata_path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+
+        if isinstance(stored, list):
+            # รูปแบบเก่าสุด: list ของ record เรียงตามลำดับใน IndexFlatIP (ID = ตำแหน่ง)
+            records = [dict(record, id=i) for i, record in enumerate(stored)]
+            self.index = self._new_index()
+            if index.ntotal:
+                self._pending_vectors.append(index.reconstruct_n(0, index.ntotal))
+                self._pending_ids.append(np.arange(index.ntotal, dtype='int64'))
+        else:
+            records = stored['records']
+            self.index = index
+            apply_search_params(self.index, self.config)
+
+        self.sidecar.add(
+            [record['id'] for record in records],
+            [(record['metadata'].get('document_id'), record['chunk_text'], None, None, record['metadata']) for record in records]
+        )
+        if not isinstance(stored, list):
+            self.sidecar.next_id = max(self.sidecar.next_id, stored['next_id'])
+        self._dirty = True
+
+    def indexed_document_ids(self) -> set:
+        """Returns the IDs of all documents that already have chunks in the index."""
+        return {doc_id for doc_id, ids in self.sidecar.document_chunks.items() if ids}
 
     def add(self, chunks_data: list):
-        """Adds a list of chunks to the in-memory store."""
-        logging.info(f"Adding {len(chunks_data)} chunks to Faiss in-memory store...")
-        for _, chunk_text, _, embedding, metadata in chunks_data:
-            self.vectors.append(embedding)
-            self.metadata_list.append({
-                "chunk_text": chunk_text,
-                "metadata": metadata
-            })
-
-    def persist(self):
-        """Builds and saves the Faiss index and metadata to files."""
-        if not self.vectors:
-            logging.warning("No vectors to persist for Faiss index.")
+        """Appends a list of chunks to the index under new, stable chunk IDs."""
+        self._check_writable()
+        if not chunks_data:
+            return
+        logging.info(f"Adding {len(chunks_data)} chunks to Faiss index...")
+        ids = np.arange(self.next_id, self.next_id + len(chunks_data), dtype='int64')
+        embeddings_np = np.array([embedding for _, _, _, embedding, _ in chunks_data]).astype('float32')
+        if self._pending_ids or not self._base_index().is_trained:
+            # IVF / SQ8 ต้อง train ก่อน: เก็บไว้ก่อนแล้วค่อย train ตอน persist() จากตัวอย่างที่สะสมไว้
+            # (ถ้า index ไม่ได้เก็บ float32 อยู่แล้ว ก็เก็บ buffer เป็น float16 ให้ใช้หน่วยความจำครึ่งเดียว)
+            if self.config.get('precision', 'FLOAT32') != 'FLOAT32':
+                embeddings_np = embeddings_np.astype('float16')
+            self._pending_vectors.append(embeddings_np)
+            self._pending_ids.append(ids)
+        else:
+            self.index.add_with_ids(embeddings_np, ids)
+
+        self.sidecar.add(ids.tolist(), chunks_data)
+        self._dirty = True
+
+    def delete_documents(self, document_ids):
+        """Removes every chunk belonging to the given document IDs."""
+        self._check_writable()
+        ids_to_remove = self.sidecar.delete_documents(document_ids)
+        if not ids_to_remove:
+            return 0
+
+        self._flush_pending()
+        if isinstance(self._base_index(), (faiss.IndexHNSW, faiss.IndexRefine)):
+            self._rebuild_without(ids_to_remove)
+        else:
+            self.index.remove_ids(np.array(ids_to_remove, dtype='int64'))
+        self._dirty = True
+        logging.info(f"Removed {len(ids_to_remove)} chunks of {len(document_ids)} documents from Faiss index.")
+        return len(ids_to_remove)
+
+    def _rebuild_without(self, ids_to_remove):
+        # HNSW (และ binary + rescoring) ลบ vector ไม่ได้ จึงต้องสร้าง index ใหม่จาก vector ที่เหลือ
+        all_ids = faiss.vector_to_array(self.index.id_map)
+        keep = ~np.isin(all_ids, np.array(ids_to_remove, dtype='int64'))
+        vectors = self._base_index().reconstruct_n(0, self.index.ntotal)[keep]
+        self.index = self._new_index()
+        if len(vectors):
+            # SQ8 ต้อง train ใหม่ ให้ _flush_pending จัดการเหมือนตอนเพิ่มครั้งแรก
+            self._pending_vectors, self._pending_ids = [vectors], [all_ids[keep]]
+            self._flush_pending()
+
+    def _flush_pending(self):
+        """Trains the index on a sample of the buffered vectors (if needed) and adds them."""
+        if not self._pending_ids:
             return
+        vectors = np.vstack(self._pending_vectors).astype('float32')
+        ids = np.concatenate(self._pending_ids)
+        self._pending_vectors, self._pending_ids = [], []
+
+        if not self._base_index().is_trained:
+            sample_size = min(len(vectors), self.config.get('train_sample_size', 100000))
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+            self.index = self._new_index(n_train=sample_size)
+            logging.info(f"Training {self.config.get('index_type')} index on {sample_size} vectors...")
+            self.index.train(sample)
+        self.index.add_with_ids(vectors, ids)
+
+    def replace_documents(self, chunks_data: list, document_ids=()):
+        """
+        Replaces all chunks of the documents present in chunks_data (and of
+        document_ids, e.g. documents that no longer produce any chunk) with the new ones.
+        """
+        self.delete_documents(set(document_ids) | {item_id for item_id, _, _, _, _ in chunks_data})
+        self.add(chunks_data)
+
+    def describe(self) -> str:
+        """One line about the index, e.g. for the inspector."""
+        return f"{type(self._base_index()).__name__}, {self.index.ntotal} vectors"
+
+    def iter_documents(self):
+        """Yields (document_id, document-level fields, chunk ids) for every indexed document."""
+        for doc_id, chunk_ids in self.sidecar.document_chunks.items():
+            if chunk_ids:
+                yield doc_id, self.sidecar.documents.get(doc_id, {}), list(chunk_ids)
+
+    def all_chunk_ids(self) -> np.ndarray:
+        """The ids of all live chunks in ascending order."""
+        return self.sidecar.ids()
+
+    def reconstruct_vectors(self, chunk_ids):
+        """The stored float32 vectors of the given chunk ids, or None if the index keeps them compressed."""
+        if not isinstance(self._base_index(), (faiss.IndexFlat, faiss.IndexHNSWFlat, faiss.IndexIVFFlat)):
+            return None
+        return np.vstack([self.index.reconstruct(int(chunk_id)) for chunk_id in chunk_ids])
+
+    def iter_chunks(self):
+        """Yields (chunk_id, chunk_text, metadata) for every live chunk, e.g. to build a lexical index."""
+        for faiss_id, record in self.sidecar.iter_records():
+            yield faiss_id, record['chunk_text'], record['metadata']
+
+    def fetch_chunks(self, chunk_ids) -> dict:
+        """Returns {chunk_id: hit} (score 0) for the given chunk ids that exist."""
+        hits = {}
+        for faiss_id in chunk_ids:
+            record = self.sidecar.get(faiss_id)
+            if record:
+                hits[int(faiss_id)] = make_hit(int(faiss_id), record['metadata'].get('document_id'), 0.0,
+                                               record['chunk_text'], record['metadata'])
+        return hits
+
+    def search(self, query_vectors, k=10, filters=None, chunk_ids=None) -> list:
+        """
+        Returns the top-k chunks for each query vector.
+        Filters are evaluated on the per-document metadata first, and only the
+        chunks of matching documents are searched. chunk_ids restricts the search
+        to a candidate set (e.g. from the lexical index), which is scored exactly.
+        """
+        queries = as_query_matrix(query_vectors)
+        filters = normalize_filters(filters)
+        params = None
+        if filters or chunk_ids is not None:
+            allowed_ids = None
+            if filters:
+                allowed_ids = np.array([
+                    faiss_id
+                    for doc_id, fields in self.sidecar.documents.items() if matches_filters(fields, filters)
+                    for faiss_id in self.sidecar.document_chunks.get(doc_id, [])
+                ], dtype='int64')
+            if chunk_ids is not None:
+                candidates = np.asarray(chunk_ids, dtype='int64')
+                allowed_ids = candidates if allowed_ids is None else np.intersect1d(allowed_ids, candidates)
+            allowed_ids = np.unique(allowed_ids)
+            if not len(allowed_ids):
+                return [[] for _ in range(len(queries))]
+            base_index = self._base_index()
+            # binary index: ขั้น Hamming ไม่สนใจ ID selector; candidate set: ให้คะแนนตรงๆ ถูกกว่าค้นทั้ง index
+            if isinstance(base_index, faiss.IndexRefine) or (chunk_ids is not None and not isinstance(base_index, faiss.IndexIVF)):
+                scores, labels = self._score_exact(queries, allowed_ids, k)
+                return self._hits(scores, labels)
+            selector = faiss.IDSelectorBatch(allowed_ids)
+            params = search_parameters(self.index, self.config, selector)
+
+        scores, labels = self.index.search(queries, k, params=params)
+        return self._hits(scores, labels)
+
+    def _score_exact(self, queries, allowed_ids, k):
+        """
+        Scores the allowed chunks directly on their stored codes (the rescoring
+        codes of the binary index) and returns the top-k as Faiss (scores, labels).
+        """
+        # id_map เรียงจากน้อยไปมากเสมอ (ID เพิ่มขึ้นเรื่อยๆ และการลบใช้การสร้างใหม่ตามลำดับเดิม)
+        id_map = faiss.vector_to_array(self.index.id_map)
+        allowed_ids = allowed_ids[np.isin(allowed_ids, id_map)]
+        positions = np.searchsorted(id_map, allowed_ids)
+        base_index = self._base_index()
+        codes = base_index.refine_index if isinstance(base_index, faiss.IndexRefine) else base_index
+        vectors = codes.reconstruct_batch(positions)
+        scores = queries @ vectors.T
+        k = min(k, len(allowed_ids))
+        top = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(scores, top, axis=1), allowed_ids[top]
+
+    def _hits(self, scores, labels):
+        """Turns Faiss (scores, labels) arrays into hit dicts, one list per query."""
+        results = []
+        for query_scores, query_labels in zip(scores, labels):
+            hits = []
+            for score, faiss_id in zip(query_scores, query_labels):
+                record = self.sidecar.get(faiss_id) if faiss_id != -1 else None
+                if record:
+                    hits.append(make_hit(int(faiss_id), record['metadata'].get('document_id'), score,
+                                         record['chunk_text'], record['metadata']))
+            results.append(hits)
+        return results
+
+    def _min_train_size(self):
+        """Number of buffered vectors worth waiting for before training an IVF / SQ8 index."""
+        if self.config.get('index_type', 'FLAT') not in ('IVF_FLAT', 'IVF_PQ'):
+            sq8 = self.config.get('precision') == 'SQ8' or (
+                self.config.get('precision') == 'BINARY' and self.config.get('binary_rescore') == 'SQ8')
+            return min(self.config.get('train_sample_size', 100000), SQ_MIN_TRAIN_SIZE) if sq8 else 0
+        return min(self.config.get('train_sample_size', 100000), self.config.get('nlist', 1024) * MIN_POINTS_PER_CENTROID)
+
+    def persist(self, final=True):
+        """
+        Saves the Faiss index and metadata to files.
+        Intermediate (final=False) flushes of an untrained IVF index are deferred
+        until enough vectors have been buffered to train it properly; returns
+        False in that case, and True once every change is on disk.
+        """
+        self._check_writable()
+        if not self._dirty:
+            logging.info("Faiss index has no changes to persist.")
+            return True
+
+        buffered = sum(len(ids) for ids in self._pending_ids)
+        if not final and not self._base_index().is_trained and buffered < self._min_train_size():
+            logging.info(f"Deferring Faiss training until {self._min_train_size()} vectors are buffered ({buffered} so far).")
+            return False
+
+        self._flush_pending()
+        logging.info(f"Persisting Faiss index ({self.index.ntotal} vectors) to {self.index_path}...")
 
-        logging.info(f"Persisting Faiss index to {self.index_path}...")
-        
         # สร้าง Directory ถ้ายังไม่มี
         os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
 
-        # 1. สร้างและบันทึก Faiss Index
-        embeddings_np = np.array(self.vectors).astype('float32')
-        index = faiss.IndexFlatIP(self.embedding_dim) # IP (Inner Product) for BGE-m3
-        index.add(embeddings_np)
-        faiss.write_index(index, self.index_path)
-
-        # 2. บันทึก Metadata ที่คู่กัน
-        with open(self.metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(self.metadata_list, f, ensure_ascii=False, indent=4)
-        
-        logging.info("Successfully persisted Faiss index and metadata.")
\ No newline at end of file
+        # 1. บันทึก Faiss Index (เขียนไฟล์ชั่วคราวก่อน แล้วค่อยสลับ เพื่อไม่ให้ไฟล์เสียถ้าโปรแกรมล่มกลางทาง)
+        tmp_index_path = self.index_path + ".tmp"
+        faiss.write_index(self.index, tmp_index_path)
+
+        os.replace(tmp_index_path, self.index_path)
+
+        # 2. บันทึก Metadata ที่คู่กัน (sidecar แบบ append-only)
+        self.sidecar.persist()
+        if os.path.exists(self.legacy_metadata_path):
+            os.remove(self.legacy_metadata_path)
+        self._dirty = False
+
+        logging.info("Successfully persisted Faiss index and metadata.")
+        return True
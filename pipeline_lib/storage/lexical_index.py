@@ -0,0 +1,255 @@
+# pipeline_lib/storage/lexical_index.py
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from pythainlp.tokenize import word_tokenize
+except ImportError:
+    word_tokenize = None
+
+# ส่วนของข้อความที่ตัดคำแยกกัน: ภาษาไทย / ตัวอักษรละตินและตัวเลข (ที่เหลือเป็นเครื่องหมาย ไม่นำมา index)
+_THAI_RUN = r'[\u0E00-\u0E7F]+'
+_TOKEN_RUNS = re.compile(rf'({_THAI_RUN})|([^\W_\u0E00-\u0E7F]+)')
+# สระบน/ล่าง วรรณยุกต์ และเครื่องหมายที่ต้องติดกับพยัญชนะตัวหน้า (ไม่แยกเป็นหน่วยของตัวเอง)
+_THAI_COMBINING = re.compile(r'.[\u0E31\u0E34-\u0E3A\u0E47-\u0E4E]*', re.S)
+
+TOKENIZERS = ('newmm', 'bigram')
+
+def default_tokenizer() -> str:
+    """'newmm' (PyThaiNLP dictionary segmentation) when PyThaiNLP is installed, otherwise 'bigram'."""
+    return 'newmm' if word_tokenize is not None else 'bigram'
+
+def _thai_bigrams(run):
+    clusters = _THAI_COMBINING.findall(run)
+    if len(clusters) < 2:
+        return ["".join(clusters)]
+    return [clusters[i] + clusters[i + 1] for i in range(len(clusters) - 1)]
+
+def tokenize(text, tokenizer='bigram') -> list:
+    """
+    Lexical terms of a text. Latin words and numbers are lowercased; Thai runs are
+    segmented into words with PyThaiNLP ('newmm') or, without a dictionary, into
+    overlapping pairs of character clusters ('bigram'), so that an exact phrase such
+    as 'ค่าธรรมเนียม' still matches as a sequence of terms.
+    """
+    text = unicodedata.normalize('NFC', text)
+    terms = []
+    for thai, other in _TOKEN_RUNS.findall(text):
+        if other:
+            terms.append(other.lower())
+        elif tokenizer == 'newmm':
+            terms.extend(word for word in word_tokenize(thai, engine='newmm', keep_whitespace=False) if word.strip())
+        else:
+            terms.extend(_thai_bigrams(thai))
+    return terms
+
+def _term_counts(args):
+    text, tokenizer = args
+    return Counter(tokenize(text, tokenizer))
+
+class LexicalIndex:
+    """
+    BM25 inverted index over chunk texts, stored as compact arrays.
+
+    Layout of the directory:
+      manifest.json     tokenizer, BM25 parameters, sizes
+      vocabulary.json   terms, in term-id order
+      offsets.npy       int64[V + 1]: postings of term t are rows offsets[t]:offsets[t + 1]
+      postings.npy      int32 row numbers, sorted by term
+      frequencies.npy   uint16 term frequency of each posting
+      chunk_ids.npy     int64 chunk id of each row (the id returned by the vector store)
+      lengths.npy       int32 number of terms of each row
+
+    The arrays are memory-mapped on load; a query only reads the postings of its terms.
+    """
+
+    def __init__(self, path, manifest, vocabulary, arrays):
+        self.path = path
+        self.tokenizer = manifest['tokenizer']
+        self.k1 = manifest['k1']
+        self.b = manifest['b']
+        self.avg_length = manifest['avg_length']
+        self.vocabulary = vocabulary
+        self.offsets = arrays['offsets']
+        self.postings = arrays['postings']
+        self.frequencies = arrays['frequencies']
+        self.chunk_ids = arrays['chunk_ids']
+        self.lengths = arrays['lengths']
+        if self.tokenizer == 'newmm' and word_tokenize is None:
+            raise ImportError(f"Lexical index {path} was built with PyThaiNLP (newmm); install pythainlp to query it.")
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    @classmethod
+    def build(cls, path, chunks, tokenizer=None, k1=1.2, b=0.75, workers=0, batch_size=2000):
+        """
+        Builds the index from (chunk_id, text) pairs, writes it to path and returns it.
+        Tokenization runs in a process pool of `workers` processes (inline when 0).
+        """
+        tokenizer = tokenizer or default_tokenizer()
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown lexical tokenizer: {tokenizer}. Supported: {list(TOKENIZERS)}")
+        if tokenizer == 'newmm' and word_tokenize is None:
+            raise ImportError("Tokenizer 'newmm' needs pythainlp; install it or use 'bigram'.")
+
+        start = time.perf_counter()
+        vocabulary = {}
+        chunk_ids, lengths = array('q'), array('i')
+        term_ids, rows, frequencies = array('i'), array('i'), array('H')
+
+        def consume(batch_ids, counts_list):
+            for chunk_id, counts in zip(batch_ids, counts_list):
+                row = len(chunk_ids)
+                chunk_ids.append(chunk_id)
+                lengths.append(sum(counts.values()))
+                for term, count in counts.items():
+                    term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                    rows.append(row)
+                    frequencies.append(min(count, 65535))
+
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) if workers else None
+        try:
+            batch_ids, batch_texts = [], []
+            for chunk_id, text in chunks:
+                if not text:
+                    continue
+                batch_ids.append(chunk_id)
+                batch_texts.append(text)
+                if len(batch_ids) >= batch_size:
+                    consume(batch_ids, cls._count_terms(pool, batch_texts, tokenizer))
+                    batch_ids, batch_texts = [], []
+            if batch_ids:
+                consume(batch_ids, cls._count_terms(pool, batch_texts, tokenizer))
+        finally:
+            if pool:
+                pool.shutdown()
+
+        term_ids = np.frombuffer(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind='stable')
+        arrays = {
+            'offsets': np.concatenate(([0], np.cumsum(np.bincount(term_ids, minlength=len(vocabulary))))).astype(np.int64),
+            'postings': np.frombuffer(rows, dtype=np.int32)[order],
+            'frequencies': np.frombuffer(frequencies, dtype=np.uint16)[order],
+            'chunk_ids': np.frombuffer(chunk_ids, dtype=np.int64).copy(),
+            'lengths': np.frombuffer(lengths, dtype=np.int32).copy(),
+        }
+        manifest = {
+            "tokenizer": tokenizer, "k1": k1, "b": b,
+            "avg_length": float(arrays['lengths'].mean()) if len(chunk_ids) else 0.0,
+            "num_chunks": len(chunk_ids), "num_terms": len(vocabulary), "num_postings": len(term_ids),
+        }
+        terms = sorted(vocabulary, key=vocabulary.get)
+        cls._write(path, manifest, terms, arrays)
+        logging.info(f"Built lexical index ({tokenizer}) of {len(chunk_ids)} chunks, {len(vocabulary)} terms, "
+                     f"{len(term_ids)} postings in {time.perf_counter() - start:.1f}s.")
+        return cls(path, manifest, vocabulary, arrays)
+
+    @staticmethod
+    def _count_terms(pool, texts, tokenizer):
+        tasks = [(text, tokenizer) for text in texts]
+        if pool is None:
+            return [_term_counts(task) for task in tasks]
+        return list(pool.map(_term_counts, tasks, chunksize=64))
+
+    @staticmethod
+    def _write(path, manifest, terms, arrays):
+        # เขียนลง directory ชั่วคราวก่อนแล้วค่อยสลับ เพื่อไม่ให้ reader เห็นไฟล์ที่เขียนไม่เสร็จ
+        tmp_path = path.rstrip(os.sep) + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+        with open(os.path.join(tmp_path, "vocabulary.json"), 'w', encoding='utf-8') as f:
+            json.dump(terms, f, ensure_ascii=False)
+        with open(os.path.join(tmp_path, "manifest.json"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        if os.path.exists(path):
+            old_path = path.rstrip(os.sep) + ".old"
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            for name in os.listdir(old_path):
+                os.remove(os.path.join(old_path, name))
+            os.rmdir(old_path)
+        else:
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Opens a built index with its arrays memory-mapped (None if there is none at path)."""
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            return None
+        with open(os.path.join(path, "manifest.json"), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        with open(os.path.join(path, "vocabulary.json"), 'r', encoding='utf-8') as f:
+            vocabulary = {term: term_id for term_id, term in enumerate(json.load(f))}
+        arrays = {}
+        for name in ('offsets', 'postings', 'frequencies', 'chunk_ids', 'lengths'):
+            file_path = os.path.join(path, f"{name}.npy")
+            # np.load mmap ไม่รองรับไฟล์ที่ไม่มีข้อมูล
+            arrays[name] = np.load(file_path, mmap_mode='r') if manifest['num_chunks'] else np.load(file_path)
+        logging.info(f"Loaded lexical index {path}: {manifest['num_chunks']} chunks, {manifest['num_terms']} terms.")
+        return cls(path, manifest, vocabulary, arrays)
+
+    def search(self, query, k=100):
+        """Returns (chunk_ids, scores) of the top-k chunks for a query text by BM25, best first."""
+        term_ids = {self.vocabulary[term] for term in tokenize(query, self.tokenizer) if term in self.vocabulary}
+        if not term_ids or not len(self):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        num_chunks = len(self)
+        rows, contributions = [], []
+        for term_id in term_ids:
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            term_rows = np.asarray(self.postings[start:end])
+            tf = np.asarray(self.frequencies[start:end], dtype=np.float32)
+            idf = np.log(1.0 + (num_chunks - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * np.asarray(self.lengths[term_rows]) / self.avg_length)
+            rows.append(term_rows)
+            contributions.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+
+        # รวมคะแนนเฉพาะ chunk ที่มีคำใน query (ไม่ต้องสร้าง array ขนาดเท่าจำนวน chunk ทั้งหมด)
+        matched, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return np.asarray(self.chunk_ids[matched[top]]), scores[top]
+
+
+def lexical_text(chunk_text, metadata, fields) -> str:
+    """The text indexed for a chunk: its own text plus the listed metadata fields (e.g. title, LLM tags)."""
+    parts = [chunk_text]
+    for field in fields:
+        value = metadata.get(field)
+        if isinstance(value, list):
+            parts.extend(str(item) for item in value)
+        elif value:
+            parts.append(str(value))
+    return "\n".join(parts)
+
+def build_lexical_index(storage_adapter, lexical_config):
+    """Rebuilds the lexical index from every chunk currently in the vector store."""
+    fields = lexical_config.get('metadata_fields', ['document_title', 'tags'])
+    chunks = (
+        (chunk_id, lexical_text(chunk_text, metadata, fields))
+        for chunk_id, chunk_text, metadata in storage_adapter.iter_chunks()
+    )
+    return LexicalIndex.build(
+        lexical_config['path'], chunks,
+        tokenizer=lexical_config.get('tokenizer'),
+        k1=lexical_config.get('k1', 1.2),
+        b=lexical_config.get('b', 0.75),
+        workers=lexical_config.get('workers', 0),
+    )
@@ -0,0 +1,285 @@
+# pipeline_lib/storage/pgvector_maintenance.py
+import hashlib
+import logging
+import math
+import re
+import time
+
+VECTOR_INDEX_NAME = 'idx_knowledge_chunks_embedding'
+
+# search ใช้ <#> (inner product) จึงต้องใช้ operator class *_ip_ops ของชนิด column
+VECTOR_OPCLASS = 'vector_ip_ops'
+HALFVEC_OPCLASS = 'halfvec_ip_ops'
+
+# ชนิดของ column embedding ตาม precision (bytes ต่อ vector 1024 มิติ); BINARY เก็บ vector สำหรับ
+# rescore ตาม binary_rescore และ index เฉพาะ binary_quantize(embedding) (128 bytes) ด้วย Hamming distance
+PRECISION_COLUMN_TYPES = {
+    'FLOAT32': 'vector',   # 4096 bytes
+    'HALFVEC': 'halfvec',  # 2048 bytes
+}
+
+# index สำหรับ filter ใน search และการลบ/แทนที่ chunk ตามเอกสาร
+METADATA_INDEXES = {
+    'idx_knowledge_chunks_item_id': "(knowledge_item_id)",
+    'idx_knowledge_chunks_category': "USING gin ((metadata->'category'))",
+    'idx_knowledge_chunks_document_type': "((metadata->>'document_type'))",
+    'idx_knowledge_chunks_source_path': "((metadata->>'source_path'))",
+}
+
+# การแบ่ง shard: partial vector index หนึ่งตัวต่อค่าของ expression นี้ (ตรงกับ shard_key ของ ShardedFaissStore)
+UNASSIGNED_SHARD = '_unassigned'
+SHARD_EXPRESSIONS = {
+    'category': f"COALESCE(metadata->'category'->>0, '{UNASSIGNED_SHARD}')",
+    'document_type': f"COALESCE(metadata->>'document_type', '{UNASSIGNED_SHARD}')",
+}
+
+# shard ที่มี partial index แล้ว; indexed_up_to = chunk id สูงสุดที่ตรวจแล้วว่าทุก shard มี index
+# (ปรับขึ้นหลังสร้างครบทุก shard เท่านั้น; shard ใหม่หลังจากนั้นมี id มากกว่าเสมอ)
+SHARDS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS knowledge_chunk_shards (
+        shard_by TEXT NOT NULL,
+        shard_key TEXT NOT NULL,
+        index_name TEXT NOT NULL,
+        num_rows BIGINT NOT NULL,
+        indexed_up_to BIGINT NOT NULL,
+        PRIMARY KEY (shard_by, shard_key)
+    );
+"""
+
+def count_chunks(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM knowledge_chunks;")
+        return cur.fetchone()[0]
+
+def shard_expression(shard_by) -> str:
+    if shard_by not in SHARD_EXPRESSIONS:
+        raise ValueError(f"Unsupported pgvector shard field: {shard_by}. Supported: {list(SHARD_EXPRESSIONS)}")
+    return SHARD_EXPRESSIONS[shard_by]
+
+def shard_index_name(shard_by, shard_key) -> str:
+    # ชื่อ index ต้องสั้นกว่า 63 bytes และเป็น ASCII จึงใช้ hash ของ key (ภาษาไทย) แทน
+    digest = hashlib.md5(f"{shard_by}\0{shard_key}".encode('utf-8')).hexdigest()[:12]
+    return f"{VECTOR_INDEX_NAME}_{digest}"
+
+def parse_vector_type(type_name):
+    """('halfvec', 1024) from a column type such as 'halfvec(1024)'."""
+    match = re.fullmatch(r'(\w+)(?:\((\d+)\))?', type_name)
+    if not match or match.group(1) not in PRECISION_COLUMN_TYPES.values():
+        raise ValueError(f"Unsupported embedding column type: {type_name}")
+    return match.group(1), int(match.group(2)) if match.group(2) else None
+
+def embedding_column_type(conn):
+    """The (type, dimensions) of knowledge_chunks.embedding, e.g. ('vector', 1024)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'knowledge_chunks'::regclass AND attname = 'embedding';
+            """
+        )
+        return parse_vector_type(cur.fetchone()[0])
+
+def target_column_type(pg_config) -> str:
+    """Column type required by the configured precision ('vector' or 'halfvec')."""
+    precision = pg_config.get('precision', 'FLOAT32')
+    if precision == 'BINARY':
+        precision = pg_config.get('binary_rescore', 'HALFVEC')
+    if precision not in PRECISION_COLUMN_TYPES:
+        raise ValueError(f"Unknown pgvector precision: {precision}")
+    return PRECISION_COLUMN_TYPES[precision]
+
+def binary_expression(dim) -> str:
+    """Indexed expression of BINARY precision; search must use exactly the same expression."""
+    return f"(binary_quantize(embedding)::bit({dim}))"
+
+def ivfflat_lists(index_config, num_rows) -> int:
+    """Configured lists, or pgvector's guideline: rows / 1000 up to 1M rows, sqrt(rows) beyond."""
+    if index_config.get('lists'):
+        return index_config['lists']
+    if num_rows > 1_000_000:
+        return max(1, int(math.sqrt(num_rows)))
+    return max(1, num_rows // 1000)
+
+def vector_index_sql(index_config, num_rows, precision='FLOAT32', column=('vector', None),
+                     name=VECTOR_INDEX_NAME, predicate=None) -> str:
+    """
+    CREATE INDEX statement for the configured vector index type (None for 'NONE').
+    column is the (type, dimensions) of the embedding column; BINARY precision
+    indexes the binary-quantized embedding with bit_hamming_ops instead.
+    predicate makes it a partial index (one shard).
+    """
+    index_type = index_config.get('type', 'HNSW')
+    if index_type == 'HNSW':
+        params = f"m = {int(index_config.get('m', 16))}, ef_construction = {int(index_config.get('ef_construction', 64))}"
+        method = 'hnsw'
+    elif index_type == 'IVFFLAT':
+        params = f"lists = {ivfflat_lists(index_config, num_rows)}"
+        method = 'ivfflat'
+    elif index_type == 'NONE':
+        return None
+    else:
+        raise ValueError(f"Unknown pgvector index type: {index_type}")
+    column_type, dim = column
+    if precision == 'BINARY':
+        if not dim:
+            raise ValueError("BINARY precision needs an embedding column with fixed dimensions.")
+        key = f"{binary_expression(dim)} bit_hamming_ops"
+    else:
+        key = f"embedding {HALFVEC_OPCLASS if column_type == 'halfvec' else VECTOR_OPCLASS}"
+    where = f" WHERE {predicate}" if predicate else ""
+    return (f"CREATE INDEX IF NOT EXISTS {name} ON knowledge_chunks "
+            f"USING {method} ({key}) WITH ({params}){where};")
+
+def _set_build_resources(cur, index_config):
+    # ใช้ได้เฉพาะใน transaction นี้ (SET LOCAL) ไม่กระทบ session อื่น
+    cur.execute("SET LOCAL maintenance_work_mem = %s;", (str(index_config.get('maintenance_work_mem', '1GB')),))
+    cur.execute("SET LOCAL max_parallel_maintenance_workers = %s;", (int(index_config.get('parallel_workers', 2)),))
+
+def vector_index_exists(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (VECTOR_INDEX_NAME,))
+        return cur.fetchone()[0]
+
+def create_vector_index(conn, index_config, precision='FLOAT32', shard_by=None):
+    """
+    Builds the HNSW / IVFFlat index on knowledge_chunks.embedding if it does not exist
+    (one partial index per shard when shard_by is set).
+    Build it after bulk loads: IVFFlat picks its lists from the data present at build
+    time, and one HNSW build is much faster than inserting every row into the graph.
+    """
+    if index_config.get('type', 'HNSW') == 'NONE':
+        logging.info("pgvector index type is NONE; no vector index is built.")
+        return
+    if shard_by:
+        create_shard_indexes(conn, index_config, precision, shard_by)
+        return
+    if vector_index_exists(conn):
+        logging.info(f"Vector index {VECTOR_INDEX_NAME} already exists.")
+        return
+    num_rows = count_chunks(conn)
+    sql = vector_index_sql(index_config, num_rows, precision, embedding_column_type(conn))
+    logging.info(f"Building vector index on {num_rows} chunks: {sql}")
+    start = time.perf_counter()
+    with conn.cursor() as cur:
+        _set_build_resources(cur, index_config)
+        cur.execute(sql)
+    conn.commit()
+    logging.info(f"Vector index built in {time.perf_counter() - start:.1f}s.")
+
+def create_shard_indexes(conn, index_config, precision, shard_by):
+    """
+    Builds a partial vector index for every shard value present in knowledge_chunks
+    that does not have one yet, sized by the rows of that shard, and records it
+    in knowledge_chunk_shards so that searches can route to it.
+    Only chunks added since the last complete pass (id > indexed_up_to) are grouped.
+    """
+    expression = shard_expression(shard_by)
+    column = embedding_column_type(conn)
+    with conn.cursor() as cur:
+        cur.execute(SHARDS_TABLE_SQL)
+        cur.execute("SELECT shard_key, indexed_up_to FROM knowledge_chunk_shards WHERE shard_by = %s;", (shard_by,))
+        rows = cur.fetchall()
+        indexed = {key for key, _ in rows}
+        checked_up_to = max((up_to for _, up_to in rows), default=0)
+        cur.execute(f"SELECT {expression}, count(*), max(id) FROM knowledge_chunks WHERE id > %s GROUP BY 1 ORDER BY 2 DESC;",
+                    (checked_up_to,))
+        shards = cur.fetchall()
+    conn.commit()
+
+    indexed_up_to = max((max_id for _, _, max_id in shards), default=checked_up_to)
+    new_shards = [(key, num_rows) for key, num_rows, _ in shards if key not in indexed]
+    logging.info(f"{len(shards)} shards by {shard_by} with chunks after id {checked_up_to}; "
+                 f"building partial vector indexes for {len(new_shards)} new shards.")
+    for key, num_rows in new_shards:
+        name = shard_index_name(shard_by, key)
+        with conn.cursor() as cur:
+            predicate = f"{expression} = {cur.mogrify('%s', (key,)).decode('utf-8')}"
+            sql = vector_index_sql(index_config, num_rows, precision, column, name=name, predicate=predicate)
+            logging.info(f"Building vector index of shard '{key}' on {num_rows} chunks: {sql}")
+            start = time.perf_counter()
+            _set_build_resources(cur, index_config)
+            cur.execute(sql)
+            cur.execute(
+                "INSERT INTO knowledge_chunk_shards (shard_by, shard_key, index_name, num_rows, indexed_up_to) "
+                "VALUES (%s, %s, %s, %s, %s);",
+                (shard_by, key, name, num_rows, checked_up_to),
+            )
+        # commit ทีละ shard: ถ้าหยุดกลางทาง shard ที่สร้างแล้วไม่ต้องสร้างใหม่
+        conn.commit()
+        logging.info(f"Vector index of shard '{key}' built in {time.perf_counter() - start:.1f}s.")
+
+    # ทุก shard ถึง id นี้มี index แล้ว: รอบถัดไปเริ่มตรวจต่อจากตรงนี้
+    with conn.cursor() as cur:
+        cur.execute("UPDATE knowledge_chunk_shards SET indexed_up_to = %s WHERE shard_by = %s;", (indexed_up_to, shard_by))
+    conn.commit()
+
+def drop_vector_index(conn):
+    """Drops the vector index and every shard index (e.g. before a large bulk load)."""
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX IF EXISTS {VECTOR_INDEX_NAME};")
+        cur.execute("SELECT to_regclass('knowledge_chunk_shards') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            cur.execute("DELETE FROM knowledge_chunk_shards RETURNING index_name;")
+            for index_name, in cur.fetchall():
+                cur.execute(f"DROP INDEX IF EXISTS {index_name};")
+    conn.commit()
+    logging.info(f"Dropped vector index {VECTOR_INDEX_NAME} and its shard indexes.")
+
+def rebuild_vector_index(conn, index_config, precision='FLOAT32', shard_by=None):
+    """Drops and rebuilds the vector index, e.g. after changing m / ef_construction / lists."""
+    drop_vector_index(conn)
+    create_vector_index(conn, index_config, precision, shard_by)
+
+def set_embedding_precision(conn, pg_config):
+    """
+    Converts knowledge_chunks.embedding to the column type of the configured
+    precision (vector <-> halfvec) and rebuilds the vector index to match.
+    The ALTER rewrites the whole table, so run it in a maintenance window.
+    """
+    index_config = pg_config.get('index', {})
+    precision = pg_config.get('precision', 'FLOAT32')
+    shard_by = pg_config.get('sharding', {}).get('shard_by')
+    column_type, dim = embedding_column_type(conn)
+    target_type = target_column_type(pg_config)
+    if column_type != target_type and not dim:
+        raise ValueError("The embedding column has no fixed dimensions; cannot convert it.")
+    drop_vector_index(conn)
+    if column_type != target_type:
+        logging.info(f"Converting embedding column from {column_type}({dim}) to {target_type}({dim})...")
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(f"ALTER TABLE knowledge_chunks ALTER COLUMN embedding TYPE {target_type}({dim}) "
+                        f"USING embedding::{target_type}({dim});")
+        conn.commit()
+        logging.info(f"Embedding column converted in {time.perf_counter() - start:.1f}s.")
+    create_vector_index(conn, index_config, precision, shard_by)
+
+def create_metadata_indexes(conn, index_config):
+    """Creates the B-tree / GIN indexes behind search filters and per-document deletes."""
+    with conn.cursor() as cur:
+        _set_build_resources(cur, index_config)
+        for name, definition in METADATA_INDEXES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON knowledge_chunks {definition};")
+    conn.commit()
+    logging.info(f"Metadata indexes ensured: {', '.join(METADATA_INDEXES)}.")
+
+def ensure_indexes(conn, index_config, precision='FLOAT32', shard_by=None):
+    create_metadata_indexes(conn, index_config)
+    create_vector_index(conn, index_config, precision, shard_by)
+
+def analyze_chunks(conn):
+    """Refreshes planner statistics after large loads."""
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE knowledge_chunks;")
+    conn.commit()
+
+def index_status(conn) -> list:
+    """Returns (index name, size, definition) for every index on knowledge_chunks."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT indexname, pg_size_pretty(pg_relation_size((quote_ident(schemaname) || '.' || quote_ident(indexname))::regclass)), indexdef
+            FROM pg_indexes WHERE tablename = 'knowledge_chunks' ORDER BY indexname;
+            """
+        )
+        return cur.fetchall()
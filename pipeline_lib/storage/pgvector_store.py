@@ -1,28 +1,323 @@
 # pipeline_lib/storage/pgvector_store.py
+import io
 import json
 import logging
+import math
+import struct
+import time
+
+import numpy as np
+
+from .search import normalize_filters, make_hit, as_query_matrix
+from .pgvector_maintenance import parse_vector_type, binary_expression, shard_expression
+
+COPY_COLUMNS = ('knowledge_item_id', 'chunk_text', 'chunk_sequence', 'embedding', 'metadata')
+
+# รูปแบบ binary ของ integer แต่ละชนิดใน COPY (big-endian)
+_INT_FORMATS = {'smallint': '>h', 'integer': '>i', 'bigint': '>q'}
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_COPY_TRAILER = struct.pack('>h', -1)
+
+# รูปแบบ binary ของแต่ละค่าใน vector ตามชนิด column (vector = float4, halfvec = float2)
+_VECTOR_FORMATS = {'vector': '>f4', 'halfvec': '>f2'}
+
+# ค่าสูงสุดที่ pgvector ยอมให้ตั้ง hnsw.ef_search
+MAX_EF_SEARCH = 1000
+
+def _vector_literal(vector) -> str:
+    """Formats a vector as a pgvector text literal: '[0.1,0.2,...]'."""
+    return "[" + ",".join(format(float(x), '.8g') for x in vector) + "]"
+
+def _filter_clause(filters):
+    """Builds the WHERE conditions (and their parameters) for normalized search filters."""
+    conditions, params = [], []
+    for field, accepted in filters.items():
+        if field == 'category':
+            # category เป็น JSON array: ตรงเมื่อมีสมาชิกตัวใดตัวหนึ่งอยู่ในรายการที่ต้องการ
+            conditions.append("metadata->'category' ?| %s")
+        else:
+            conditions.append(f"metadata->>'{field}' = ANY(%s)")
+        params.append([str(value) for value in accepted])
+    return conditions, params
+
+def _vector_binary(matrix: np.ndarray, column_type='vector') -> list:
+    """pgvector binary representation of each row: int16 dim, int16 unused, float4/float2[dim] (big-endian)."""
+    header = struct.pack('>hh', matrix.shape[1], 0)
+    big_endian = np.ascontiguousarray(matrix, dtype=_VECTOR_FORMATS[column_type])
+    return [header + row.tobytes() for row in big_endian]
 
 class PGVectorStore:
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, config=None):
         self.conn = db_connection
+        self.config = config or {}
+        self.copy_batch_size = self.config.get('copy_batch_size', 5000)
+        self.precision = self.config.get('precision', 'FLOAT32')
+        self.rescore_factor = self.config.get('rescore_factor', 10)
+        self.shard_by = self.config.get('sharding', {}).get('shard_by')
+        if self.shard_by:
+            shard_expression(self.shard_by)  # ตรวจชื่อฟิลด์ตั้งแต่ตอนเริ่ม
+        self._int_formats = None
+        self._embedding_type = None
         logging.info("PGVectorStore Adapter initialized.")
 
     def add(self, chunks_data: list):
         """Adds a list of chunks to the PostgreSQL database."""
         logging.info(f"Adding {len(chunks_data)} chunks to PostgreSQL...")
         
+        start = time.perf_counter()
         with self.conn.cursor() as cur:
-            for item_id, chunk_text, seq, embedding, metadata in chunks_data:
-                cur.execute(
-                    """
-                    INSERT INTO knowledge_chunks (knowledge_item_id, chunk_text, chunk_sequence, embedding, metadata)
-                    VALUES (%s, %s, %s, %s, %s);
-                    """,
-                    (item_id, chunk_text, seq, embedding, json.dumps(metadata, ensure_ascii=False))
-                )
+            self._insert(cur, chunks_data)
         self.conn.commit()
-        logging.info("Successfully added chunks to PostgreSQL.")
+        elapsed = time.perf_counter() - start
+        logging.info(f"Successfully added {len(chunks_data)} chunks to PostgreSQL "
+                     f"({len(chunks_data) / elapsed if elapsed else 0:.0f} rows/sec).")
+
+    def _column_int_formats(self, cur):
+        """Binary formats of the integer columns, read once from the table definition."""
+        if self._int_formats is None:
+            cur.execute(
+                """
+                SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'knowledge_chunks'::regclass AND attname IN ('knowledge_item_id', 'chunk_sequence');
+                """
+            )
+            types = dict(cur.fetchall())
+            unsupported = {name: pg_type for name, pg_type in types.items() if pg_type not in _INT_FORMATS}
+            if unsupported:
+                raise ValueError(f"Unsupported column types for binary COPY: {unsupported}")
+            self._int_formats = {name: _INT_FORMATS[pg_type] for name, pg_type in types.items()}
+        return self._int_formats
+
+    def _embedding_column(self, cur):
+        """(type, dimensions) of the embedding column, e.g. ('halfvec', 1024), read once."""
+        if self._embedding_type is None:
+            cur.execute(
+                """
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'knowledge_chunks'::regclass AND attname = 'embedding';
+                """
+            )
+            self._embedding_type = parse_vector_type(cur.fetchone()[0])
+        return self._embedding_type
+
+    def _insert(self, cur, chunks_data):
+        """
+        Streams chunks into knowledge_chunks with binary COPY, copy_batch_size rows per
+        COPY statement. Embeddings (NumPy rows or lists) are encoded for a whole batch
+        at once, with no per-value text formatting.
+        """
+        int_formats = self._column_int_formats(cur)
+        item_id_format = int_formats['knowledge_item_id']
+        seq_format = int_formats['chunk_sequence']
+        item_id_size = struct.calcsize(item_id_format)
+        seq_size = struct.calcsize(seq_format)
+        column_type, _ = self._embedding_column(cur)
+        sql = f"COPY knowledge_chunks ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT binary)"
+
+        for start in range(0, len(chunks_data), self.copy_batch_size):
+            batch = chunks_data[start:start + self.copy_batch_size]
+            vectors = _vector_binary(np.vstack([embedding for _, _, _, embedding, _ in batch]), column_type)
+            buffer = io.BytesIO()
+            buffer.write(_COPY_HEADER)
+            for (item_id, chunk_text, seq, _, metadata), vector in zip(batch, vectors):
+                text = chunk_text.encode('utf-8')
+                # jsonb binary = version byte 1 + JSON text
+                meta = b'\x01' + json.dumps(metadata, ensure_ascii=False).encode('utf-8')
+                buffer.write(struct.pack('>h', len(COPY_COLUMNS)))
+                buffer.write(struct.pack('>i', item_id_size) + struct.pack(item_id_format, item_id))
+                buffer.write(struct.pack('>i', len(text)) + text)
+                buffer.write(struct.pack('>i', seq_size) + struct.pack(seq_format, seq))
+                buffer.write(struct.pack('>i', len(vector)) + vector)
+                buffer.write(struct.pack('>i', len(meta)) + meta)
+            buffer.write(_COPY_TRAILER)
+            buffer.seek(0)
+            cur.copy_expert(sql, buffer)
+
+    def _delete(self, cur, document_ids):
+        cur.execute("DELETE FROM knowledge_chunks WHERE knowledge_item_id = ANY(%s);", (list(document_ids),))
+        return cur.rowcount
+
+    def delete_documents(self, document_ids):
+        """Removes every chunk belonging to the given document IDs."""
+        with self.conn.cursor() as cur:
+            removed = self._delete(cur, document_ids)
+        self.conn.commit()
+        logging.info(f"Removed {removed} chunks of {len(document_ids)} documents from PostgreSQL.")
+        return removed
+
+    def replace_documents(self, chunks_data: list, document_ids=()):
+        """
+        Replaces all chunks of the documents in chunks_data (and of document_ids,
+        e.g. documents that no longer produce any chunk) in one transaction.
+        """
+        document_ids = set(document_ids) | {item_id for item_id, _, _, _, _ in chunks_data}
+        with self.conn.cursor() as cur:
+            removed = self._delete(cur, document_ids)
+            self._insert(cur, chunks_data)
+        self.conn.commit()
+        logging.info(f"Replaced {removed} chunks of {len(document_ids)} documents with {len(chunks_data)} new chunks in PostgreSQL.")
+
+    def iter_chunks(self, fetch_size=5000):
+        """Yields (chunk_id, chunk_text, metadata) for every chunk, e.g. to build a lexical index."""
+        with self.conn.cursor(name='iter_chunks_cursor') as cur:
+            cur.itersize = fetch_size
+            cur.execute("SELECT id, chunk_text, metadata FROM knowledge_chunks ORDER BY id;")
+            for row in cur:
+                yield row
+        self.conn.commit()
+
+    def fetch_chunks(self, chunk_ids) -> dict:
+        """Returns {chunk_id: hit} (score 0) for the given chunk ids that exist."""
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id, knowledge_item_id, chunk_text, metadata FROM knowledge_chunks WHERE id = ANY(%s);",
+                        ([int(chunk_id) for chunk_id in chunk_ids],))
+            return {
+                chunk_id: make_hit(chunk_id, item_id, 0.0, chunk_text, metadata)
+                for chunk_id, item_id, chunk_text, metadata in cur.fetchall()
+            }
+
+    def search(self, query_vectors, k=10, filters=None, chunk_ids=None) -> list:
+        """
+        Returns the top-k chunks for each query vector, ranked by inner product
+        (embeddings are normalized, so this equals cosine similarity).
+        Metadata filters are applied in the same query, before the LIMIT.
+
+        With BINARY precision the binary index first selects rescore_factor x k
+        candidates by Hamming distance, which are then re-ranked by inner product
+        on the stored vectors.
+
+        With sharding, each routed shard is ranked on its own partial index and
+        the per-shard top-k are merged by a UNION ALL in the same statement.
+
+        chunk_ids restricts the search to a candidate set (e.g. from the lexical
+        index), which is scored exactly instead of through the ANN index.
+        """
+        queries = as_query_matrix(query_vectors)
+        filters = normalize_filters(filters)
+        conditions, filter_params = _filter_clause(filters)
+        results = []
+        with self.conn.cursor() as cur:
+            column = self._embedding_column(cur)
+            branches = self._shard_branches(cur, filters) if self.shard_by and chunk_ids is None else None
+            if chunk_ids is not None:
+                conditions = conditions + ["id = ANY(%s)"]
+                filter_params = filter_params + [[int(chunk_id) for chunk_id in chunk_ids]]
+            self._configure_search(cur, k)
+            for query in queries:
+                literal = _vector_literal(query)
+                if chunk_ids is not None:
+                    sql, params = self._candidate_select(column, conditions, filter_params, literal, k)
+                elif branches is None:
+                    sql, params = self._ranked_select(column, conditions, filter_params, literal, k)
+                    sql += ";"
+                else:
+                    selects, params = [], []
+                    for condition, condition_params in branches:
+                        branch_sql, branch_params = self._ranked_select(
+                            column, conditions + [condition], filter_params + condition_params, literal, k)
+                        selects.append(f"({branch_sql})")
+                        params.extend(branch_params)
+                    sql = f"SELECT * FROM ({' UNION ALL '.join(selects)}) AS hits ORDER BY score DESC LIMIT %s;"
+                    params.append(k)
+                cur.execute(sql, params)
+                results.append([
+                    make_hit(chunk_id, item_id, score, chunk_text, metadata)
+                    for chunk_id, item_id, chunk_text, metadata, score in cur.fetchall()
+                ])
+        return results
+
+    def _ranked_select(self, column, conditions, params, literal, k):
+        """The top-k SELECT (and its parameters) over the rows matching conditions."""
+        column_type, dim = column
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        if self.precision == 'BINARY':
+            sql = f"""
+                WITH candidates AS (
+                    SELECT id, knowledge_item_id, chunk_text, metadata, embedding
+                    FROM knowledge_chunks
+                    {where}
+                    ORDER BY {binary_expression(dim)} <~> binary_quantize(%s::{column_type})
+                    LIMIT %s
+                )
+                SELECT id, knowledge_item_id, chunk_text, metadata, -(embedding <#> %s::{column_type}) AS score
+                FROM candidates
+                ORDER BY embedding <#> %s::{column_type}
+                LIMIT %s
+            """
+            return sql, [*params, literal, k * self.rescore_factor, literal, literal, k]
+        sql = f"""
+            SELECT id, knowledge_item_id, chunk_text, metadata, -(embedding <#> %s::{column_type}) AS score
+            FROM knowledge_chunks
+            {where}
+            ORDER BY embedding <#> %s::{column_type}
+            LIMIT %s
+        """
+        return sql, [literal, *params, literal, k]
+
+    def _candidate_select(self, column, conditions, params, literal, k):
+        """Exact top-k over a small candidate set; OFFSET 0 keeps the planner off the ANN index."""
+        column_type, _ = column
+        sql = f"""
+            SELECT id, knowledge_item_id, chunk_text, metadata, -(embedding <#> %s::{column_type}) AS score
+            FROM (SELECT * FROM knowledge_chunks WHERE {" AND ".join(conditions)} OFFSET 0) AS candidates
+            ORDER BY embedding <#> %s::{column_type}
+            LIMIT %s;
+        """
+        return sql, [literal, *params, literal, k]
+
+    def _shard_branches(self, cur, filters) -> list:
+        """
+        (condition, parameters) of each branch of a sharded search: one per routed
+        shard, matching its partial index predicate exactly, plus one for the rows
+        no routed shard index covers (shards created since the last index build,
+        or deeper category levels that match a category filter).
+        """
+        expression = shard_expression(self.shard_by)
+        known, indexed_up_to = [], 0
+        cur.execute("SELECT to_regclass('knowledge_chunk_shards') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT shard_key, indexed_up_to FROM knowledge_chunk_shards WHERE shard_by = %s;", (self.shard_by,))
+            rows = cur.fetchall()
+            known = [key for key, _ in rows]
+            indexed_up_to = max((up_to for _, up_to in rows), default=0)
+
+        accepted = filters.get(self.shard_by)
+        if accepted is None:
+            routed = known
+            # shard ที่ยังไม่มี index เกิดหลังการสร้างครั้งล่าสุดเสมอ จึงจำกัดด้วย id ได้ (ใช้ primary key)
+            rest = (f"id > %s AND {expression} <> ALL(%s)", [indexed_up_to, known])
+        else:
+            accepted = {str(value) for value in accepted}
+            routed = [key for key in known if key in accepted]
+            rest = (f"{expression} <> ALL(%s)", [routed])
+        return [(f"{expression} = %s", [key]) for key in routed] + [rest]
+
+    def _configure_search(self, cur, k):
+        """
+        Sets the ANN search knobs for the current transaction (SET LOCAL, so the
+        caller's session settings are left alone): hnsw.ef_search / ivfflat.probes,
+        and optionally hnsw.iterative_scan so filtered searches still return k rows.
+
+        An HNSW scan returns at most ef_search rows, so with BINARY precision
+        ef_search is raised to the rescore_factor x k candidates (and probes by
+        the same ratio); otherwise the rescoring would silently see fewer.
+        """
+        ef_search = int(self.config.get('ef_search', 64))
+        probes = int(self.config.get('probes', 10))
+        if self.precision == 'BINARY':
+            candidates = k * self.rescore_factor
+            if candidates > ef_search:
+                probes = math.ceil(probes * candidates / ef_search)
+                ef_search = candidates
+            if ef_search > MAX_EF_SEARCH:
+                logging.warning(f"BINARY search wants {ef_search} candidates; hnsw.ef_search is capped at {MAX_EF_SEARCH}.")
+                ef_search = MAX_EF_SEARCH
+        cur.execute("SET LOCAL hnsw.ef_search = %s;", (ef_search,))
+        cur.execute("SET LOCAL ivfflat.probes = %s;", (probes,))
+        if self.config.get('iterative_scan'):
+            cur.execute("SET LOCAL hnsw.iterative_scan = %s;", (self.config['iterative_scan'],))
 
-    def persist(self):
+    def persist(self, final=True):
         # For PostgreSQL, data is persisted on commit, so this does nothing.
-        logging.info("PostgreSQL data is already persisted. Nothing to do.")
\ No newline at end of file
+        logging.info("PostgreSQL data is already persisted. Nothing to do.")
+        return True
\ No newline at end of file
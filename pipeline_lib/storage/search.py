@@ -0,0 +1,148 @@
+# pipeline_lib/storage/search.py
+import logging
+import time
+import numpy as np
+
+# ฟิลด์ metadata ที่ใช้กรองก่อนค้นหาได้ (ค่าใน filters เป็นค่าเดียวหรือ list ก็ได้)
+FILTERABLE_FIELDS = ('category', 'document_type', 'source_path')
+
+def normalize_filters(filters):
+    """Validates a filters dict and turns every value into a list of accepted values."""
+    if not filters:
+        return {}
+    unknown = set(filters) - set(FILTERABLE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unsupported search filters: {sorted(unknown)}. Supported: {list(FILTERABLE_FIELDS)}")
+    return {field: value if isinstance(value, (list, tuple, set)) else [value] for field, value in filters.items()}
+
+def matches_filters(metadata, filters) -> bool:
+    """
+    Checks metadata against normalized filters.
+    List-valued metadata (e.g. category = ['กรมการปกครอง', 'บัตรประชาชน']) matches
+    when any of its elements is one of the accepted values.
+    """
+    for field, accepted in filters.items():
+        value = metadata.get(field)
+        if isinstance(value, list):
+            if not any(v in accepted for v in value):
+                return False
+        elif value not in accepted:
+            return False
+    return True
+
+def make_hit(chunk_id, document_id, score, chunk_text, metadata):
+    """The result record returned by every store's search()."""
+    return {
+        "chunk_id": chunk_id,
+        "document_id": document_id,
+        "score": float(score),
+        "chunk_text": chunk_text,
+        "metadata": metadata,
+    }
+
+def as_query_matrix(query_vectors):
+    """Accepts one vector or a batch of vectors and returns a 2-D float32 array."""
+    queries = np.asarray(query_vectors, dtype='float32')
+    if queries.ndim == 1:
+        queries = queries.reshape(1, -1)
+    return np.ascontiguousarray(queries)
+
+SEARCH_MODES = ('DENSE', 'HYBRID', 'PREFILTER')
+
+def reciprocal_rank_fusion(ranked_lists, k, rrf_k=60) -> list:
+    """
+    Fuses ranked hit lists by Reciprocal Rank Fusion: each hit scores
+    sum(1 / (rrf_k + rank)) over the lists it appears in. The fused score
+    replaces 'score'; the per-list scores are kept as '<name>_score'.
+    """
+    fused, hits = {}, {}
+    for name, ranked in ranked_lists.items():
+        for rank, hit in enumerate(ranked, start=1):
+            chunk_id = hit['chunk_id']
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+            merged = hits.setdefault(chunk_id, dict(hit))
+            merged[f"{name}_score"] = hit['score']
+    top = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [dict(hits[chunk_id], score=fused[chunk_id]) for chunk_id in top]
+
+class SearchEngine:
+    """
+    Read path over any vector store adapter.
+
+    Every store implements search(query_vectors, k, filters) and returns, for
+    each query, a list of hits (see make_hit) sorted by descending score.
+    The engine adds text queries on top, encoding them with the same model
+    instance that the indexer uses.
+
+    With a lexical (BM25) index, text queries run in one of SEARCH_MODES:
+      DENSE      vector search only
+      HYBRID     dense and lexical candidates fused with reciprocal rank fusion
+      PREFILTER  the lexical candidates are the only chunks scored by the vector
+                 store (dense search is used when too few terms match)
+    """
+
+    def __init__(self, storage_adapter, model, batch_size=32, lexical_index=None, hybrid_config=None):
+        self.storage_adapter = storage_adapter
+        self.model = model
+        self.batch_size = batch_size
+        self.lexical_index = lexical_index
+        hybrid_config = hybrid_config or {}
+        self.mode = hybrid_config.get('mode', 'HYBRID') if lexical_index is not None else 'DENSE'
+        self.candidates = hybrid_config.get('candidates', 50)
+        self.prefilter_candidates = hybrid_config.get('prefilter_candidates', 1000)
+        self.rrf_k = hybrid_config.get('rrf_k', 60)
+
+    def encode(self, queries: list) -> np.ndarray:
+        return self.model.encode(queries, batch_size=self.batch_size, normalize_embeddings=True)
+
+    def search(self, query_vectors, k=10, filters=None) -> list:
+        start = time.perf_counter()
+        results = self.storage_adapter.search(query_vectors, k=k, filters=filters)
+        logging.debug(f"Searched {len(results)} queries in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return results
+
+    def search_texts(self, queries: list, k=10, filters=None, mode=None) -> list:
+        """Encodes a batch of query strings and searches the store with them."""
+        mode = mode or self.mode
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}. Supported: {list(SEARCH_MODES)}")
+        query_vectors = self.encode(queries)
+        if mode == 'DENSE' or self.lexical_index is None:
+            return self.search(query_vectors, k=k, filters=filters)
+
+        start = time.perf_counter()
+        if mode == 'HYBRID':
+            dense = self.storage_adapter.search(query_vectors, k=max(k, self.candidates), filters=filters)
+            results = [
+                reciprocal_rank_fusion({"dense": dense_hits, "lexical": self.lexical_hits(query, max(k, self.candidates), filters)},
+                                       k, self.rrf_k)
+                for query, dense_hits in zip(queries, dense)
+            ]
+        else:
+            results = []
+            for query, vector in zip(queries, query_vectors):
+                chunk_ids, _ = self.lexical_index.search(query, self.prefilter_candidates)
+                hits = self.storage_adapter.search(vector, k=k, filters=filters, chunk_ids=chunk_ids)[0] if len(chunk_ids) else []
+                if len(hits) < k:
+                    # candidate จากคำค้นไม่พอ: เติมผลจาก dense search ต่อท้าย (ไม่ทิ้งผลที่ตรงคำค้น)
+                    seen = {hit['chunk_id'] for hit in hits}
+                    dense = self.storage_adapter.search(vector, k=k, filters=filters)[0]
+                    hits = hits + [hit for hit in dense if hit['chunk_id'] not in seen][:k - len(hits)]
+                results.append(hits)
+        logging.debug(f"{mode} search of {len(queries)} queries in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return results
+
+    def lexical_hits(self, query, k, filters=None) -> list:
+        """Top-k BM25 hits of a query text that pass the filters, with their chunk text and metadata."""
+        filters = normalize_filters(filters)
+        # ผ่าน filter ได้น้อยลง จึงดึง candidate มามากขึ้นก่อนกรอง
+        chunk_ids, scores = self.lexical_index.search(query, self.prefilter_candidates if filters else k)
+        records = self.storage_adapter.fetch_chunks(chunk_ids)
+        hits = []
+        for chunk_id, score in zip(chunk_ids.tolist(), scores.tolist()):
+            hit = records.get(chunk_id)
+            if hit and matches_filters(hit['metadata'], filters):
+                hits.append(dict(hit, score=score))
+                if len(hits) == k:
+                    break
+        return hits
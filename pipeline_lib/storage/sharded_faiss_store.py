@@ -0,0 +1,262 @@
+# pipeline_lib/storage/sharded_faiss_store.py
+import heapq
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+from .faiss_store import FaissStore
+from .search import normalize_filters, as_query_matrix
+
+# ฟิลด์ที่ใช้แบ่ง shard ได้ และวิธีหา shard key จาก metadata ของเอกสาร
+SHARD_FIELDS = ('category', 'document_type')
+UNASSIGNED_SHARD = '_unassigned'
+
+# chunk_id ที่คืนจาก search = (ลำดับ shard << SHARD_ID_BITS) | faiss id ภายใน shard (ไม่ซ้ำกันข้าม shard)
+SHARD_ID_BITS = 40
+
+def shard_key(metadata, shard_by) -> str:
+    """
+    The shard of a chunk: the top-level folder of its category (e.g. the ministry)
+    or its document_type. Chunks without the field go to the unassigned shard.
+    """
+    value = metadata.get(shard_by)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value) if value else UNASSIGNED_SHARD
+
+def _field_values(metadata, field) -> set:
+    value = metadata.get(field)
+    if isinstance(value, list):
+        return set(value)
+    return {value} if value is not None else set()
+
+class ShardedFaissStore:
+    """
+    One FaissStore per shard (category or document_type) under sharding.path,
+    each with its own index file and metadata sidecar, plus a shards.json
+    manifest mapping shard keys to their directories.
+
+    Every document lives in exactly one shard. Searches that filter on the
+    shard field go only to the shards that hold matching values; other searches
+    fan out to all shards in parallel and the per-shard top-k are merged by score.
+    persist() trains and writes the changed shards in parallel.
+    With read_only=True every shard is memory-mapped (see FaissStore).
+    """
+
+    def __init__(self, config, embedding_dim=1024, read_only=False):
+        self.config = config
+        self.read_only = read_only
+        sharding = config.get('sharding', {})
+        self.shard_by = sharding['shard_by']
+        if self.shard_by not in SHARD_FIELDS:
+            raise ValueError(f"Unsupported shard field: {self.shard_by}. Supported: {list(SHARD_FIELDS)}")
+        self.path = sharding.get('path', 'storage/faiss_shards')
+        self.workers = sharding.get('workers', 4)
+        self.embedding_dim = embedding_dim
+        self.manifest_path = os.path.join(self.path, 'shards.json')
+        self.shards = {}           # shard key -> FaissStore
+        self._directories = {}     # shard key -> directory name
+        self._shard_values = {}    # shard key -> values of shard_by present in the shard (for routing)
+        self._document_shard = {}  # document_id -> shard key
+        self._load()
+        logging.info(f"ShardedFaissStore initialized with {len(self.shards)} shards by {self.shard_by}, "
+                     f"{sum(len(shard.sidecar) for shard in self.shards.values())} existing chunks.")
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            if self.read_only:
+                raise FileNotFoundError(f"No shard manifest at {self.manifest_path}; run main_index.py first.")
+            return
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['shard_by'] != self.shard_by:
+            raise ValueError(f"Shards in {self.path} are split by {manifest['shard_by']}, not {self.shard_by}; "
+                             f"re-index into a new sharding.path to change the shard field.")
+        for key, directory in manifest['shards'].items():
+            shard = self._open_shard(key, directory)
+            for doc_id, fields in shard.sidecar.documents.items():
+                self._document_shard[doc_id] = key
+                self._shard_values[key] |= _field_values(fields, self.shard_by)
+
+    def _open_shard(self, key, directory):
+        shard_dir = os.path.join(self.path, directory)
+        shard_config = {name: value for name, value in self.config.items() if name != 'sharding'}
+        shard_config.update(index_path=os.path.join(shard_dir, 'index.bin'), metadata_path=os.path.join(shard_dir, 'metadata'))
+        self.shards[key] = FaissStore(shard_config, self.embedding_dim, read_only=self.read_only)
+        self._directories[key] = directory
+        self._shard_values.setdefault(key, set())
+        return self.shards[key]
+
+    def _shard(self, key):
+        if key not in self.shards:
+            if self.read_only:
+                raise RuntimeError(f"Sharded Faiss index {self.path} is opened read-only.")
+            logging.info(f"Creating shard '{key}'.")
+            self._open_shard(key, f"shard_{len(self._directories):04d}")
+        return self.shards[key]
+
+    def indexed_document_ids(self) -> set:
+        """Returns the IDs of all documents that already have chunks in any shard."""
+        return set().union(*(shard.indexed_document_ids() for shard in self.shards.values()))
+
+    def add(self, chunks_data: list):
+        """Routes each chunk to the shard of its document and appends it there."""
+        groups = {}
+        for chunk in chunks_data:
+            doc_id, metadata = chunk[0], chunk[4]
+            key = self._document_shard.get(doc_id) or shard_key(metadata, self.shard_by)
+            groups.setdefault(key, []).append(chunk)
+            self._document_shard[doc_id] = key
+            self._shard_values[key] = self._shard_values.get(key, set()) | _field_values(metadata, self.shard_by)
+        for key, group in groups.items():
+            self._shard(key).add(group)
+
+    def delete_documents(self, document_ids):
+        """Removes every chunk of the given documents from the shards that hold them."""
+        groups = {}
+        for doc_id in document_ids:
+            key = self._document_shard.pop(doc_id, None)
+            if key is not None:
+                groups.setdefault(key, set()).add(doc_id)
+        return sum(self.shards[key].delete_documents(doc_ids) for key, doc_ids in groups.items())
+
+    def replace_documents(self, chunks_data: list, document_ids=()):
+        """
+        Replaces all chunks of the documents present in chunks_data (and of
+        document_ids) with the new ones; a document whose shard field changed moves shard.
+        """
+        self.delete_documents(set(document_ids) | {item_id for item_id, _, _, _, _ in chunks_data})
+        self.add(chunks_data)
+
+    def route(self, filters) -> list:
+        """Shard keys that can hold chunks matching the (normalized) filters."""
+        accepted = filters.get(self.shard_by)
+        if accepted is None:
+            return list(self.shards)
+        accepted = set(accepted)
+        return [key for key in self.shards if self._shard_values.get(key, set()) & accepted]
+
+    def _shard_no(self, key) -> int:
+        return int(self._directories[key].rsplit('_', 1)[1])
+
+    def _split_chunk_ids(self, chunk_ids) -> dict:
+        """Groups global chunk ids into {shard key: [faiss id within the shard]}."""
+        keys_by_no = {self._shard_no(key): key for key in self.shards}
+        groups = {}
+        for chunk_id in chunk_ids:
+            key = keys_by_no.get(int(chunk_id) >> SHARD_ID_BITS)
+            if key is not None:
+                groups.setdefault(key, []).append(int(chunk_id) & ((1 << SHARD_ID_BITS) - 1))
+        return groups
+
+    def describe(self) -> str:
+        """One line about the shards, e.g. for the inspector."""
+        index_types = sorted({shard.describe().split(',')[0] for shard in self.shards.values()})
+        vectors = sum(shard.index.ntotal for shard in self.shards.values())
+        return f"{len(self.shards)} shards by {self.shard_by} ({', '.join(index_types) or '-'}), {vectors} vectors"
+
+    def iter_documents(self):
+        """Yields (document_id, document-level fields, global chunk ids) for every indexed document."""
+        for key, shard in self.shards.items():
+            offset = self._shard_no(key) << SHARD_ID_BITS
+            for doc_id, fields, chunk_ids in shard.iter_documents():
+                yield doc_id, fields, [offset | chunk_id for chunk_id in chunk_ids]
+
+    def all_chunk_ids(self) -> np.ndarray:
+        """The global ids of all live chunks."""
+        return np.concatenate([np.zeros(0, dtype='int64')] + [
+            (self._shard_no(key) << SHARD_ID_BITS) | shard.all_chunk_ids() for key, shard in self.shards.items()
+        ])
+
+    def reconstruct_vectors(self, chunk_ids):
+        """The stored float32 vectors of the given global chunk ids, or None if a shard keeps them compressed."""
+        chunk_ids = np.asarray(chunk_ids, dtype='int64')
+        shard_nos = chunk_ids >> SHARD_ID_BITS
+        vectors = None
+        for key, shard in self.shards.items():
+            in_shard = shard_nos == self._shard_no(key)
+            if not in_shard.any():
+                continue
+            shard_vectors = shard.reconstruct_vectors(chunk_ids[in_shard] & ((1 << SHARD_ID_BITS) - 1))
+            if shard_vectors is None:
+                return None
+            if vectors is None:
+                vectors = np.zeros((len(chunk_ids), shard_vectors.shape[1]), dtype='float32')
+            vectors[in_shard] = shard_vectors
+        return vectors
+
+    def iter_chunks(self):
+        """Yields (chunk_id, chunk_text, metadata) for every live chunk of every shard."""
+        for key, shard in self.shards.items():
+            offset = self._shard_no(key) << SHARD_ID_BITS
+            for faiss_id, chunk_text, metadata in shard.iter_chunks():
+                yield offset | faiss_id, chunk_text, metadata
+
+    def fetch_chunks(self, chunk_ids) -> dict:
+        """Returns {chunk_id: hit} (score 0) for the given global chunk ids that exist."""
+        hits = {}
+        for key, faiss_ids in self._split_chunk_ids(chunk_ids).items():
+            offset = self._shard_no(key) << SHARD_ID_BITS
+            for faiss_id, hit in self.shards[key].fetch_chunks(faiss_ids).items():
+                hit['chunk_id'] = offset | faiss_id
+                hits[hit['chunk_id']] = hit
+        return hits
+
+    def search(self, query_vectors, k=10, filters=None, chunk_ids=None) -> list:
+        """
+        Returns the top-k chunks for each query vector over the routed shards
+        (only the shards holding candidates when chunk_ids is given).
+        chunk_id values are made unique across shards (see SHARD_ID_BITS).
+        """
+        queries = as_query_matrix(query_vectors)
+        filters = normalize_filters(filters)
+        keys = self.route(filters)
+        candidates = None
+        if chunk_ids is not None:
+            candidates = self._split_chunk_ids(chunk_ids)
+            keys = [key for key in keys if key in candidates]
+        if not keys:
+            return [[] for _ in range(len(queries))]
+
+        def search_shard(key):
+            offset = self._shard_no(key) << SHARD_ID_BITS
+            shard_candidates = candidates[key] if candidates is not None else None
+            results = self.shards[key].search(queries, k=k, filters=filters, chunk_ids=shard_candidates)
+            for hits in results:
+                for hit in hits:
+                    hit['chunk_id'] = offset | hit['chunk_id']
+            return results
+
+        if len(keys) == 1:
+            return search_shard(keys[0])
+        # Faiss ปล่อย GIL ระหว่างค้นหา จึงค้นหลาย shard พร้อมกันด้วย thread ได้
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(keys))) as pool:
+            shard_results = list(pool.map(search_shard, keys))
+        return [
+            heapq.nlargest(k, chain.from_iterable(results[i] for results in shard_results), key=lambda hit: hit['score'])
+            for i in range(len(queries))
+        ]
+
+    def persist(self, final=True):
+        """
+        Persists (and trains, if needed) the changed shards in parallel, then the shard manifest.
+        Returns False if a shard deferred its write (see FaissStore.persist).
+        """
+        if self.read_only:
+            raise RuntimeError(f"Sharded Faiss index {self.path} is opened read-only.")
+        if not self.shards:
+            logging.info("Sharded Faiss store has no shards to persist.")
+            return True
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(self.shards))) as pool:
+            persisted = all(list(pool.map(lambda shard: shard.persist(final=final), self.shards.values())))
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"shard_by": self.shard_by, "shards": self._directories}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        return persisted
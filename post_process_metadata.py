@@ -3,8 +3,10 @@
 import json
 import logging
 
+from pipeline_lib.storage.faiss_metadata import MetadataSidecar
+
 # --- 1. การตั้งค่า ---
-INPUT_FILE = "/home/ai-intern02/index_pipeline/storage/metadata.json"  # <-- ไฟล์ผลลัพธ์จาก main_index.py
+INPUT_DIR = "/home/ai-intern02/index_pipeline/storage/metadata"  # <-- metadata sidecar ที่สร้างจาก main_index.py
 OUTPUT_FILE = "/home/ai-intern02/index_pipeline/storage/metadata_final.json" # <-- ไฟล์ใหม่ที่เราจะสร้าง
 
 # --- 2. กำหนดค่า: เลือกฟิลด์ที่คุณต้องการเก็บไว้ในผลลัพธ์สุดท้าย ---
@@ -16,7 +18,7 @@ KEYS_TO_KEEP = [
     "document_title"
 ]
 
-def filter_metadata_fields(records: list) -> list:
+def filter_metadata_fields(records) -> list:
     """
     ฟังก์ชันสำหรับกรอง metadata object ให้เหลือเฉพาะ key ที่กำหนดใน KEYS_TO_KEEP
     """
@@ -47,12 +49,14 @@ def main():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
     
     try:
-        logging.info(f"Reading data from {INPUT_FILE}...")
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        logging.info(f"Reading data from {INPUT_DIR}...")
+        sidecar = MetadataSidecar(INPUT_DIR)
+        if not sidecar.exists():
+            raise FileNotFoundError(INPUT_DIR)
         
-        logging.info(f"Found {len(data)} records. Filtering metadata to keep only specified keys...")
-        filtered_data = filter_metadata_fields(data)
+        logging.info(f"Found {len(sidecar)} records. Filtering metadata to keep only specified keys...")
+        # อ่านทีละ record จาก sidecar แทนการโหลดทั้งไฟล์
+        filtered_data = filter_metadata_fields(record for _, record in sidecar.iter_records())
         
         logging.info(f"Filtering complete. Saving results to {OUTPUT_FILE}...")
         with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
@@ -61,7 +65,7 @@ def main():
         logging.info(f"Successfully created the final filtered metadata file: {OUTPUT_FILE}")
 
     except FileNotFoundError:
-        logging.error(f"Error: Input file not found at '{INPUT_FILE}'")
+        logging.error(f"Error: Metadata sidecar not found at '{INPUT_DIR}'")
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}", exc_info=True)
 
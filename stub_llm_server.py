@@ -0,0 +1,137 @@
+# stub_llm_server.py
+"""
+Minimal OpenAI-compatible chat completion server for testing ingest without a vLLM backend.
+
+It answers POST /v1/chat/completions with a metadata JSON object built from the
+prompt, after a configurable delay. It can also fail a share of the requests and
+reject requests beyond a concurrency capacity (HTTP 503), which exercises the
+retries and the adaptive concurrency limit of MetadataExtractor.
+
+    python stub_llm_server.py --port 8001 --latency 2 --capacity 16
+    # config.yaml: llm.api_base: "http://localhost:8001/v1"
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DOCUMENT_CONTENT = re.compile(r'--- DOCUMENT CONTENT ---\n(.*?)\n--- END DOCUMENT CONTENT ---', re.S)
+
+def fake_metadata(prompt: str) -> dict:
+    """Derives a deterministic title, summary and tags from the document part of the prompt."""
+    match = DOCUMENT_CONTENT.search(prompt)
+    content = match.group(1) if match else prompt
+    lines = [line.strip() for line in content.splitlines() if line.strip()]
+    title = lines[0][:120] if lines else "เอกสารไม่มีชื่อ"
+    words = sorted(set(content.split()), key=lambda word: (-len(word), word))
+    return {
+        "document_title": title,
+        "summary": " ".join(lines[1:3])[:300] if len(lines) > 1 else title,
+        "tags": words[:5],
+    }
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    server_version = "StubLLM/1.0"
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send(200, {"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send(404, {"error": {"message": "not found"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        with self.server.lock:
+            if self.server.in_flight >= self.server.capacity:
+                overloaded = True
+            else:
+                overloaded = False
+                self.server.in_flight += 1
+            self.server.requests += 1
+        if overloaded:
+            self._send(503, {"error": {"message": "server overloaded"}})
+            return
+
+        try:
+            # ยิ่งมี request พร้อมกันมาก ยิ่งตอบช้าลงเล็กน้อย (จำลอง batch ของ vLLM)
+            delay = self.server.latency * (1 + self.server.in_flight / self.server.capacity) + random.uniform(0, self.server.jitter)
+            time.sleep(delay)
+            if random.random() < self.server.error_rate:
+                self._send(500, {"error": {"message": "injected failure"}})
+                return
+            prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+            content = json.dumps(fake_metadata(prompt), ensure_ascii=False)
+            self._send(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", self.server.model),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                          "total_tokens": (len(prompt) + len(content)) // 4},
+            })
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def make_server(host='127.0.0.1', port=8001, latency=1.0, jitter=0.5, error_rate=0.0, capacity=16,
+                model='stub-model', quiet=True) -> ThreadingHTTPServer:
+    """Creates (but does not start) a stub server; port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.capacity = capacity
+    server.model = model
+    server.quiet = quiet
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.requests = 0
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stub OpenAI-compatible LLM server for ingest testing.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=1.0, help="Base seconds per request.")
+    parser.add_argument('--jitter', type=float, default=0.5, help="Extra random seconds per request.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with HTTP 500.")
+    parser.add_argument('--capacity', type=int, default=16, help="Concurrent requests served before answering 503.")
+    parser.add_argument('--model', default='stub-model')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.jitter, args.error_rate,
+                         args.capacity, args.model, quiet=not args.verbose)
+    print(f"Stub LLM server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# tune_faiss_index.py
+import json
+import logging
+import time
+import faiss
+import numpy as np
+
+from pipeline_lib.config_loader import load_config
+from pipeline_lib.utils import setup_logging
+from pipeline_lib.storage import create_storage_adapter
+from pipeline_lib.storage.faiss_store import build_index, apply_search_params
+
+# ค่าที่จะลองปรับสำหรับแต่ละประเภท index (knob, ค่าที่ลอง)
+SEARCH_KNOBS = {
+    'IVF_FLAT': ('nprobe', [1, 4, 8, 16, 32, 64, 128]),
+    'IVF_PQ': ('nprobe', [1, 4, 8, 16, 32, 64, 128]),
+    'HNSW': ('ef_search', [16, 32, 64, 128, 256]),
+}
+
+# precision ที่ลองกับ FLAT index (knob, ค่าที่ลอง); BINARY ปรับจำนวน candidate ที่นำมา rescore
+PRECISION_KNOBS = {
+    'FLOAT16': (None, [None]),
+    'SQ8': (None, [None]),
+    'BINARY': ('rescore_factor', [1, 4, 10, 20]),
+}
+
+def load_sample_vectors(store, config, sample_size):
+    """
+    Returns exact vectors for a random sample of indexed chunks.
+    Vectors are reconstructed from the index when it stores them uncompressed,
+    otherwise the chunk texts are re-embedded with the configured model.
+    """
+    rng = np.random.default_rng(0)
+    all_ids = store.all_chunk_ids()
+    sample_ids = rng.choice(all_ids, min(sample_size, len(all_ids)), replace=False)
+
+    vectors = store.reconstruct_vectors(sample_ids)
+    if vectors is not None:
+        logging.info(f"Reconstructed {len(sample_ids)} vectors from the existing index.")
+        return vectors
+
+    from sentence_transformers import SentenceTransformer
+    logging.info(f"Index is compressed; re-embedding {len(sample_ids)} chunks with {config['embedding']['model_name']}...")
+    model = SentenceTransformer(config['embedding']['model_name'], device=config['embedding']['device'])
+    chunks = store.fetch_chunks(sample_ids)
+    texts = [chunks[int(i)]['chunk_text'] for i in sample_ids]
+    return model.encode(texts, normalize_embeddings=True).astype('float32')
+
+def evaluate(index, queries, ground_truth, k):
+    """Returns (recall@k, milliseconds per query) of an index against exact results."""
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    hits = sum(len(set(found[i]) & set(ground_truth[i])) for i in range(len(queries)))
+    return hits / ground_truth.size, elapsed_ms / len(queries)
+
+def main():
+    """
+    Builds each approximate index type, and a FLAT index at each reduced storage
+    precision, over a sample of the indexed vectors and reports recall@k, latency
+    and memory saved against the exact float32 (flat) index, so that nprobe /
+    ef_search / precision in config.yaml can be chosen with real numbers.
+    """
+    setup_logging()
+    config = load_config()
+    if not config: return
+
+    faiss_config = config['vector_store']['faiss']
+    tuning_config = faiss_config.get('tuning', {})
+    k = tuning_config.get('k', 10)
+    num_queries = tuning_config.get('num_queries', 500)
+
+    # เปิดผ่าน create_storage_adapter เพื่อให้ใช้ได้ทั้ง index เดี่ยวและแบบแบ่ง shard
+    store = create_storage_adapter(dict(config['vector_store'], type='FAISS'), None, read_only=True)
+    num_chunks = len(store.all_chunk_ids())
+    if num_chunks <= num_queries:
+        logging.error(f"Need more than {num_queries} indexed chunks to tune; found {num_chunks}.")
+        return
+
+    vectors = load_sample_vectors(store, config, tuning_config.get('sample_size', 50000))
+    queries, base = vectors[:num_queries], vectors[num_queries:]
+    base_ids = np.arange(len(base), dtype='int64')
+
+    flat_index = faiss.IndexFlatIP(vectors.shape[1])
+    flat_index.add(base)
+    _, ground_truth = flat_index.search(queries, k)
+    _, flat_ms = evaluate(flat_index, queries, ground_truth, k)
+
+    flat_bytes = len(faiss.serialize_index(flat_index))
+    report = [{"index_type": "FLAT", "precision": "FLOAT32", "param": None, "value": None, "recall": 1.0,
+               "ms_per_query": flat_ms, "bytes": flat_bytes, "memory_saved": 0.0}]
+
+    for index_type in tuning_config.get('index_types', list(SEARCH_KNOBS)):
+        knob, values = SEARCH_KNOBS[index_type]
+        type_config = dict(faiss_config, index_type=index_type)
+        index = build_index(type_config, vectors.shape[1], n_train=len(base))
+        logging.info(f"Building {index_type} over {len(base)} vectors...")
+        index.train(base)
+        index.add_with_ids(base, base_ids)
+        index_bytes = len(faiss.serialize_index(index))
+
+        for value in values:
+            apply_search_params(index, dict(type_config, **{knob: value}))
+            recall, ms_per_query = evaluate(index, queries, ground_truth, k)
+            report.append({"index_type": index_type, "precision": type_config.get('precision', 'FLOAT32'),
+                           "param": knob, "value": value, "recall": recall, "ms_per_query": ms_per_query,
+                           "bytes": index_bytes, "memory_saved": 1 - index_bytes / flat_bytes})
+
+    for precision in tuning_config.get('precisions', list(PRECISION_KNOBS)):
+        knob, values = PRECISION_KNOBS[precision]
+        precision_config = dict(faiss_config, index_type='FLAT', precision=precision)
+        index = build_index(precision_config, vectors.shape[1], n_train=len(base))
+        logging.info(f"Building FLAT {precision} over {len(base)} vectors...")
+        index.train(base)
+        index.add_with_ids(base, base_ids)
+        index_bytes = len(faiss.serialize_index(index))
+
+        for value in values:
+            apply_search_params(index, dict(precision_config, **({knob: value} if knob else {})))
+            recall, ms_per_query = evaluate(index, queries, ground_truth, k)
+            report.append({"index_type": "FLAT", "precision": precision, "param": knob, "value": value,
+                           "recall": recall, "ms_per_query": ms_per_query,
+                           "bytes": index_bytes, "memory_saved": 1 - index_bytes / flat_bytes})
+
+    print(f"\n{'index_type':<10} {'precision':<9} {'param':<14} {'value':>6} {'recall@' + str(k):>10} "
+          f"{'ms/query':>10} {'MB':>10} {'saved':>7}")
+    for row in report:
+        print(f"{row['index_type']:<10} {row['precision']:<9} {str(row['param'] or '-'):<14} {str(row['value'] or '-'):>6} "
+              f"{row['recall']:>10.4f} {row['ms_per_query']:>10.3f} {row['bytes'] / 2**20:>10.1f} {row['memory_saved']:>7.1%}")
+
+    report_path = tuning_config.get('report_path')
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        logging.info(f"Tuning report written to {report_path}")
+
+if __name__ == "__main__":
+    main()